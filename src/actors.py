@@ -0,0 +1,223 @@
+import queue
+import time
+from typing import List
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from src.environment import FourRoomEnv, StateFields
+from src.features.model_ready import SequenceStateFeaturizer, StreamingFeaturizer
+from src.inference_server import InferenceClient, InferenceServer
+from src.policy import select_actions
+from src.replay_memory import SharedReplayBuffer
+from src.scheduler import ExponentialSchedule
+
+
+class ActorPool:
+    """
+    Actor processes playing the environment for a learner.
+
+    Every actor acts with the models of an InferenceServer (epsilon-greedy, with the
+    schedule value at the global step) and appends its transitions to its own shard of a
+    SharedReplayBuffer, which the learner samples from. Actors claim global steps from a
+    shared counter until `num_steps` is reached, so `n_steps` is the number of
+    environment steps taken by all actors together.
+
+    Parameters:
+        env (FourRoomEnv): Environment, every actor plays its own copy.
+        featurizer (SequenceStateFeaturizer): Featurizer of the served models.
+        replay_buffer (SharedReplayBuffer): Buffer with one shard per actor.
+        server (InferenceServer): Server with one client per actor.
+        scheduler (ExponentialSchedule): Exploration schedule.
+        gamma (float): Discount of the episode returns reported by `finished_episodes`.
+        num_steps (int): Global step at which the actors stop.
+        start_step (int): Global step to start from, e.g. of a resumed run.
+        start_method (str): Multiprocessing start method of the actor processes.
+    """
+
+    def __init__(
+        self,
+        env: FourRoomEnv,
+        featurizer: SequenceStateFeaturizer,
+        replay_buffer: SharedReplayBuffer,
+        server: InferenceServer,
+        scheduler: ExponentialSchedule,
+        gamma: float,
+        num_steps: int,
+        start_step: int = 0,
+        start_method: str = "spawn",
+    ):
+        n_actors = replay_buffer.n_shards
+        assert n_actors == len(
+            server.response_queues
+        ), "Need one inference client per replay buffer shard"
+
+        context = mp.get_context(start_method)
+        self.steps = context.Value("q", start_step)
+        self.stop = context.Event()
+        self.episodes = context.Queue()
+        # episodes received while closing
+        self.pending_episodes = []
+
+        # actors draw their own exploration and environment randomness
+        seeds = np.random.randint(0, 2**31, n_actors)
+        self.processes = [
+            context.Process(
+                target=_act,
+                args=(
+                    env,
+                    featurizer,
+                    replay_buffer,
+                    server.client(actor_idx),
+                    actor_idx,
+                    int(seeds[actor_idx]),
+                    scheduler,
+                    gamma,
+                    num_steps,
+                    self.steps,
+                    self.stop,
+                    self.episodes,
+                ),
+                daemon=True,
+            )
+            for actor_idx in range(n_actors)
+        ]
+        for process in self.processes:
+            process.start()
+
+    @property
+    def n_steps(self) -> int:
+        """Global steps claimed by the actors so far."""
+        return self.steps.value
+
+    def finished_episodes(self) -> List[dict]:
+        """
+        Episodes finished since the last call, as dicts with the env `info`, the mean
+        "imposter_return" and "crew_return", the "length" and the "eps" they ended with.
+        Raises RuntimeError if an actor failed.
+        """
+        self._receive_episodes()
+        episodes, self.pending_episodes = self.pending_episodes, []
+
+        failed = [p.exitcode for p in self.processes if p.exitcode not in (None, 0)]
+        if failed:
+            raise RuntimeError(f"Actor processes failed with exit codes {failed}")
+        return episodes
+
+    def wait(self, n_steps: int, timeout: float = 0.01):
+        """Waits (at most `timeout` seconds) until the actors have claimed `n_steps` steps."""
+        deadline = time.perf_counter() + timeout
+        while self.n_steps < n_steps and time.perf_counter() < deadline:
+            time.sleep(0.001)
+
+    def close(self):
+        self.stop.set()
+        # actors only exit once their finished episodes are flushed to the queue
+        for process in self.processes:
+            while process.is_alive():
+                self._receive_episodes()
+                process.join(timeout=0.1)
+        self._receive_episodes()
+
+    def _receive_episodes(self):
+        while True:
+            try:
+                self.pending_episodes.append(self.episodes.get_nowait())
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _act(
+    env: FourRoomEnv,
+    featurizer: SequenceStateFeaturizer,
+    replay_buffer: SharedReplayBuffer,
+    client: InferenceClient,
+    actor_idx: int,
+    seed: int,
+    scheduler: ExponentialSchedule,
+    gamma: float,
+    num_steps: int,
+    steps,
+    stop,
+    episodes,
+):
+    torch.set_num_threads(1)
+    np.random.seed(seed)
+    replay_buffer.set_shard(actor_idx)
+    imposter_model, crew_model = client.remote_models()
+    trajectory_size = replay_buffer.trajectory_size
+
+    state, _ = env.reset()
+    state_sequence = np.zeros((trajectory_size, replay_buffer.state_size))
+    for i in range(trajectory_size):
+        state_sequence[i] = env.flatten_state(state)
+    stream = StreamingFeaturizer(featurizer, trajectory_size)
+    stream.reset(state_sequence[-1])
+
+    G = np.zeros(env.n_agents)
+    t_episode = 0
+
+    while not stop.is_set():
+        with steps.get_lock():
+            t_total = steps.value
+            if t_total >= num_steps:
+                break
+            steps.value += 1
+
+        eps = scheduler.value(t_total)
+        alive_agents = state[env.state_fields[StateFields.ALIVE_AGENTS]]
+        with torch.no_grad():
+            agent_actions, _, _ = select_actions(
+                env,
+                featurizer,
+                stream.current(),
+                imposter_model,
+                crew_model,
+                alive_agents,
+                eps=eps,
+            )
+
+        next_state, reward, done, trunc, info = env.step(agent_actions=agent_actions)
+        G = reward + gamma * G
+
+        next_state_sequence = np.roll(state_sequence.copy(), -1, axis=0)
+        next_state_sequence[-1] = env.flatten_state(next_state)
+
+        replay_buffer.add(
+            state=state_sequence,
+            action=agent_actions,
+            reward=reward,
+            done=done,
+            next_state=next_state_sequence,
+            imposters=env.imposter_idxs,
+            truncated=trunc,
+        )
+
+        if done or trunc:
+            episodes.put(
+                {
+                    "info": info,
+                    "imposter_return": G[env.imposter_mask].mean().item(),
+                    "crew_return": G[~env.imposter_mask].mean().item(),
+                    "length": t_episode,
+                    "eps": eps,
+                }
+            )
+
+            G = np.zeros(env.n_agents)
+            t_episode = 0
+            state, _ = env.reset()
+            for i in range(trajectory_size):
+                state_sequence[i] = env.flatten_state(state)
+            stream.reset(state_sequence[-1])
+        else:
+            state = next_state
+            state_sequence = next_state_sequence
+            stream.push(state_sequence[-1])
+            t_episode += 1
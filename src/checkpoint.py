@@ -0,0 +1,174 @@
+import pathlib
+import random
+from functools import partial
+from typing import Dict, Optional
+import numpy as np
+import torch
+
+from src.models.dqn import ModelType, Q_Estimator, build_from_checkpoint
+from src.scheduler import ExponentialSchedule
+
+CHECKPOINT_VERSION = 1
+
+
+def rng_state() -> dict:
+    """States of the python, numpy and torch global generators, as plain types and tensors."""
+    numpy_state = np.random.get_state(legacy=False)
+    return {
+        "python": random.getstate(),
+        "numpy": {
+            **numpy_state,
+            "state": {
+                "key": torch.from_numpy(numpy_state["state"]["key"].astype(np.int64)),
+                "pos": numpy_state["state"]["pos"],
+            },
+        },
+        "torch": torch.get_rng_state(),
+    }
+
+
+def set_rng_state(state: dict):
+    """Restores generator states saved with `rng_state`."""
+    random.setstate(state["python"])
+    np.random.set_state(
+        {
+            **state["numpy"],
+            "state": {
+                "key": state["numpy"]["state"]["key"].numpy().astype(np.uint32),
+                "pos": state["numpy"]["state"]["pos"],
+            },
+        }
+    )
+    torch.set_rng_state(state["torch"])
+
+
+def save_training_checkpoint(
+    filepath: pathlib.Path,
+    models: Dict[str, Q_Estimator],
+    target_models: Dict[str, Q_Estimator],
+    optimizers: Dict[str, Optional[torch.optim.Optimizer]],
+    scheduler: ExponentialSchedule,
+    counters: Dict[str, int],
+):
+    """
+    Saves everything needed to resume training: models, target models, optimizers,
+    scheduler position, RNG states and the training loop counters.
+
+    Each model entry is a regular model checkpoint (config and state dict) with its model
+    type, so a single model can be loaded from the file with `load_model`. An optimizer
+    shared by several teams is saved once.
+
+    Parameters:
+        filepath (pathlib.Path): Destination of the checkpoint.
+        models (Dict[str, Q_Estimator]): Models per team name, e.g. "imposter" and "crew".
+        target_models (Dict[str, Q_Estimator]): Target models per team name.
+        optimizers (Dict[str, torch.optim.Optimizer]): Optimizer per team name, None for teams not trained.
+        scheduler (ExponentialSchedule): Exploration schedule, its position is counters["t_total"].
+        counters (Dict[str, int]): Training loop counters, at least "t_total".
+    """
+    saved_optimizers = {}
+    for name, optimizer in optimizers.items():
+        if optimizer is not None and all(
+            optimizer is not optimizers[saved_name] for saved_name in saved_optimizers
+        ):
+            saved_optimizers[name] = optimizer.state_dict()
+
+    checkpoint = {
+        "version": CHECKPOINT_VERSION,
+        "models": {name: _model_entry(model) for name, model in models.items()},
+        "target_models": {
+            name: _model_entry(model) for name, model in target_models.items()
+        },
+        "optimizers": saved_optimizers,
+        "scheduler": {
+            "value_from": scheduler.value_from,
+            "value_to": scheduler.value_to,
+            "num_steps": scheduler.num_steps,
+            "step": counters["t_total"],
+        },
+        "rng_state": rng_state(),
+        "counters": counters,
+    }
+    torch.save(checkpoint, filepath)
+    print(f"Training checkpoint saved to {filepath}")
+
+
+def _model_entry(model: Q_Estimator) -> dict:
+    return {
+        "model_type": str(model.model_type),
+        "config": model.config,
+        "state_dict": model.state_dict(),
+    }
+
+
+def load_checkpoint(
+    filepath: pathlib.Path, map_location="cpu", mmap: bool = True
+) -> dict:
+    """
+    Loads a training checkpoint. With `mmap`, tensors are memory mapped from the file
+    instead of read eagerly, and `map_location` maps the saved devices (e.g. CUDA) to the
+    devices available here.
+    """
+    checkpoint = torch.load(filepath, map_location=map_location, mmap=mmap)
+    assert (
+        checkpoint.get("version") == CHECKPOINT_VERSION
+    ), f"Unsupported training checkpoint version: {checkpoint.get('version')}"
+    return checkpoint
+
+
+def load_model(
+    filepath: pathlib.Path,
+    name: str,
+    target: bool = False,
+    map_location="cpu",
+    mmap: bool = True,
+) -> Q_Estimator:
+    """
+    Model of one team from a training checkpoint, for evaluation. Its weights stay memory
+    mapped (see `build_from_checkpoint`), so opening a checkpoint doesn't read the others.
+
+    Parameters:
+        filepath (pathlib.Path): Training checkpoint.
+        name (str): Team name of the model, e.g. "imposter".
+        target (bool): Load the target model instead.
+    """
+    checkpoint = load_checkpoint(filepath, map_location=map_location, mmap=mmap)
+    entry = checkpoint["target_models" if target else "models"][name]
+    return build_from_checkpoint(partial(ModelType.build, entry["model_type"]), entry)
+
+
+def restore_training_checkpoint(
+    checkpoint: dict,
+    models: Dict[str, Q_Estimator],
+    target_models: Dict[str, Q_Estimator],
+    optimizers: Dict[str, Optional[torch.optim.Optimizer]],
+    scheduler: Optional[ExponentialSchedule] = None,
+) -> Dict[str, int]:
+    """
+    Loads a training checkpoint into already built models and optimizers (in place, so
+    models sharing modules keep sharing them) and restores the RNG states.
+
+    Returns:
+        Dict[str, int]: The training loop counters to resume from.
+    """
+    for name, model in models.items():
+        model.load_state_dict(checkpoint["models"][name]["state_dict"])
+    for name, model in target_models.items():
+        model.load_state_dict(checkpoint["target_models"][name]["state_dict"])
+    for name, optimizer_state in checkpoint["optimizers"].items():
+        assert optimizers[name] is not None, f"No optimizer to restore for {name}"
+        optimizers[name].load_state_dict(optimizer_state)
+
+    if scheduler is not None and (
+        scheduler.value_from,
+        scheduler.value_to,
+        scheduler.num_steps,
+    ) != (
+        checkpoint["scheduler"]["value_from"],
+        checkpoint["scheduler"]["value_to"],
+        checkpoint["scheduler"]["num_steps"],
+    ):
+        print("Warning: resuming with a different exploration schedule")
+
+    set_rng_state(checkpoint["rng_state"])
+    return checkpoint["counters"]
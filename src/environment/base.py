@@ -240,6 +240,23 @@ class FourRoomEnv(Env):
             state = state.numpy()
         return spaces.unflatten(self.observation_space, state)
 
+    def flat_state_field(
+        self, states: torch.Tensor, state_field: StateFields
+    ) -> torch.Tensor:
+        """
+        Reads a state field straight from flat states of shape (..., flattened_state_size).
+
+        Same values as `unflatten_state(s)[state_fields[state_field]]` for every state, as
+        a tensor of shape (..., *field shape), without unflattening state by state.
+        """
+        field_idx = self.state_fields[state_field]
+        subspaces = self.observation_space.spaces
+        start = sum(spaces.flatdim(space) for space in subspaces[:field_idx])
+        end = start + spaces.flatdim(subspaces[field_idx])
+        return states[..., start:end].reshape(
+            *states.shape[:-1], *subspaces[field_idx].shape
+        )
+
     def _validate_init_args(self, n_imposters, n_crew, n_jobs):
         assert n_imposters > 0, f"Must have at least one imposter. Got {n_imposters}."
         assert n_crew > 0, f"Must have at least one crew member. Got {n_crew}."
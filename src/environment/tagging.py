@@ -17,9 +17,9 @@ class FourRoomEnvWithTagging(FourRoomEnv):
             for idx, field in enumerate(
                 [
                     StateFields.AGENT_POSITIONS,
+                    StateFields.ALIVE_AGENTS,
                     StateFields.JOB_POSITIONS,
                     StateFields.JOB_STATUS,
-                    StateFields.ALIVE_AGENTS,
                     StateFields.USED_TAGS,
                     StateFields.TAG_COUNTS,
                     StateFields.TAG_RESET_COUNT,
@@ -1,2 +1,3 @@
 from .model_ready import *
-from .component import *
\ No newline at end of file
+from .component import *
+from .cache import *
@@ -0,0 +1,392 @@
+import json
+import platform
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+import torch
+
+from src.environment.base import FourRoomEnv
+from src.environment.pred_prey import ImposterTrainingGround
+from src.environment.tagging import FourRoomEnvWithTagging
+from src.features.component import (
+    AgentPositionsFeaturizer,
+    AliveCrewFeaturizer,
+    ClosestAliveCrewFeaturizer,
+    ComponentFeaturizer,
+    CompositeFeaturizer,
+    CoordinateAgentPositionsFeaturizer,
+    DistanceToImposterFeaturizer,
+    ImposterScentFeaturizer,
+    ImposterVSCrewRoomLocaionFeaturizer,
+    JobFeaturizer,
+    L1CrewFeaturizer,
+    OneHotAgentPositionFeaturizer,
+    WallsFeaturizer,
+)
+from src.features.model_ready import (
+    FeaturizerType,
+    FlatFeaturizer,
+    GlobalFeaturizer,
+    PerspectiveFeaturizer,
+    SequenceStateFeaturizer,
+)
+from src.features.sampling import random_states
+
+
+def build_env(env_name: str, n_crew: int, n_jobs: int = 4) -> FourRoomEnv:
+    """
+    Builds an environment with a single imposter, by class name.
+
+    Parameters:
+        env_name (str): FourRoomEnv, ImposterTrainingGround or FourRoomEnvWithTagging.
+        n_crew (int): Number of crew members.
+        n_jobs (int): Number of jobs.
+    """
+    if env_name == FourRoomEnv.__name__:
+        return FourRoomEnv(n_imposters=1, n_crew=n_crew, n_jobs=n_jobs)
+    elif env_name == ImposterTrainingGround.__name__:
+        return ImposterTrainingGround(
+            n_crew=n_crew,
+            n_jobs=n_jobs,
+            time_step_reward=0,
+            kill_reward=3,
+            sabotage_reward=1,
+            end_of_game_reward=10,
+        )
+    elif env_name == FourRoomEnvWithTagging.__name__:
+        return FourRoomEnvWithTagging(n_imposters=1, n_crew=n_crew, n_jobs=n_jobs)
+    raise ValueError(f"Unknown environment: {env_name}")
+
+
+def component_featurizers(env: FourRoomEnv) -> List[ComponentFeaturizer]:
+    """
+    The component featurizers of `component.py`. The imposter centric ones read the
+    imposter at index 0, as in ImposterTrainingGround, but are checked on every environment.
+    """
+    featurizers = [
+        AgentPositionsFeaturizer(env),
+        JobFeaturizer(env),
+        OneHotAgentPositionFeaturizer(env),
+        DistanceToImposterFeaturizer(env),
+        L1CrewFeaturizer(env),
+        ClosestAliveCrewFeaturizer(env),
+        AliveCrewFeaturizer(env),
+        CoordinateAgentPositionsFeaturizer(env),
+        WallsFeaturizer(env),
+        ImposterScentFeaturizer(env),
+        ImposterVSCrewRoomLocaionFeaturizer(env),
+    ]
+    return featurizers
+
+
+def sequence_featurizers(env: FourRoomEnv) -> Dict[str, SequenceStateFeaturizer]:
+    """The sequence featurizers of `model_ready.py` in all their variants, by name."""
+    return {
+        "perspective": FeaturizerType.build(FeaturizerType.PERPSECTIVE, env),
+        "perspective_po": FeaturizerType.build(
+            FeaturizerType.PERPSECTIVE, env, partially_observable=True
+        ),
+        "perspective_sparse": FeaturizerType.build(
+            FeaturizerType.PERPSECTIVE, env, sparse=True
+        ),
+        "global": FeaturizerType.build(FeaturizerType.GLOBAL, env),
+        "global_po": FeaturizerType.build(
+            FeaturizerType.GLOBAL, env, partially_observable=True
+        ),
+        "global_sparse": FeaturizerType.build(FeaturizerType.GLOBAL, env, sparse=True),
+        "flat_coordinates": FeaturizerType.build(
+            FeaturizerType.FLAT,
+            env,
+            featurizers=CompositeFeaturizer([CoordinateAgentPositionsFeaturizer(env)]),
+        ),
+        "flat_one_hot": FeaturizerType.build(
+            FeaturizerType.FLAT,
+            env,
+            featurizers=CompositeFeaturizer([OneHotAgentPositionFeaturizer(env)]),
+        ),
+    }
+
+
+def reference_component_features(
+    featurizer: ComponentFeaturizer, states: torch.Tensor
+) -> torch.Tensor:
+    """Per-state reference of `featurizer.extract_features_batch(states)`."""
+    env = featurizer.env
+    return torch.stack(
+        [featurizer.extract_features(env.unflatten_state(s)) for s in states]
+    )
+
+
+def reference_sequence_features(
+    featurizer: SequenceStateFeaturizer, state_sequence: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Per-state and per-agent reference of `generate_stacked_featurized_states`.
+
+    Parameters:
+        featurizer (SequenceStateFeaturizer): Perspective, Global or Flat featurizer.
+        state_sequence (torch.Tensor): States, shape (B, T, S).
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: Spatial and non-spatial features, (n_agents, B, T, ...).
+    """
+    env = featurizer.env
+    B, T, _ = state_sequence.size()
+    states = [
+        [env.unflatten_state(state_sequence[b, t]) for t in range(T)] for b in range(B)
+    ]
+
+    def per_frame(extract: Callable) -> torch.Tensor:
+        return torch.stack(
+            [torch.stack([extract(state) for state in sequence]) for sequence in states]
+        )
+
+    if isinstance(featurizer, FlatFeaturizer):
+        non_spatial = per_frame(featurizer.featurizer.extract_features)
+        return (
+            torch.zeros(env.n_agents, B, T, 1),
+            torch.stack([non_spatial] * env.n_agents),
+        )
+
+    if isinstance(featurizer, PerspectiveFeaturizer):
+        spatial_featurizer = featurizer.sp_f
+    elif isinstance(featurizer, GlobalFeaturizer):
+        spatial_featurizer = featurizer.spatial_features
+    else:
+        raise ValueError(f"No reference for {featurizer.__class__.__name__}")
+    spatial = per_frame(spatial_featurizer.extract_features)
+
+    agents_spatial, agents_non_spatial = [], []
+    for agent_idx in range(env.n_agents):
+        # partially observable features hold one view per agent
+        agent_spatial = spatial[:, :, agent_idx] if featurizer.partially_observable else spatial
+
+        if isinstance(featurizer, PerspectiveFeaturizer):
+            # agent first, then the others in increasing order, other channels stay in place
+            others = [a for a in range(env.n_agents) if a != agent_idx]
+            agent_order = [agent_idx] + others
+            channel_order = agent_order + list(range(env.n_agents, agent_spatial.size(2)))
+            agent_spatial = agent_spatial[:, :, channel_order]
+
+            agent_non_spatial = per_frame(featurizer.agent_non_sp_f.extract_features)
+            agent_non_spatial = agent_non_spatial.view(B, T, -1, env.n_agents)
+            non_spatial = torch.cat(
+                [
+                    agent_non_spatial[..., agent_order].reshape(B, T, -1),
+                    per_frame(featurizer.global_non_sp_f.extract_features),
+                ],
+                dim=2,
+            )
+        else:
+            agent_one_hot = torch.zeros(B, T, env.n_agents)
+            agent_one_hot[..., agent_idx] = 1
+            non_spatial = torch.cat(
+                [per_frame(featurizer.non_spatial_features.extract_features), agent_one_hot],
+                dim=2,
+            )
+
+        agents_spatial.append(agent_spatial)
+        agents_non_spatial.append(non_spatial)
+
+    return torch.stack(agents_spatial), torch.stack(agents_non_spatial)
+
+
+def time_call(fn: Callable, n_repeats: int = 5) -> float:
+    """Best wall clock time of `fn()` in seconds, over `n_repeats` calls after one warm-up call."""
+    fn()
+    timings = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def _matches(outputs, references) -> bool:
+    return all(
+        output.shape == reference.shape and torch.equal(output.float(), reference.float())
+        for output, reference in zip(outputs, references)
+    )
+
+
+def benchmark_component_featurizers(
+    env: FourRoomEnv, batch_sizes: List[int], n_repeats: int = 5, seed: int = 0
+) -> List[dict]:
+    """
+    Frames per second of `extract_features_batch` against the per-state reference.
+
+    Parameters:
+        env (FourRoomEnv): The environment.
+        batch_sizes (List[int]): Number of states per call.
+        n_repeats (int): Timed calls per measurement.
+        seed (int): Seed of the random states.
+    """
+    results = []
+    states = random_states(env, max(batch_sizes), seed=seed)
+    for featurizer in component_featurizers(env):
+        for batch_size in batch_sizes:
+            batch = states[:batch_size]
+            output = featurizer.extract_features_batch(batch)
+            reference = reference_component_features(featurizer, batch)
+
+            elapsed = time_call(lambda: featurizer.extract_features_batch(batch), n_repeats)
+            reference_elapsed = time_call(
+                lambda: reference_component_features(featurizer, batch), 1
+            )
+            results.append(
+                {
+                    "featurizer": featurizer.__class__.__name__,
+                    "batch_size": batch_size,
+                    "sequence_length": 1,
+                    "frames_per_sec": batch_size / elapsed,
+                    "reference_frames_per_sec": batch_size / reference_elapsed,
+                    "matches_reference": _matches([output], [reference]),
+                }
+            )
+    return results
+
+
+def benchmark_sequence_featurizers(
+    env: FourRoomEnv,
+    batch_sizes: List[int],
+    sequence_lengths: List[int],
+    n_repeats: int = 5,
+    seed: int = 0,
+) -> List[dict]:
+    """
+    Frames per second of `featurize` followed by `generate_stacked_featurized_states`
+    (all agents' perspectives) against the per-state, per-agent reference.
+
+    Parameters:
+        env (FourRoomEnv): The environment.
+        batch_sizes (List[int]): Number of sequences per call.
+        sequence_lengths (List[int]): Number of states per sequence.
+        n_repeats (int): Timed calls per measurement.
+        seed (int): Seed of the random states.
+    """
+    results = []
+    states = random_states(env, max(batch_sizes) * max(sequence_lengths), seed=seed)
+    for name, featurizer in sequence_featurizers(env).items():
+        for batch_size in batch_sizes:
+            for sequence_length in sequence_lengths:
+                n_frames = batch_size * sequence_length
+                state_sequence = states[:n_frames].view(batch_size, sequence_length, -1)
+
+                def featurize():
+                    return featurizer.generate_stacked_featurized_states(
+                        featurizer.featurize(state_sequence)
+                    )
+
+                output = featurize()
+                reference = reference_sequence_features(featurizer, state_sequence)
+
+                elapsed = time_call(featurize, n_repeats)
+                reference_elapsed = time_call(
+                    lambda: reference_sequence_features(featurizer, state_sequence), 1
+                )
+                results.append(
+                    {
+                        "featurizer": name,
+                        "batch_size": batch_size,
+                        "sequence_length": sequence_length,
+                        "frames_per_sec": n_frames / elapsed,
+                        "reference_frames_per_sec": n_frames / reference_elapsed,
+                        "matches_reference": _matches(output, reference),
+                    }
+                )
+    return results
+
+
+def run_featurizer_benchmark(
+    env_names: Optional[List[str]] = None,
+    n_crews: List[int] = [3, 7],
+    batch_sizes: List[int] = [1, 32, 256],
+    sequence_lengths: List[int] = [1, 4, 16],
+    n_repeats: int = 5,
+    seed: int = 0,
+) -> dict:
+    """
+    Benchmarks the throughput (frames per second) of every featurizer on every environment
+    and agent count, and checks its output against a per-state reference: `extract_features`
+    of the component featurizers on unflattened states, i.e. the original implementation.
+    Optimizations of the featurizers are only safe if every result matches.
+
+    Example:
+        report = run_featurizer_benchmark(batch_sizes=[1, 32], sequence_lengths=[2, 8])
+        save_report(report, "featurizer_benchmark.json")
+        assert not failed_checks(report)
+
+    An environment that can't be featurized is reported with its error instead of results,
+    and counts as a failed check.
+
+    Parameters:
+        env_names (List[str]): Environment classes, defaults to all of them.
+        n_crews (List[int]): Crew sizes, every environment has one imposter.
+        batch_sizes (List[int]): Number of sequences (states for component featurizers) per call.
+        sequence_lengths (List[int]): Number of states per sequence.
+        n_repeats (int): Timed calls per measurement, the best one is reported.
+        seed (int): Seed of the random states.
+
+    Returns:
+        dict: The report, see `save_report`.
+    """
+    if env_names is None:
+        env_names = [
+            FourRoomEnv.__name__,
+            ImposterTrainingGround.__name__,
+            FourRoomEnvWithTagging.__name__,
+        ]
+    torch.manual_seed(seed)
+
+    runs = []
+    for env_name in env_names:
+        for n_crew in n_crews:
+            run = {"env": env_name, "n_agents": n_crew + 1}
+            try:
+                env = build_env(env_name, n_crew)
+                run["component"] = benchmark_component_featurizers(
+                    env, batch_sizes, n_repeats=n_repeats, seed=seed
+                )
+                run["sequence"] = benchmark_sequence_featurizers(
+                    env, batch_sizes, sequence_lengths, n_repeats=n_repeats, seed=seed
+                )
+            except Exception as e:
+                run["error"] = f"{e.__class__.__name__}: {e}"
+            runs.append(run)
+
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "n_threads": torch.get_num_threads(),
+        "seed": seed,
+        "runs": runs,
+    }
+
+
+def failed_checks(report: dict) -> List[dict]:
+    """
+    Results of the report whose output differs from the reference, and the runs that
+    failed with an error (nothing of them was checked).
+    """
+    failures = []
+    for run in report["runs"]:
+        if "error" in run:
+            failures.append(run)
+            continue
+        failures.extend(
+            {"env": run["env"], "n_agents": run["n_agents"], **result}
+            for result in run["component"] + run["sequence"]
+            if not result["matches_reference"]
+        )
+    return failures
+
+
+def save_report(report: dict, path: str) -> None:
+    """
+    Writes the report as JSON. Results are keyed by environment, agent count, featurizer,
+    batch size and sequence length, so reports of different commits can be compared.
+    """
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Featurizer benchmark saved to {path}")
@@ -0,0 +1,192 @@
+import threading
+from typing import Callable, List
+import torch
+
+
+class FeatureCache:
+    """
+    Bounded LRU cache of featurized frames, keyed by the flat state.
+
+    Lookups are tensor ops over the whole batch: frames are hashed from the bits of their
+    float32 values (no rounding, the same for float32 / float64 copies of a state), the
+    hashes are searched in a sorted index of the cached ones and hits are checked against
+    the stored frames, so colliding hashes are only misses. Features are stored in
+    preallocated slot tensors, as many slots as fit in `max_bytes`, and the least recently
+    used ones are reused first.
+
+    A fully hit lookup costs about a dense featurization of the batch, so the cache pays
+    off for the expensive (partially observable) featurizers, not for the sparse / flat ones.
+
+    The cache is thread safe, featurizers with the same configuration (e.g. copies used by
+    other threads) can share it, featurizers computing other features can't.
+
+    Parameters:
+        max_bytes (int): Memory cap for the cached frames and feature tensors.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 2**20):
+        assert max_bytes > 0, "Cache size must be positive"
+
+        self.max_bytes = max_bytes
+        # slot tensors, allocated with the shapes of the first featurized frames
+        self.keys = None
+        self.values = None
+        self.n_slots = 0
+        self.last_used = None
+        self.tick = 0
+        # sorted hashes of the filled slots, and the slot of every hash
+        self.sorted_hashes = torch.empty(0, dtype=torch.long)
+        self.sorted_slots = torch.empty(0, dtype=torch.long)
+        self.filled = None
+        self.slot_hashes = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.sorted_slots)
+
+    def featurize(
+        self,
+        frames: torch.Tensor,
+        featurize_frames: Callable[[torch.Tensor], List[torch.Tensor]],
+    ) -> List[torch.Tensor]:
+        """
+        Featurizes flat frames (N, S), only computing the frames that are not cached.
+
+        Parameters:
+            frames (torch.Tensor): Flat states, shape (N, S).
+            featurize_frames (Callable): Featurizes (M, S) frames into a list of (M, ...) tensors.
+
+        Returns:
+            List[torch.Tensor]: The (N, ...) tensors `featurize_frames(frames)` would return.
+        """
+        if len(frames) == 0:
+            return featurize_frames(frames)
+
+        keys = frames.to(torch.float32).contiguous()
+        hashes = _hash_rows(keys)
+
+        with self.lock:
+            slots = self._lookup(keys, hashes)
+            hit = slots >= 0
+            self.hits += int(hit.sum())
+            if self.values is not None:
+                self.tick += 1
+                self.last_used[slots[hit]] = self.tick
+                if hit.all():
+                    return [torch.index_select(values, 0, slots) for values in self.values]
+                # read before the slots can be reused by other threads or the insert below
+                hit_values = [
+                    torch.index_select(values, 0, slots[hit]) for values in self.values
+                ]
+
+        # every distinct missing frame is featurized once
+        missing = torch.nonzero(~hit).view(-1)
+        missing_keys, inverse = torch.unique(keys[missing], dim=0, return_inverse=True)
+        first = torch.empty(len(missing_keys), dtype=torch.long)
+        first[inverse] = missing
+        computed = featurize_frames(frames[first])
+
+        with self.lock:
+            self.misses += len(missing)
+            if self.values is None:
+                self._allocate(keys.size(1), computed)
+            self._insert(missing_keys, hashes[first], computed)
+
+        if len(missing) == len(frames):
+            return [computed_values[inverse] for computed_values in computed]
+
+        outputs = []
+        for values, computed_values in zip(hit_values, computed):
+            output = torch.empty(
+                (len(frames), *computed_values.shape[1:]), dtype=computed_values.dtype
+            )
+            output[hit] = values
+            output[missing] = computed_values[inverse]
+            outputs.append(output)
+        return outputs
+
+    def _lookup(self, keys: torch.Tensor, hashes: torch.Tensor) -> torch.Tensor:
+        # slot of every key, -1 if not cached
+        slots = torch.full((len(keys),), -1, dtype=torch.long)
+        if len(self.sorted_hashes) == 0:
+            return slots
+        pos = torch.searchsorted(self.sorted_hashes, hashes).clamp_(
+            max=len(self.sorted_hashes) - 1
+        )
+        candidates = torch.index_select(self.sorted_slots, 0, pos)
+        found = (torch.index_select(self.sorted_hashes, 0, pos) == hashes) & (
+            torch.index_select(self.keys, 0, candidates) == keys
+        ).all(dim=1)
+        slots[found] = candidates[found]
+        return slots
+
+    def _allocate(self, state_size: int, computed: List[torch.Tensor]):
+        frame_bytes = 4 * state_size + sum(
+            values[0].element_size() * values[0].nelement() for values in computed
+        )
+        self.n_slots = max(1, self.max_bytes // frame_bytes)
+        self.keys = torch.empty((self.n_slots, state_size))
+        self.values = [
+            torch.empty((self.n_slots, *values.shape[1:]), dtype=values.dtype)
+            for values in computed
+        ]
+        self.last_used = torch.zeros(self.n_slots, dtype=torch.long)
+        self.filled = torch.zeros(self.n_slots, dtype=torch.bool)
+        self.slot_hashes = torch.zeros(self.n_slots, dtype=torch.long)
+
+    def _insert(
+        self, keys: torch.Tensor, hashes: torch.Tensor, computed: List[torch.Tensor]
+    ):
+        # empty slots first, then the least recently used ones (never those of this batch)
+        n = min(len(keys), self.n_slots)
+        keys, hashes = keys[:n], hashes[:n]
+        priority = torch.where(self.filled, self.last_used, -1)
+        slots = torch.topk(priority, n, largest=False).indices
+        self.evictions += int(self.filled[slots].sum())
+
+        self.keys[slots] = keys
+        for values, computed_values in zip(self.values, computed):
+            values[slots] = computed_values[:n]
+        self.tick += 1
+        self.last_used[slots] = self.tick
+        self.filled[slots] = True
+        self.slot_hashes[slots] = hashes
+
+        filled_slots = torch.nonzero(self.filled).view(-1)
+        self.sorted_hashes, order = torch.sort(self.slot_hashes[filled_slots])
+        self.sorted_slots = filled_slots[order]
+
+    def stats(self) -> dict:
+        """Hit / miss / eviction counts (per frame), cached frames and number of slots."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "entries": len(self.sorted_slots),
+                "slots": self.n_slots,
+            }
+
+
+# odd 64 bit multipliers of the row hash, one per state value
+_HASH_MULTIPLIERS = {}
+
+
+def _hash_rows(rows: torch.Tensor) -> torch.Tensor:
+    """64 bit hash (wrapping int64 arithmetic) of the float32 bits of every row."""
+    size = rows.size(1)
+    if size not in _HASH_MULTIPLIERS:
+        generator = torch.Generator().manual_seed(size)
+        _HASH_MULTIPLIERS[size] = (
+            torch.randint(-(2**62), 2**62, (size,), generator=generator) * 2 + 1
+        )
+    # every value is mixed before the sum, so that permuted rows hash differently
+    mixed = rows.view(torch.int32).long() * _HASH_MULTIPLIERS[size]
+    return (mixed ^ (mixed >> 29)).sum(dim=1)
@@ -1,6 +1,7 @@
 from typing import List, Tuple
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 from src.environment import FourRoomEnv, StateFields
 from abc import ABC, abstractmethod
@@ -16,6 +17,23 @@ Q4_mask[5:, :5] = 1.0
 
 ROOM_MASKS = [Q1_mask, Q2_mask, Q3_mask, Q4_mask]
 
+# lookup tables, the rooms partition the map: (room, x, y) masks and the room id of each cell
+ROOM_MASKS_TENSOR = torch.tensor(np.stack(ROOM_MASKS), dtype=torch.float32)
+assert torch.all(ROOM_MASKS_TENSOR.sum(dim=0) == 1), "Rooms must partition the map"
+ROOM_IDS = ROOM_MASKS_TENSOR.argmax(dim=0)
+
+
+def _batch_positions(env: FourRoomEnv, states: torch.Tensor):
+    """Agent positions (N, n_agents, 2) and alive mask (N, n_agents) of flat states."""
+    positions = env.flat_state_field(states, StateFields.AGENT_POSITIONS).long()
+    alive = env.flat_state_field(states, StateFields.ALIVE_AGENTS) > 0
+    return positions, alive
+
+
+def _crew_l1(positions: torch.Tensor) -> torch.Tensor:
+    """L1 distance (N, n_agents - 1) from the imposter (agent 0) to every other agent."""
+    return (positions[:, 1:] - positions[:, :1]).abs().sum(dim=2)
+
 
 class ComponentFeaturizer(ABC):
     """Extracts features from the environment state."""
@@ -28,6 +46,16 @@ class ComponentFeaturizer(ABC):
         """Extracts features from the environment state."""
         raise NotImplementedError("Need to implement extract_features method.")
 
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        """
+        Extracts features from a batch of flat states (N, flattened_state_size), stacked
+        along the first dimension. Featurizers override this with tensor ops, the default
+        unflattens and featurizes state by state.
+        """
+        return torch.stack(
+            [self.extract_features(self.env.unflatten_state(s)) for s in states]
+        )
+
     @property
     def shape(self) -> Tuple:
         """Returns the shape of the features."""
@@ -99,6 +127,24 @@ class AgentPositionsFeaturizer(PositionFeaturizer):
 
         return features
 
+    def extract_features_batch(self, states: torch.Tensor, alive_only: bool = True):
+        positions = self.env.flat_state_field(states, StateFields.AGENT_POSITIONS).long()
+        alive = self.env.flat_state_field(states, StateFields.ALIVE_AGENTS)
+        N, n_agents, _ = positions.shape
+        features = torch.zeros(
+            (N, n_agents, self.env.n_cols, self.env.n_rows), dtype=torch.float32
+        )
+
+        if alive_only:
+            # one cell per (state, agent) channel, dead agents write a 0
+            batch_idx = torch.arange(N).unsqueeze(1).expand(N, n_agents)
+            agent_idx = torch.arange(n_agents).expand(N, n_agents)
+            features[batch_idx, agent_idx, positions[..., 0], positions[..., 1]] = (
+                alive > 0
+            ).float()
+
+        return features
+
     @property
     def shape(self):
         return torch.tensor(
@@ -126,11 +172,88 @@ class JobFeaturizer(BaseSpatialFeaturizer):
 
         return features
 
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        job_positions = self.env.flat_state_field(
+            states, StateFields.JOB_POSITIONS
+        ).long()
+        job_statuses = self.env.flat_state_field(states, StateFields.JOB_STATUS).long()
+        N, n_jobs, _ = job_positions.shape
+        features = torch.zeros(
+            (N, 2, self.env.n_cols, self.env.n_rows), dtype=torch.float32
+        )
+
+        batch_idx = torch.arange(N).unsqueeze(1).expand(N, n_jobs)
+        features[
+            batch_idx, job_statuses, job_positions[..., 0], job_positions[..., 1]
+        ] = 1
+
+        return features
+
     @property
     def shape(self):
         return torch.tensor([2, self.env.n_cols, self.env.n_rows], dtype=torch.int)
 
 
+class AgentCellIndexFeaturizer(ComponentFeaturizer):
+    """
+    n_agents values: sparse alternative to AgentPositionsFeaturizer.
+    Flat cell index (x * n_rows + y) of every alive agent, `2 * n_cells` (padding) for dead agents.
+    """
+
+    def extract_features(self, agent_state: Tuple) -> torch.Tensor:
+        positions = agent_state[self.env.state_fields[StateFields.AGENT_POSITIONS]]
+        alive = agent_state[self.env.state_fields[StateFields.ALIVE_AGENTS]]
+        n_cells = self.env.n_cols * self.env.n_rows
+
+        features = torch.full((self.env.n_agents,), 2.0 * n_cells)
+        for i, (x, y) in enumerate(positions):
+            if alive[i]:
+                features[i] = x * self.env.n_rows + y
+
+        return features
+
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        positions, alive = _batch_positions(self.env, states)
+        n_cells = self.env.n_cols * self.env.n_rows
+        cells = positions[..., 0] * self.env.n_rows + positions[..., 1]
+        return torch.where(alive, cells, 2 * n_cells).float()
+
+    @property
+    def shape(self):
+        return torch.tensor([self.env.n_agents], dtype=torch.int)
+
+
+class JobCellIndexFeaturizer(ComponentFeaturizer):
+    """
+    n_jobs values: sparse alternative to JobFeaturizer.
+    Flat cell index (x * n_rows + y) of every job, offset by n_cells for done jobs.
+    """
+
+    def extract_features(self, agent_state: Tuple) -> torch.Tensor:
+        job_positions = agent_state[self.env.state_fields[StateFields.JOB_POSITIONS]]
+        job_statuses = agent_state[self.env.state_fields[StateFields.JOB_STATUS]]
+        n_cells = self.env.n_cols * self.env.n_rows
+
+        features = torch.zeros(self.env.n_jobs)
+        for i, ((x, y), job_done) in enumerate(zip(job_positions, job_statuses)):
+            features[i] = x * self.env.n_rows + y + n_cells * int(job_done)
+
+        return features
+
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        job_positions = self.env.flat_state_field(
+            states, StateFields.JOB_POSITIONS
+        ).long()
+        job_statuses = self.env.flat_state_field(states, StateFields.JOB_STATUS).long()
+        n_cells = self.env.n_cols * self.env.n_rows
+        cells = job_positions[..., 0] * self.env.n_rows + job_positions[..., 1]
+        return (cells + n_cells * job_statuses).float()
+
+    @property
+    def shape(self):
+        return torch.tensor([self.env.n_jobs], dtype=torch.int)
+
+
 class CompositeFeaturizer(ComponentFeaturizer):
     """
     Combines featurizers into a single tensor.
@@ -143,11 +266,22 @@ class CompositeFeaturizer(ComponentFeaturizer):
         ), "All featurizers must have the same shape (ignoring the number of first dimension)."
         self.featurizers = featurizers
 
+        # first dimension slice of every featurizer in the concatenated features
+        self.offsets = np.cumsum([0] + [int(f.shape[0]) for f in featurizers]).tolist()
+
     def extract_features(self, agent_state: Tuple):
         return torch.cat(
             [f.extract_features(agent_state) for f in self.featurizers], axis=0
         )
 
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        shape = [self.offsets[-1], *self.featurizers[0].shape[1:].tolist()]
+        features = torch.empty((len(states), *shape), dtype=torch.float32)
+        for f, start, end in zip(self.featurizers, self.offsets, self.offsets[1:]):
+            features[:, start:end] = f.extract_features_batch(states)
+
+        return features
+
     @property
     def shape(self):
         assert len(self.featurizers) > 0, "No featurizers provided."
@@ -161,40 +295,60 @@ class CompositeFeaturizer(ComponentFeaturizer):
 
 class PartiallyObservableFeaturizer(CompositeFeaturizer):
     """
-    Zeros everything that is not visible to the agent.
+    Zeros everything that is not visible to the agent, i.e. outside of its room.
+
+    Features are computed for every agent at once: (n_agents, C, n_cols, n_rows) per
+    state, where agent i only sees its own room. With `add_obs_mask_feature` the
+    visibility mask is appended as a last channel.
     """
 
     def __init__(
         self, featurizers: List[BaseSpatialFeaturizer], add_obs_mask_feature=True
     ):
         super().__init__(featurizers=featurizers)
+        self.env = featurizers[0].env
         self.add_obs_mask_feature = add_obs_mask_feature
 
     def extract_features(self, agent_state: Tuple):
         features = super().extract_features(agent_state=agent_state)
 
-        # agent position
-        x, y = agent_state.agent_position
-        # determine observability mask
-        obs_mask = self.get_blank_features(num_channels=1)
-        for room_mask in ROOM_MASKS:
-            if room_mask[x, y] > 0:
-                obs_mask += room_mask
-
-        obs_mask = np.minimum(obs_mask, 1)  # 1 if cell is observable, 0 if not
+        # observability masks of the agents, the cells of their rooms
+        positions = agent_state[self.env.state_fields[StateFields.AGENT_POSITIONS]]
+        obs_mask = torch.stack(
+            [ROOM_MASKS_TENSOR[ROOM_IDS[x, y]] for x, y in positions]
+        ).unsqueeze(1)
 
         # zero out all that is not in the room
-        features = features * obs_mask
+        features = features.unsqueeze(0) * obs_mask
 
         # add channel to indicate what we can/cannot observe? the observation mask?
         if self.add_obs_mask_feature:
-            return np.concatenate([features, obs_mask], axis=0)
+            return torch.cat([features, obs_mask], axis=1)
+
+        return features
+
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        features = super().extract_features_batch(states)
+
+        # (N, n_agents, 1, n_cols, n_rows) visibility of every agent, from the room table
+        positions, _ = _batch_positions(self.env, states)
+        obs_mask = ROOM_MASKS_TENSOR[
+            ROOM_IDS[positions[..., 0], positions[..., 1]]
+        ].unsqueeze(2)
+
+        features = features.unsqueeze(1) * obs_mask
+
+        if self.add_obs_mask_feature:
+            return torch.cat([features, obs_mask], axis=2)
 
         return features
 
     @property
     def shape(self):
-        raise NotImplementedError("Need to implement shape property.")
+        """Shape of the features seen by one agent."""
+        shape = super().shape
+        shape[0] += int(self.add_obs_mask_feature)
+        return shape
 
 
 class StateFieldFeaturizer(ComponentFeaturizer):
@@ -213,6 +367,12 @@ class StateFieldFeaturizer(ComponentFeaturizer):
             dtype=torch.float32,
         )
 
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        # unflattening casts to the integer field dtypes, so truncate the same way
+        return (
+            self.env.flat_state_field(states, self.state_field).long().float()
+        )
+
     @property
     def shape(self):
         return self.env.compute_state_dims(self.state_field)
@@ -239,6 +399,20 @@ class OneHotAgentPositionFeaturizer(ComponentFeaturizer):
 
         return one_hot_positions.view(-1)
 
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        positions, alive = _batch_positions(self.env, states)
+        N, n_agents, _ = positions.shape
+        one_hot_positions = torch.zeros(N, n_agents, self.env.n_cols + self.env.n_rows)
+
+        batch_idx = torch.arange(N).unsqueeze(1).expand(N, n_agents)
+        agent_idx = torch.arange(n_agents).expand(N, n_agents)
+        x_idx = positions[..., 0]
+        y_idx = self.env.n_cols + positions[..., 1]
+        one_hot_positions[batch_idx, agent_idx, x_idx] = alive.float()
+        one_hot_positions[batch_idx, agent_idx, y_idx] = alive.float()
+
+        return one_hot_positions.view(N, -1)
+
     @property
     def shape(self) -> torch.tensor:
 
@@ -272,6 +446,24 @@ class DistanceToImposterFeaturizer(ComponentFeaturizer):
 
         return imposter_diastances.view(-1)
 
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        positions, alive = _batch_positions(self.env, states)
+        N, n_agents, _ = positions.shape
+
+        # NOTE: ONLY IF IMPOSTER IN 0th IDX
+        distances = (positions[:, :1] - positions[:, 1:]).float()
+        crew_alive = alive[:, 1:]
+
+        # distances of the alive crew are packed to the front, in agent order
+        imposter_diastances = torch.zeros(N, n_agents - 1, 2)
+        batch_idx, crew_idx = torch.nonzero(crew_alive, as_tuple=True)
+        slots = crew_alive.long().cumsum(dim=1) - 1
+        imposter_diastances[batch_idx, slots[batch_idx, crew_idx]] = distances[
+            batch_idx, crew_idx
+        ]
+
+        return imposter_diastances.view(N, -1)
+
     @property
     def shape(self) -> torch.tensor:
 
@@ -283,17 +475,23 @@ class WallsFeaturizer(ComponentFeaturizer):
     def __init__(self, env: FourRoomEnv):
         super().__init__(env)
 
+        # the map is fixed: flattened 3x3 window of the zero padded grid around every cell
+        grid = torch.zeros((self.env.n_cols+2, self.env.n_rows+2))
+        grid[1:-1,1:-1] = torch.tensor(self.env.grid)
+        self.neighborhoods = (
+            grid.unfold(0, 3, 1).unfold(1, 3, 1).reshape(env.n_cols, env.n_rows, 9)
+        )
+
     def extract_features(self, state: Tuple) -> torch.Tensor:
 
         agent_positions = state[self.env.state_fields[StateFields.AGENT_POSITIONS]]
         imposter_x, imposter_y = agent_positions[0]
 
-        grid = torch.zeros((self.env.n_cols+2, self.env.n_rows+2))
-        grid[1:-1,1:-1] = torch.tensor(self.env.grid)
-
-        surrounding = grid[imposter_x:imposter_x+3, imposter_y:imposter_y+3].clone().view(-1)
+        return self.neighborhoods[imposter_x, imposter_y].clone()
 
-        return surrounding
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        positions, _ = _batch_positions(self.env, states)
+        return self.neighborhoods[positions[:, 0, 0], positions[:, 0, 1]]
 
     @property
     def shape(self) -> torch.tensor:
@@ -317,9 +515,7 @@ class ImposterVSCrewRoomLocaionFeaturizer(ComponentFeaturizer):
             if not alive_agents[agent_idx]:
                 continue
             
-            rooms = torch.zeros(4)
-            for room_idx, room_mask in enumerate(ROOM_MASKS):
-                rooms[room_idx] = room_mask[pos[0], pos[1]]
+            rooms = F.one_hot(ROOM_IDS[pos[0], pos[1]], 4).float()
 
             if agent_idx == 0:
                 room_features[:4] += rooms
@@ -328,6 +524,15 @@ class ImposterVSCrewRoomLocaionFeaturizer(ComponentFeaturizer):
                 
         return room_features
 
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        positions, alive = _batch_positions(self.env, states)
+
+        # (N, n_agents, 4) rooms of every alive agent
+        rooms = F.one_hot(ROOM_IDS[positions[..., 0], positions[..., 1]], 4).float()
+        rooms = rooms * alive.unsqueeze(2)
+
+        return torch.cat([rooms[:, 0], rooms[:, 1:].sum(dim=1)], dim=1)
+
 
     @property
     def shape(self) -> torch.tensor:
@@ -374,10 +579,38 @@ class ImposterScentFeaturizer(ComponentFeaturizer):
 
         return imposter_scent.view(-1)
 
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        positions, alive = _batch_positions(self.env, states)
+
+        # NOTE: ONLY IF IMPOSTER IN 0th IDX
+        deltas = (positions[:, 1:] - positions[:, :1]).double()
+        crew_alive = alive[:, 1:]
+        # scents in float64 (as numpy computes them), summed agent by agent in float32
+        # like extract_features, so the results are identical
+        x_scent = (self.env.n_cols - deltas[..., 0]) / self.env.n_cols
+        y_scent = (self.env.n_rows - deltas[..., 1]) / self.env.n_rows
+        scent_columns = [
+            (scent.float(), crew_alive & positive, crew_alive & ~positive)
+            for scent, positive in ((x_scent, x_scent > 0), (y_scent, y_scent > 0))
+        ]
+
+        # left, right, top, bottom
+        imposter_scent = torch.zeros(len(states), 4)
+        for agent_idx in range(crew_alive.size(1)):
+            for column, (scent, positive, negative) in enumerate(scent_columns):
+                imposter_scent[:, 2 * column] += torch.where(
+                    positive[:, agent_idx], scent[:, agent_idx], 0
+                )
+                imposter_scent[:, 2 * column + 1] += torch.where(
+                    negative[:, agent_idx], scent[:, agent_idx], 0
+                )
+
+        return imposter_scent
+
     @property
     def shape(self) -> torch.tensor:
 
-        return torch.tensor(4, dtype=torch.int)
+        return torch.tensor([4], dtype=torch.int)
 
 
 
@@ -398,6 +631,10 @@ class CoordinateAgentPositionsFeaturizer(ComponentFeaturizer):
 
         return coordinates
 
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        positions, _ = _batch_positions(self.env, states)
+        return positions.view(len(states), -1).float()
+
     @property
     def shape(self) -> torch.tensor:
         return torch.tensor([self.env.n_agents * 2], dtype=torch.int)
@@ -420,6 +657,10 @@ class AliveCrewFeaturizer(ComponentFeaturizer):
 
         return alive_features
 
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        _, alive = _batch_positions(self.env, states)
+        return alive[:, 1:].float()
+
     @property
     def shape(self) -> torch.tensor:
         return torch.tensor([self.env.n_agents-1], dtype=torch.int)
@@ -447,6 +688,10 @@ class L1CrewFeaturizer(ComponentFeaturizer):
 
         return l1_crew
 
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        positions, alive = _batch_positions(self.env, states)
+        return torch.where(alive[:, 1:], _crew_l1(positions), -1).float()
+
     @property
     def shape(self) -> torch.tensor:
         return torch.tensor([self.env.n_crew], dtype=torch.int)
@@ -477,6 +722,13 @@ class ClosestAliveCrewFeaturizer(ComponentFeaturizer):
 
         return closest
 
+    def extract_features_batch(self, states: torch.Tensor) -> torch.Tensor:
+        positions, alive = _batch_positions(self.env, states)
+        l1_crew = torch.where(
+            alive[:, 1:], _crew_l1(positions), self.env.n_cols + self.env.n_rows
+        )
+        return F.one_hot(torch.argmin(l1_crew, dim=1), self.env.n_crew).float()
+
     @property
     def shape(self) -> torch.tensor:
         return torch.tensor([self.env.n_crew], dtype=torch.int)
@@ -1,8 +1,11 @@
+from collections import namedtuple
 from enum import StrEnum, auto
 from abc import ABC, abstractmethod
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import torch
+import torch.nn.functional as F
 
+from src.features.cache import FeatureCache
 from src.features.component import (
     AgentPositionsFeaturizer,
     CompositeFeaturizer,
@@ -13,6 +16,9 @@ from src.features.component import (
     CoordinateAgentPositionsFeaturizer,
     AliveCrewFeaturizer,
     WallsFeaturizer,
+    PartiallyObservableFeaturizer,
+    AgentCellIndexFeaturizer,
+    JobCellIndexFeaturizer,
 )
 from src.environment.base import FourRoomEnv, StateFields
 
@@ -27,14 +33,34 @@ class FeaturizerType(StrEnum):
         assert featurizer_type in [
             f.value for f in FeaturizerType
         ], f"Invalid featurizer type: {featurizer_type}"
+        partially_observable = kwargs.get("partially_observable", False)
+        sparse = kwargs.get("sparse", False)
+        cache = kwargs.get("cache", None)
         if featurizer_type == FeaturizerType.PERPSECTIVE:
-            return PerspectiveFeaturizer(env=env)
+            return PerspectiveFeaturizer(
+                env=env,
+                partially_observable=partially_observable,
+                sparse=sparse,
+                cache=cache,
+            )
         elif featurizer_type == FeaturizerType.GLOBAL:
-            return GlobalFeaturizer(env=env)
+            return GlobalFeaturizer(
+                env=env,
+                partially_observable=partially_observable,
+                sparse=sparse,
+                cache=cache,
+            )
         elif featurizer_type == FeaturizerType.FLAT:
             featurizers = kwargs.get("featurizers", None)
             assert featurizers is not None, "Need to provide a featurizer for FlatFeaturizer."
-            return FlatFeaturizer(env=env, featurizer=featurizers)
+            return FlatFeaturizer(env=env, featurizer=featurizers, cache=cache)
+
+
+PerspectiveFeatures = namedtuple(
+    "PerspectiveFeatures", ["spatial", "agent_non_spatial", "global_non_spatial"]
+)
+GlobalFeatures = namedtuple("GlobalFeatures", ["spatial", "non_spatial"])
+FlatFeatures = namedtuple("FlatFeatures", ["featurized_state"])
 
 
 class SequenceStateFeaturizer(ABC):
@@ -43,39 +69,207 @@ class SequenceStateFeaturizer(ABC):
 
     Exposes a method to generate featurized states from each agent's perspective.
 
+    `featurize` is pure: it returns the (B, T, ...) features of a state sequence (a
+    `features_type` namedtuple) and never modifies the featurizer, the generate methods
+    turn these into model inputs. One featurizer can therefore be used by several threads
+    at once (e.g. acting and learning). `fit` is kept for compatibility, it stores the
+    features of the last sequence, which the generate methods use when no features are given.
+
     Parameters:
         env (FourRoomEnv): The environment.
-        sequence_len (int): The length of the sequence.
+        partially_observable (bool): Spatial features only show each agent's own room, see PartiallyObservableFeaturizer.
+        sparse (bool): Spatial features are cell indices per agent / job (B, T, n_agents + n_jobs) instead of (B, T, C, H, W) position channels, see SparseSpatialDQN.
+        cache (FeatureCache): Optional cache of featurized frames, only shareable with featurizers of the same configuration.
     """
 
-    def __init__(self, env: FourRoomEnv):
+    # namedtuple of the (B, T, ...) tensors returned by `featurize`, see StreamingFeaturizer
+    features_type = None
+
+    def __init__(
+        self,
+        env: FourRoomEnv,
+        partially_observable: bool = False,
+        sparse: bool = False,
+        cache: Optional[FeatureCache] = None,
+    ):
+        assert not (
+            partially_observable and sparse
+        ), "Sparse spatial features can't be partially observable"
+
         self.env = env
         self.state_size = env.flattened_state_size
+        self.partially_observable = partially_observable
+        self.sparse = sparse
+        self.cache = cache
+
+        # features of the last `fit`, only used by the generate methods when no features are given
+        self.fitted = None
 
     @property
     def featurized_shape(self):
         raise NotImplementedError("Need to implement featurized_shape property.")
 
-    @abstractmethod
+    def featurize(self, state_sequence: torch.Tensor):
+        """
+        Featurizes the state sequence, without modifying the featurizer.
+
+        Parameters:
+            state_sequence (torch.Tensor): A sequence of states, shape (B, T, S).
+
+        Returns:
+            features_type: The (B, T, ...) featurized states, input of the generate methods.
+        """
+        assert (
+            state_sequence.dim() == 3
+        ), f"Expected 3D tensor. Got: {state_sequence.dim()}"
+
+        # all B * T frames are featurized at once, straight from the flat states
+        B, T, S = state_sequence.size()
+        frames = state_sequence.reshape(B * T, S)
+        if self.cache is None:
+            features = self._featurize_frames(frames)
+        else:
+            features = self.cache.featurize(frames, self._featurize_frames)
+
+        return self.features_type(
+            *[values.view(B, T, *values.shape[1:]) for values in features]
+        )
+
+    def featurize_transitions(self, states: torch.Tensor, next_states: torch.Tensor):
+        """
+        Featurizes the state and next state sequences of a batch of transitions.
+
+        When every next state sequence is its state sequence shifted by one frame (transition
+        replay with n_step=1), the B x (T + 1) frames are featurized once and both outputs are
+        views into the same features. Otherwise both sequences are featurized.
+
+        Parameters:
+            states (torch.Tensor): State sequences, shape (B, T, S).
+            next_states (torch.Tensor): Next state sequences, shape (B, T, S).
+
+        Returns:
+            Tuple[features_type, features_type]: Features of the states and of the next states.
+        """
+        if not torch.equal(states[:, 1:], next_states[:, :-1]):
+            return self.featurize(states), self.featurize(next_states)
+
+        features = self.featurize(torch.cat([states, next_states[:, -1:]], dim=1))
+        return (
+            self.features_type(*[f[:, :-1] for f in features]),
+            self.features_type(*[f[:, 1:] for f in features]),
+        )
+
     def fit(self, state_sequence: torch.Tensor) -> None:
         """
         Featurizes the state sequence and imposter locations. Stores the featurized states, this impacts state returned by generate_featurized_states.
 
+        Not thread safe, prefer `featurize`.
+
         Parameters:
             state_sequence (torch.Tensor): A sequence of states.
         """
-        raise NotImplementedError("Need to implement fit method.")
+        self.fitted = self.featurize(state_sequence)
+
+    def _features(self, features):
+        if features is not None:
+            return features
+        assert self.fitted is not None, "Pass features or call fit first"
+        return self.fitted
 
     @abstractmethod
-    def generate_featurized_states(self) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    def _featurize_frames(self, frames: torch.Tensor) -> List[torch.Tensor]:
+        """
+        Featurizes flat frames (N, S) into one (N, ...) tensor per field of `features_type`.
+        """
+        raise NotImplementedError("Need to implement _featurize_frames method.")
+
+    def _build_spatial_featurizer(self) -> CompositeFeaturizer:
+        """Agent and job spatial features, as position channels or sparse cell indices."""
+        if self.sparse:
+            return CompositeFeaturizer(
+                featurizers=[
+                    AgentCellIndexFeaturizer(env=self.env),
+                    JobCellIndexFeaturizer(env=self.env),
+                ]
+            )
+
+        spatial_featurizers = [
+            AgentPositionsFeaturizer(env=self.env),
+            JobFeaturizer(env=self.env),
+        ]
+        if self.partially_observable:
+            return PartiallyObservableFeaturizer(featurizers=spatial_featurizers)
+        return CompositeFeaturizer(featurizers=spatial_featurizers)
+
+    def _stacked_spatial(self, spatial: torch.Tensor) -> torch.Tensor:
+        """
+        (n_agents, B, T, C, ...) spatial features of all agents. Partially observable
+        features (B, T, n_agents, C, H, W) are already per agent, otherwise every agent
+        sees the same features (a view).
+        """
+        if self.partially_observable:
+            return spatial.permute(2, 0, 1, 3, 4, 5)
+        return spatial.expand(self.env.n_agents, *spatial.shape)
+
+    def _agent_spatial(self, spatial: torch.Tensor, agents: torch.Tensor) -> torch.Tensor:
+        """(B, T, C, ...) spatial features seen by the agent of each batch element."""
+        if self.partially_observable:
+            return spatial[torch.arange(len(agents)), :, agents]
+        return spatial
+
+    def generate_featurized_states(
+        self, features=None
+    ) -> List[Tuple[torch.Tensor, torch.Tensor]]:
         """
         Returns the featurized state from each agent's perspective.
 
+        The tensors are views into `generate_stacked_featurized_states`, they are not
+        cloned per agent.
+
+        Parameters:
+            features (features_type): Output of `featurize`, defaults to the fitted features.
+
         Returns:
             List[Tuple[torch.Tensor, torch.Tensor]]: List of spatial and non-spatial features.
         """
+        spatial, non_spatial = self.generate_stacked_featurized_states(features)
+        return list(zip(spatial.unbind(0), non_spatial.unbind(0)))
+
+    @abstractmethod
+    def generate_stacked_featurized_states(
+        self, features=None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the featurized states from all agents' perspectives at once, stacked along
+        a leading agent dimension, e.g. spatial (n_agents, B, T, C, H, W). No input
+        gradients are tracked.
+
+        Parameters:
+            features (features_type): Output of `featurize`, defaults to the fitted features.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: Spatial and non-spatial features.
+        """
         raise NotImplementedError(
-            "Need to implement generate_featurized_states method."
+            "Need to implement generate_stacked_featurized_states method."
+        )
+
+    @abstractmethod
+    def generate_agent_featurized_states(
+        self, agents: torch.Tensor, features=None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the featurized state of each batch element from the perspective of its own agent.
+
+        Parameters:
+            agents (torch.Tensor): Agent index per batch element, shape (B,).
+            features (features_type): Output of `featurize`, defaults to the fitted features.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: Spatial and non-spatial features.
+        """
+        raise NotImplementedError(
+            "Need to implement generate_agent_featurized_states method."
         )
 
 
@@ -90,12 +284,20 @@ class PerspectiveFeaturizer(SequenceStateFeaturizer):
     - Non-spatial are also ordered based on the agent in question.
     """
 
-    def __init__(self, env: FourRoomEnv):
-        super().__init__(env)
-
-        self.sp_f = CompositeFeaturizer(
-            featurizers=[AgentPositionsFeaturizer(env=env), JobFeaturizer(env=env)]
+    features_type = PerspectiveFeatures
+
+    def __init__(
+        self,
+        env: FourRoomEnv,
+        partially_observable: bool = False,
+        sparse: bool = False,
+        cache: Optional[FeatureCache] = None,
+    ):
+        super().__init__(
+            env, partially_observable=partially_observable, sparse=sparse, cache=cache
         )
+
+        self.sp_f = self._build_spatial_featurizer()
         self.agent_non_sp_f = CompositeFeaturizer(
             [
                 StateFieldFeaturizer(env=env, state_field=StateFields.ALIVE_AGENTS),
@@ -112,6 +314,24 @@ class PerspectiveFeaturizer(SequenceStateFeaturizer):
             ]
         )
 
+        # row i: agents ordered from agent i's perspective (i first, then the others in order)
+        agent_idxs = torch.arange(env.n_agents)
+        self.agent_orders = torch.stack(
+            [
+                torch.cat([agent_idxs[i : i + 1], agent_idxs[agent_idxs != i]])
+                for i in range(env.n_agents)
+            ]
+        )
+        # row i: spatial channel order from agent i's perspective, non agent channels stay in place
+        n_channels = int(self.sp_f.shape[0])
+        self.channel_orders = torch.cat(
+            [
+                self.agent_orders,
+                torch.arange(env.n_agents, n_channels).expand(env.n_agents, -1),
+            ],
+            dim=1,
+        )
+
     @property
     def featurized_shape(self):
         non_spatial_shape = torch.sum(
@@ -122,98 +342,65 @@ class PerspectiveFeaturizer(SequenceStateFeaturizer):
         )
         return self.sp_f.shape, non_spatial_shape
 
-    def fit(self, state_sequence: torch.Tensor) -> None:
-        assert (
-            state_sequence.dim() == 3
-        ), f"Expected 3D tensor. Got: {state_sequence.dim()}"
-
-        self.B, self.T, S = state_sequence.size()
-
-        for seq_idx in range(self.T):
-            batch_states = [
-                self.env.unflatten_state(s) for s in state_sequence[:, seq_idx, :]
-            ]
-            spatial, agent_non_spatial, global_non_spatial = self._featurize_state(
-                batch_states
-            )
-
-            if seq_idx == 0:
-                # Start with a list
-                spatial_list = [spatial]
-                agent_non_spatial_list = [agent_non_spatial]
-                global_non_spatial_list = [global_non_spatial]
-            else:
-                # Append new tensor to the list
-                spatial_list.append(spatial)
-                agent_non_spatial_list.append(agent_non_spatial)
-                global_non_spatial_list.append(global_non_spatial)
-
-            self.spatial = torch.stack(spatial_list)
-            self.agent_non_spatial = torch.stack(agent_non_spatial_list)
-            self.global_non_spatial = torch.stack(global_non_spatial_list)
-
-        self.spatial = self.spatial.transpose(0, 1)
-        self.agent_non_spatial = self.agent_non_spatial.transpose(0, 1)
-        self.global_non_spatial = self.global_non_spatial.transpose(0, 1)
-
-    def _featurize_state(
-        self, states: List[Tuple]
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        spatial_features = torch.stack(
-            [self.sp_f.extract_features(state) for state in states]
+    def _featurize_frames(self, frames: torch.Tensor) -> List[torch.Tensor]:
+        return [
+            self.sp_f.extract_features_batch(frames),
+            self.agent_non_sp_f.extract_features_batch(frames).view(
+                len(frames), -1, self.env.n_agents
+            ),
+            self.global_non_sp_f.extract_features_batch(frames),
+        ]
+
+    def generate_stacked_featurized_states(
+        self, features: Optional[PerspectiveFeatures] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        features = self._features(features)
+        spatial = self._stacked_spatial(features.spatial)
+        A, B, T, C, *cell_dims = spatial.size()
+
+        # a single gather over the permutation table of every agent
+        channel_orders = self.channel_orders.view(A, 1, 1, C, *[1] * len(cell_dims))
+        spatial = spatial.gather(3, channel_orders.expand(spatial.size()))
+
+        K = features.agent_non_spatial.size(2)
+        agent_orders = self.agent_orders.view(A, 1, 1, 1, A)
+        agent_non_spatial = (
+            features.agent_non_spatial.unsqueeze(0)
+            .expand(A, B, T, K, A)
+            .gather(4, agent_orders.expand(A, B, T, K, A))
         )
-        agent_non_spatial_features = torch.stack(
-            [self.agent_non_sp_f.extract_features(state) for state in states]
-        ).view(self.B, -1, self.env.n_agents)
 
-        global_non_spatial_features = torch.stack(
-            [self.global_non_sp_f.extract_features(state) for state in states]
+        non_spatial = torch.cat(
+            [
+                agent_non_spatial.view(A, B, T, -1),
+                features.global_non_spatial.expand(A, B, T, -1),
+            ],
+            dim=3,
         )
 
-        return spatial_features, agent_non_spatial_features, global_non_spatial_features
-
-    def generate_featurized_states(self) -> List[Tuple[torch.Tensor, torch.Tensor]]:
-        spatial_rep = self.spatial.detach().clone()
-        agent_non_spatial_rep = self.agent_non_spatial.detach().clone()
-        global_non_spatial_rep = self.global_non_spatial.detach().clone()
+        return spatial, non_spatial
 
-        featurized = []
+    def generate_agent_featurized_states(
+        self, agents: torch.Tensor, features: Optional[PerspectiveFeatures] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        features = self._features(features)
+        spatial = self._agent_spatial(features.spatial, agents)
+        B, T, C, *cell_dims = spatial.size()
 
-        C = spatial_rep.size(2)  # number of channels size (B, T, C, H, W)
+        channel_order = self.channel_orders[agents].view(B, 1, C, *[1] * len(cell_dims))
+        spatial = spatial.gather(2, channel_order.expand(spatial.size()))
 
-        agents = torch.arange(self.env.n_agents)
-
-        channel_order = torch.arange(C)
-
-        for agent_idx in range(self.env.n_agents):
-            channel_order[0] = agent_idx
-            agents[0] = agent_idx
-            if agent_idx > 0:
-                channel_order[agent_idx] = agent_idx - 1
-                agents[agent_idx] = agent_idx - 1
-
-            non_spatial = torch.cat(
-                [
-                    agent_non_spatial_rep[:, :, :, agents]
-                    .detach()
-                    .clone()
-                    .view(self.B, self.T, -1),
-                    global_non_spatial_rep,
-                ],
-                dim=2,
-            )
+        _, _, K, A = features.agent_non_spatial.size()
+        agent_order = self.agent_orders[agents].view(B, 1, 1, A)
+        agent_non_spatial = features.agent_non_spatial.gather(
+            3, agent_order.expand(B, T, K, A)
+        )
 
-            featurized.append(
-                (
-                    spatial_rep[:, :, channel_order, :, :]
-                    .detach()
-                    .clone()
-                    .requires_grad_(True),
-                    non_spatial.requires_grad_(True),
-                )
-            )
+        non_spatial = torch.cat(
+            [agent_non_spatial.reshape(B, T, -1), features.global_non_spatial], dim=2
+        )
 
-        return featurized
+        return spatial, non_spatial
 
 
 class GlobalFeaturizer(SequenceStateFeaturizer):
@@ -224,16 +411,21 @@ class GlobalFeaturizer(SequenceStateFeaturizer):
     GlobalFeaturizer does not shift ordering of channels based on the agent in question. Instead we just simply append one-hot encoding of the agent index to the non-spatial features.
     """
 
-    def __init__(self, env: FourRoomEnv):
-        super().__init__(env)
-
-        self.spatial_features = CompositeFeaturizer(
-            featurizers=[
-                AgentPositionsFeaturizer(env=env),
-                JobFeaturizer(env=env),
-            ]
+    features_type = GlobalFeatures
+
+    def __init__(
+        self,
+        env: FourRoomEnv,
+        partially_observable: bool = False,
+        sparse: bool = False,
+        cache: Optional[FeatureCache] = None,
+    ):
+        super().__init__(
+            env, partially_observable=partially_observable, sparse=sparse, cache=cache
         )
 
+        self.spatial_features = self._build_spatial_featurizer()
+
         self.non_spatial_features = CompositeFeaturizer(
             featurizers=[
                 StateFieldFeaturizer(env=env, state_field=StateFields.ALIVE_AGENTS),
@@ -252,67 +444,54 @@ class GlobalFeaturizer(SequenceStateFeaturizer):
         non_sp_shape[0] += self.env.n_agents
         return self.spatial_features.shape, non_sp_shape
 
-    def fit(self, state_sequence: torch.Tensor) -> None:
-        assert (
-            state_sequence.dim() == 3
-        ), f"Expected 3D tensor. Got: {state_sequence.dim()}"
-
-        self.B, self.T, S = state_sequence.size()
-
-        for seq_idx in range(self.T):
-            batch_states = [
-                self.env.unflatten_state(s) for s in state_sequence[:, seq_idx, :]
-            ]
-            spatial, non_spatial = self._featurize_state(batch_states)
-
-            if seq_idx == 0:
-                spatial_list = [spatial]  # Start with a list
-                non_spatial_list = [non_spatial]
-            else:
-                spatial_list.append(spatial)  # Append new tensor to the list
-                non_spatial_list.append(non_spatial)
+    def _featurize_frames(self, frames: torch.Tensor) -> List[torch.Tensor]:
+        return [
+            self.spatial_features.extract_features_batch(frames),
+            self.non_spatial_features.extract_features_batch(frames),
+        ]
+
+    def generate_stacked_featurized_states(
+        self, features: Optional[GlobalFeatures] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        features = self._features(features)
+        A = self.env.n_agents
+        B, T, _ = features.non_spatial.size()
+
+        agent_idx_tensor = torch.eye(A).view(A, 1, 1, A).expand(A, B, T, A)
+        non_spatial = torch.cat(
+            [features.non_spatial.expand(A, B, T, -1), agent_idx_tensor], dim=3
+        )
 
-            self.spatial = torch.stack(spatial_list)  # Convert list to tensor stack
-            self.non_spatial = torch.stack(non_spatial_list)
+        # fully observable spatial features are shared by all agents, the stack is a view
+        return self._stacked_spatial(features.spatial), non_spatial
 
-        self.non_spatial = self.non_spatial.transpose(0, 1)
-        self.spatial = self.spatial.transpose(0, 1)
+    def generate_agent_featurized_states(
+        self, agents: torch.Tensor, features: Optional[GlobalFeatures] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        features = self._features(features)
+        T = features.non_spatial.size(1)
+        agent_idx_tensor = F.one_hot(agents, self.env.n_agents).float()
+        agent_idx_tensor = agent_idx_tensor.unsqueeze(1).expand(-1, T, -1)
 
-    def _featurize_state(self, batch_state) -> Tuple[torch.Tensor, torch.Tensor]:
-        spatial_features = torch.stack(
-            [self.spatial_features.extract_features(state) for state in batch_state]
-        )
-        non_spatial_features = torch.stack(
-            [self.non_spatial_features.extract_features(state) for state in batch_state]
+        return self._agent_spatial(features.spatial, agents).contiguous(), torch.cat(
+            [features.non_spatial, agent_idx_tensor], dim=2
         )
 
-        return spatial_features, non_spatial_features
-
-    def generate_featurized_states(self) -> Tuple[torch.Tensor, torch.Tensor]:
-        featurized = []
-        for agent_idx in range(self.env.n_agents):
-            agent_idx_tensor = torch.zeros(self.B, self.T, self.env.n_agents)
-            agent_idx_tensor[:, :, agent_idx] = 1
-
-            featurized.append(
-                (
-                    self.spatial.detach().clone().requires_grad_(True),
-                    torch.cat(
-                        [self.non_spatial.detach().clone(), agent_idx_tensor], dim=2
-                    ).requires_grad_(True),
-                )
-            )
-
-        return featurized
-
 
 class FlatFeaturizer(SequenceStateFeaturizer):
     """
     Quite simple, just return the flattened state.
     """
 
-    def __init__(self, env: FourRoomEnv, featurizer: CompositeFeaturizer):
-        super().__init__(env)
+    features_type = FlatFeatures
+
+    def __init__(
+        self,
+        env: FourRoomEnv,
+        featurizer: CompositeFeaturizer,
+        cache: Optional[FeatureCache] = None,
+    ):
+        super().__init__(env, cache=cache)
         self.featurizer = featurizer
 
     @property
@@ -322,49 +501,91 @@ class FlatFeaturizer(SequenceStateFeaturizer):
             self.featurizer.shape
         )  # current returning zeros for spatial features (this is a hack, need to fix this)
 
-    def fit(self, state_sequence: torch.Tensor) -> None:
-        assert (
-            state_sequence.dim() == 3
-        ), f"Expected 3D tensor. Got: {state_sequence.dim()}"
+    def _featurize_frames(self, frames: torch.Tensor) -> List[torch.Tensor]:
+        return [self.featurizer.extract_features_batch(frames)]
+
+    def generate_stacked_featurized_states(
+        self, features: Optional[FlatFeatures] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        featurized_state = self._features(features).featurized_state
+        A = self.env.n_agents
+        B, T = featurized_state.shape[:2]
+        # flat features are the same for every agent, both stacks are views
+        spatial = torch.zeros(1).expand(A, B, T, 1)
+        return spatial, featurized_state.expand(A, *featurized_state.shape)
+
+    def generate_agent_featurized_states(
+        self, agents: torch.Tensor, features: Optional[FlatFeatures] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        featurized_state = self._features(features).featurized_state
+        B, T = featurized_state.shape[:2]
+        # flat features are the same for every agent
+        return torch.zeros(B, T, 1), featurized_state.contiguous()
 
-        self.B, self.T, _ = state_sequence.size()
+    def __repr__(self) -> str:
+        return f"FlatFeaturizer_{self.featurizer}"
 
-        for seq_idx in range(self.T):
-            batch_states = [
-                self.env.unflatten_state(s) for s in state_sequence[:, seq_idx, :]
-            ]
 
-            featurized_batch_timestep_states = []
-            for batch_idx, batch_state in enumerate(batch_states):
+class StreamingFeaturizer:
+    """
+    Sliding window featurization for acting, one episode at a time.
 
-                featurized_timestep_batch_state = self.featurizer.extract_features(batch_state)
+    Keeps a ring buffer with the featurized frames of the last `sequence_length` states.
+    `push` only featurizes the newest frame, and `current` returns the features of the
+    window, exactly as `featurize` on the whole (1, T, S) state sequence would. Acting cost
+    therefore does not grow with the sequence length.
 
-                featurized_batch_timestep_states.append(featurized_timestep_batch_state)
+    Parameters:
+        featurizer (SequenceStateFeaturizer): Featurizer of the frames, it is never modified and can be shared.
+        sequence_length (int): Number of frames in the window.
+    """
 
-            featurized_batch_timestep_states = torch.stack(
-                featurized_batch_timestep_states
-            )
+    def __init__(self, featurizer: SequenceStateFeaturizer, sequence_length: int):
+        assert sequence_length > 0, "Sequence length must be positive"
+        assert featurizer.features_type is not None, f"{featurizer} can't be streamed"
 
-            if seq_idx == 0:
-                feature_sequence_list = [featurized_batch_timestep_states]
-            else:
-                feature_sequence_list.append(featurized_batch_timestep_states)
-
-        self.featurized_state = torch.stack(feature_sequence_list)
-        self.featurized_state = self.featurized_state.transpose(0, 1)
-
-    def generate_featurized_states(self) -> Tuple[torch.Tensor, torch.Tensor]:
-        featurized = []
-        for agent_idx in range(self.env.n_agents):
-             
-            featurized.append(
-                (
-                    torch.zeros(self.B, self.T, 1).requires_grad_(True),
-                    self.featurized_state.detach().clone().requires_grad_(True),
-                )
-            )
+        self.featurizer = featurizer
+        self.sequence_length = sequence_length
+        self.rings = None
+        # ring slot of the oldest frame
+        self.start = 0
 
-        return featurized
-    
-    def __repr__(self) -> str:
-        return f"FlatFeaturizer_{self.featurizer}"
+    def _featurize_frame(self, frame) -> List[torch.Tensor]:
+        frame = torch.as_tensor(frame, dtype=torch.float32).view(1, 1, -1)
+        return [feature[0, 0] for feature in self.featurizer.featurize(frame)]
+
+    def reset(self, frame) -> None:
+        """
+        Starts a new episode, the window is filled with its first state.
+
+        Parameters:
+            frame (np.ndarray): Flat first state of the episode.
+        """
+        self.rings = [
+            feature.unsqueeze(0).repeat(self.sequence_length, *[1] * feature.dim())
+            for feature in self._featurize_frame(frame)
+        ]
+        self.start = 0
+
+    def push(self, frame) -> None:
+        """
+        Appends the newest state to the window, dropping the oldest one.
+
+        Parameters:
+            frame (np.ndarray): Flat state.
+        """
+        assert self.rings is not None, "Call reset at the start of the episode first"
+        for ring, feature in zip(self.rings, self._featurize_frame(frame)):
+            ring[self.start] = feature
+        self.start = (self.start + 1) % self.sequence_length
+
+    def current(self):
+        """
+        Returns the features of the current window (batch of one), see `featurize`.
+        """
+        assert self.rings is not None, "Call reset at the start of the episode first"
+        order = (self.start + torch.arange(self.sequence_length)) % self.sequence_length
+
+        return self.featurizer.features_type(
+            *[ring[order].unsqueeze(0) for ring in self.rings]
+        )
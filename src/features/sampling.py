@@ -0,0 +1,29 @@
+import numpy as np
+import torch
+
+from src.environment.base import FourRoomEnv
+
+
+def random_states(env: FourRoomEnv, n_states: int, seed: int = 0) -> torch.Tensor:
+    """
+    Random valid flat states (n_states, S), visited by random policy rollouts.
+
+    Rollouts cover the whole game (kills, completed / sabotaged jobs, game ends), unlike
+    states drawn independently per field which could put agents inside walls.
+
+    Parameters:
+        env (FourRoomEnv): The environment.
+        n_states (int): Number of states.
+        seed (int): Seed of the rollouts.
+    """
+    np.random.seed(seed)
+
+    states = np.zeros((n_states, env.flattened_state_size), dtype=np.float32)
+    state, _ = env.reset()
+    for i in range(n_states):
+        states[i] = env.flatten_state(state)
+        state, _, done, truncated, _ = env.step(env.sample_actions())
+        if done or truncated:
+            state, _ = env.reset()
+
+    return torch.from_numpy(states)
@@ -0,0 +1,348 @@
+import copy
+import queue
+import time
+from typing import List, Optional, Tuple
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from src.models.dqn import Q_Estimator, forward_shared_trunk
+
+# role index of a request input, as in select_actions
+IMPOSTER, CREW = 0, 1
+
+# seconds between checks of the server while a client waits for its answer
+_POLL_INTERVAL = 1.0
+
+
+class InferenceServer:
+    """
+    Process serving the imposter and crew models to many actor processes.
+
+    Actors send the model inputs of their alive agents (both teams in one request)
+    through a shared request queue. The server collects requests until every actor is
+    waiting, it has `max_batch_size` rows or the first request waited `max_latency`
+    seconds. It then runs one forward per role over all of them (a single one for models
+    sharing a trunk, see MultiRoleSpatialDQN) and answers every actor on its own queue.
+    New weights published by the learner are loaded between micro-batches. A request
+    that fails is answered with its exception and the server keeps serving; clients raise
+    if the server stopped or didn't answer within `response_timeout`.
+
+    Usage: create the server before the actor processes, hand `client(i)` to actor i,
+    which acts with `select_actions(..., *client.remote_models(), ...)`. Training with
+    actor processes (`run_experiment(n_actors=...)`) serves the learner's models this way,
+    see ActorPool, and publishes their weights after every update.
+
+    Parameters:
+        imposter_model (Q_Estimator): Model of the imposters.
+        crew_model (Q_Estimator): Model of the crew.
+        n_clients (int): Number of actors, each one gets its own response queue.
+        max_batch_size (int): Rows (agents) per role after which a micro-batch runs.
+        max_latency (float): Max seconds a request waits for the micro-batch to fill.
+        n_threads (int): Torch threads of the server process.
+        response_timeout (float): Max seconds a client waits for an answer, None to wait forever.
+        start_method (str): Multiprocessing start method of the server process.
+    """
+
+    def __init__(
+        self,
+        imposter_model: Q_Estimator,
+        crew_model: Q_Estimator,
+        n_clients: int,
+        max_batch_size: int = 256,
+        max_latency: float = 0.002,
+        n_threads: int = 1,
+        response_timeout: Optional[float] = 60.0,
+        start_method: str = "spawn",
+    ):
+        assert n_clients > 0, "Need at least one client"
+        assert max_batch_size > 0, "Batch size must be positive"
+
+        context = mp.get_context(start_method)
+        self.request_queue = context.Queue()
+        self.response_queues = [context.Queue() for _ in range(n_clients)]
+        self.weights_queue = context.Queue()
+        # set by the server when it exits, clients can't check the process itself
+        self.stopped = context.Event()
+        self.response_timeout = response_timeout
+
+        # the server gets its own copy of the models: sending them to the process would move
+        # their weights to shared memory, and training would then change the served weights
+        # in place (mid-update) instead of through `publish_weights`. Both models are
+        # copied together, so modules they share stay shared in the copy
+        served_models = copy.deepcopy((imposter_model, crew_model))
+        self.process = context.Process(
+            target=_serve,
+            args=(
+                served_models,
+                self.request_queue,
+                self.response_queues,
+                self.weights_queue,
+                self.stopped,
+                max_batch_size,
+                max_latency,
+                n_threads,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+
+    def client(self, client_idx: int) -> "InferenceClient":
+        """Client of actor `client_idx`, can be passed to the actor process."""
+        return InferenceClient(
+            client_idx,
+            self.request_queue,
+            self.response_queues[client_idx],
+            self.stopped,
+            self.response_timeout,
+        )
+
+    def publish_weights(self, imposter_model: Q_Estimator, crew_model: Q_Estimator):
+        """
+        Sends the current weights of the learner's models, the server switches to them
+        before the first micro-batch after they arrive (requests already in flight may still
+        be answered with the previous weights). Weights are copied, training can continue
+        right away.
+        """
+        self.weights_queue.put(
+            tuple(
+                {name: x.detach().clone() for name, x in model.state_dict().items()}
+                for model in (imposter_model, crew_model)
+            )
+        )
+
+    def close(self):
+        self.request_queue.put(None)
+        self.process.join()
+
+
+class InferenceClient:
+    """Actor side of an InferenceServer, see `InferenceServer.client`."""
+
+    def __init__(
+        self,
+        client_idx: int,
+        request_queue,
+        response_queue,
+        server_stopped,
+        timeout: Optional[float] = None,
+    ):
+        self.client_idx = client_idx
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+        self.server_stopped = server_stopped
+        self.timeout = timeout
+        # id of the last request, answers to earlier (timed out) requests are dropped
+        self.request_id = 0
+
+    def q_values(
+        self, role_inputs: List[Optional[Tuple[torch.Tensor, torch.Tensor]]]
+    ) -> List[Optional[torch.Tensor]]:
+        """
+        Q-values of the imposter and crew model on their (spatial, non-spatial) inputs, None
+        for a role without inputs. Blocks until the server answers, raises RuntimeError if
+        it stopped and TimeoutError if it didn't answer in time.
+        """
+        self.request_id += 1
+        # small arrays are pickled, sharing tensor storages costs more per request
+        self.request_queue.put(
+            (
+                self.client_idx,
+                self.request_id,
+                [
+                    None if inputs is None else tuple(x.numpy() for x in inputs)
+                    for inputs in role_inputs
+                ],
+            )
+        )
+        response = self._wait_response()
+        if isinstance(response, Exception):
+            raise response
+        return [None if q is None else torch.from_numpy(q) for q in response]
+
+    def _wait_response(self):
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        while True:
+            try:
+                request_id, response = self.response_queue.get(timeout=_POLL_INTERVAL)
+                if request_id == self.request_id:
+                    return response
+                continue
+            except queue.Empty:
+                pass
+            if self.server_stopped.is_set():
+                raise RuntimeError("Inference server stopped")
+            if deadline is not None and time.perf_counter() > deadline:
+                raise TimeoutError(
+                    f"Inference server didn't answer in {self.timeout} seconds"
+                )
+
+    def remote_models(self) -> Tuple["RemoteModel", "RemoteModel"]:
+        """Imposter and crew models served through this client."""
+        return RemoteModel(self, IMPOSTER), RemoteModel(self, CREW)
+
+
+class RemoteModel(Q_Estimator):
+    """
+    Model of one role evaluated by an InferenceServer. `select_actions` sends the inputs
+    of both teams in one request, see `forward_teams`.
+    """
+
+    def __init__(self, client: InferenceClient, role: int):
+        super(RemoteModel, self).__init__()
+        self.client = client
+        self.role = role
+
+    @property
+    def model_type(self):
+        return "remote"
+
+    def forward(self, spatial_x, non_spatial_x):
+        role_inputs = [None, None]
+        role_inputs[self.role] = (spatial_x, non_spatial_x)
+        return self.client.q_values(role_inputs)[self.role]
+
+    def create_copy(self):
+        raise NotImplementedError("Remote models can't be trained")
+
+    def forward_teams(self, models, inputs) -> List[torch.Tensor]:
+        """Q-values of models served to the same client with one request to their server."""
+        if not all(
+            isinstance(model, RemoteModel) and model.client is self.client
+            for model in models
+        ):
+            return super(RemoteModel, self).forward_teams(models, inputs)
+        role_inputs = [None, None]
+        for model, model_inputs in zip(models, inputs):
+            role_inputs[model.role] = model_inputs
+        q_values = self.client.q_values(role_inputs)
+        return [q_values[model.role] for model in models]
+
+
+def _serve(
+    models,
+    request_queue,
+    response_queues,
+    weights_queue,
+    stopped,
+    max_batch_size: int,
+    max_latency: float,
+    n_threads: int,
+):
+    try:
+        _serve_loop(
+            models,
+            request_queue,
+            response_queues,
+            weights_queue,
+            max_batch_size,
+            max_latency,
+            n_threads,
+        )
+    finally:
+        stopped.set()
+
+
+def _serve_loop(
+    models,
+    request_queue,
+    response_queues,
+    weights_queue,
+    max_batch_size: int,
+    max_latency: float,
+    n_threads: int,
+):
+    torch.set_num_threads(n_threads)
+    for model in models:
+        model.eval()
+
+    stop = False
+    while not stop:
+        request = request_queue.get()
+        if request is None:
+            break
+
+        # micro-batch: collect requests until full or the first one waited long enough,
+        # clients wait for their answer, so there is at most one request per client (and
+        # the ones they stopped waiting for)
+        requests = [request]
+        deadline = time.perf_counter() + max_latency
+        while (
+            len(requests) < len(response_queues)
+            and _n_rows(requests) < max_batch_size
+        ):
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = request_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                stop = True
+                break
+            requests.append(request)
+
+        # only the latest published weights matter
+        weights = None
+        while True:
+            try:
+                weights = weights_queue.get_nowait()
+            except queue.Empty:
+                break
+        if weights is not None:
+            for model, state_dict in zip(models, weights):
+                model.load_state_dict(state_dict)
+
+        # a bad request fails its micro-batch only, the other clients keep being served
+        try:
+            responses = _run_batch(models, requests)
+        except Exception as e:
+            for client_idx, request_id, _ in requests:
+                response_queues[client_idx].put((request_id, e))
+            continue
+
+        for (client_idx, request_id, _), response in zip(requests, responses):
+            response_queues[client_idx].put((request_id, response))
+
+
+def _n_rows(requests) -> int:
+    return max(
+        sum(
+            len(role_inputs[role][0])
+            for _, _, role_inputs in requests
+            if role_inputs[role]
+        )
+        for role in (IMPOSTER, CREW)
+    )
+
+
+def _run_batch(models, requests) -> List[List[Optional[np.ndarray]]]:
+    # (spatial, non-spatial) of all requests per role, and where each request's rows are
+    roles, inputs, slices = [], [], []
+    for role in (IMPOSTER, CREW):
+        role_requests = [role_inputs[role] for _, _, role_inputs in requests]
+        sizes = [0 if x is None else len(x[0]) for x in role_requests]
+        if sum(sizes) == 0:
+            continue
+        roles.append(role)
+        inputs.append(
+            tuple(
+                torch.from_numpy(
+                    np.concatenate([x[i] for x in role_requests if x is not None])
+                )
+                for i in range(2)
+            )
+        )
+        slices.append(np.cumsum([0] + sizes))
+
+    with torch.no_grad():
+        q_values = forward_shared_trunk([models[role] for role in roles], inputs)
+
+    responses = [[None, None] for _ in requests]
+    for role, role_q_values, offsets in zip(roles, q_values, slices):
+        role_q_values = role_q_values.numpy()
+        for request_idx, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+            if end > start:
+                responses[request_idx][role] = role_q_values[start:end]
+    return responses
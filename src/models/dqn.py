@@ -1,4 +1,6 @@
-from typing import List
+import copy
+from collections import namedtuple
+from typing import List, Optional, Tuple
 import torch
 from torch import nn
 from enum import StrEnum, auto
@@ -6,16 +8,35 @@ from enum import StrEnum, auto
 from src.utils import calculate_cnn_output_dim
 
 
+# streaming inference state of a SpatialDQN, one row per stream (e.g. agent), see SpatialDQN.init_state
+StreamState = namedtuple("StreamState", ["encodings", "hidden", "n_frames"])
+
+
 class ModelType(StrEnum):
     RANDOM = auto()
     SPATIAL_DQN = auto()
     MLP = auto()
+    SPARSE_SPATIAL_DQN = auto()
+    MULTI_ROLE_SPATIAL_DQN = auto()
 
     @staticmethod
     def build(model_type: str, **kwargs):
         assert model_type in [
             m.value for m in ModelType
         ], f"Invalid model type: {model_type}"
+        if kwargs.pop("quantized", False):
+            # int8 CPU inference copy, see src.models.quantize
+            from src.models.quantize import build_quantized
+
+            return build_quantized(model_type, **kwargs)
+        exported_model_path = kwargs.pop("exported_model_path", None)
+        if exported_model_path is not None:
+            # frozen TorchScript model for acting / evaluation, see src.models.export
+            from src.models.export import load_exported_model
+
+            model = load_exported_model(exported_model_path)
+            assert model.model_type == model_type, f"Exported model is a {model.model_type}"
+            return model
         if model_type == ModelType.RANDOM:
             assert (
                 kwargs.get("pretrained_model_path", None) is None
@@ -32,6 +53,20 @@ class ModelType(StrEnum):
                 return MLP.load_from_checkpoint(kwargs["pretrained_model_path"])
             kwargs.pop("pretrained_model_path", None)
             return MLP(**kwargs)
+        elif model_type == ModelType.SPARSE_SPATIAL_DQN:
+            if kwargs.get("pretrained_model_path", None) is not None:
+                return SparseSpatialDQN.load_from_checkpoint(
+                    kwargs["pretrained_model_path"]
+                )
+            kwargs.pop("pretrained_model_path", None)
+            return SparseSpatialDQN(**kwargs)
+        elif model_type == ModelType.MULTI_ROLE_SPATIAL_DQN:
+            if kwargs.get("pretrained_model_path", None) is not None:
+                return MultiRoleSpatialDQN.load_from_checkpoint(
+                    kwargs["pretrained_model_path"]
+                )
+            kwargs.pop("pretrained_model_path", None)
+            return MultiRoleSpatialDQN(**kwargs)
 
 
 class ActivationType(StrEnum):
@@ -68,8 +103,16 @@ class Q_Estimator(nn.Module):
     def create_copy(self):
         raise NotImplementedError("create_copy method not implemented")
 
+    def forward_teams(self, models, inputs) -> List[torch.Tensor]:
+        """
+        Q-values of the team `models` (this one first) on their (spatial, non-spatial)
+        inputs, used by `select_actions` to run all teams together. Models that can batch
+        teams in a single call override it.
+        """
+        return forward_shared_trunk(models, inputs)
 
-class MLP(nn.Module):
+
+class MLP(Q_Estimator):
     def __init__(
         self,
         layer_dims,
@@ -94,11 +137,9 @@ class MLP(nn.Module):
         torch.save(checkpoint, filepath)
         print(f"Model checkpoint saved to {filepath}")
     
-    def load_from_checkpoint(filepath):
-        checkpoint = torch.load(filepath)
-        config = checkpoint["config"]
-        model = MLP(**config)
-        model.load_state_dict(checkpoint["state_dict"])
+    def load_from_checkpoint(filepath, map_location="cpu", mmap=True):
+        checkpoint = torch.load(filepath, map_location=map_location, mmap=mmap)
+        model = build_from_checkpoint(MLP, checkpoint)
         print("Model loaded from checkpoint")
         return model
 
@@ -112,6 +153,8 @@ class RandomEquiprobable(Q_Estimator):
     def __init__(self, n_outputs: int):
         super(RandomEquiprobable, self).__init__()
         self.n_outputs = n_outputs
+        # arguments of ModelType.build, e.g. when loaded from a training checkpoint
+        self.config = {"n_actions": n_outputs}
 
     def forward(self, *inputs):
         batch_size = 1  # default batch size if no inputs are provided
@@ -280,36 +323,125 @@ class SpatialDQN(Q_Estimator):
     def model_type(self):
         return ModelType.SPATIAL_DQN
 
-    def forward(self, spatial_x, non_spatial_x):
+    @property
+    def hidden_shape(self):
+        """Shape of the RNN hidden state of a single sample, (layers, hidden_dim)."""
+        return (self.config["rnn_layers"], self.config["rnn_hidden_dim"])
 
+    def _encode(self, spatial_x, non_spatial_x):
         # running through CNN
         batch_size, timesteps, C, H, W = spatial_x.size()
-        cnn_in = spatial_x.view(batch_size * timesteps, C, H, W)
+        cnn_in = spatial_x.reshape(batch_size * timesteps, C, H, W)
         cnn_out = self.cnn(cnn_in)
         # Reshape the output for the RNN
-
-
-        cnn_out = cnn_out.view(batch_size, timesteps, -1)
+        cnn_out = cnn_out.reshape(batch_size, timesteps, -1)
         # appending non-spatial features
-        rnn_in = torch.cat((cnn_out, non_spatial_x), dim=2)
+        return torch.cat((cnn_out, non_spatial_x), dim=2)
 
-        rnn_out, _ = self.rnn(rnn_in)
+    def forward(self, spatial_x, non_spatial_x):
+        rnn_out, _ = self.rnn(self._encode(spatial_x, non_spatial_x))
         # Use the last hidden state to predict with MLP
         mlp_in = rnn_out[:, -1, :]
         out = self.prediction_head(mlp_in)
 
         return out
 
+    def forward_sequence(self, spatial_x, non_spatial_x, hidden=None):
+        """
+        Q-values for every timestep, starting the RNN from `hidden` (zeros if None).
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: Q-values (B, T, n_actions) and the final hidden state (B, layers, hidden_dim).
+        """
+        if hidden is not None:
+            hidden = hidden.transpose(0, 1).contiguous()  # nn.RNN expects (layers, B, hidden_dim)
+
+        rnn_out, hidden = self.rnn.model(self._encode(spatial_x, non_spatial_x), hidden)
+
+        return self.prediction_head(rnn_out), hidden.transpose(0, 1)
+
+    def init_state(
+        self, batch_size: int = 1, sequence_length: Optional[int] = None
+    ) -> StreamState:
+        """
+        Empty streaming inference state of `batch_size` independent streams, see `step`.
+
+        With a `sequence_length`, `step` keeps the encodings (CNN output and non-spatial
+        features) of the last `sequence_length` frames and returns exactly the output of
+        `forward` on that window, which starts from a zero hidden state. Only the newest
+        frame goes through the CNN, the RNN is rerun over the cached encodings.
+        Without a `sequence_length` the RNN hidden state is carried over instead, as in
+        `forward_sequence`, and a step costs one CNN frame and one RNN step.
+
+        Parameters:
+            batch_size (int): Number of streams.
+            sequence_length (int): Window of `forward`, None to carry the hidden state.
+        """
+        if sequence_length is None:
+            encodings, hidden = None, torch.zeros(batch_size, *self.hidden_shape)
+        else:
+            encodings, hidden = torch.zeros(batch_size, sequence_length, self.rnn_in_dim), None
+        return StreamState(
+            encodings=encodings,
+            hidden=hidden,
+            n_frames=torch.zeros(batch_size, dtype=torch.long),
+        )
+
+    def step(
+        self, spatial_x, non_spatial_x, state: StreamState
+    ) -> Tuple[torch.Tensor, StreamState]:
+        """
+        Q-values of the newest frame of every stream.
+
+        The first frame of a stream (or after `reset_state`) fills the whole window, as
+        StreamingFeaturizer repeats the first state of an episode.
+
+        Parameters:
+            spatial_x (torch.Tensor): Spatial features of the newest frame, (B, C, ...).
+            non_spatial_x (torch.Tensor): Non-spatial features of the newest frame, (B, F).
+            state (StreamState): State of the B streams, it is not modified.
+
+        Returns:
+            Tuple[torch.Tensor, StreamState]: Q-values (B, n_actions) and the next state.
+        """
+        encoding = self._encode(spatial_x.unsqueeze(1), non_spatial_x.unsqueeze(1))
+        n_frames = state.n_frames + 1
+
+        if state.encodings is None:
+            hidden = state.hidden.transpose(0, 1).contiguous()
+            rnn_out, hidden = self.rnn.model(encoding, hidden)
+            q_values = self.prediction_head(rnn_out[:, -1])
+            return q_values, StreamState(None, hidden.transpose(0, 1), n_frames)
+
+        first = (state.n_frames == 0).view(-1, 1, 1)
+        encodings = torch.where(first, encoding, state.encodings)
+        encodings = torch.cat([encodings[:, 1:], encoding], dim=1)
+
+        rnn_out, _ = self.rnn(encodings)
+        q_values = self.prediction_head(rnn_out[:, -1])
+        return q_values, StreamState(encodings, None, n_frames)
+
+    @staticmethod
+    def reset_state(state: StreamState, mask: torch.Tensor) -> StreamState:
+        """
+        Restarts the streams flagged in `mask` (B,), e.g. at the end of their episode.
+        """
+        keep = ~mask
+        return StreamState(
+            *[
+                None if x is None else x * keep.view(-1, *[1] * (x.dim() - 1))
+                for x in state
+            ]
+        )
+
     def dump_to_checkpoint(model, filepath):
         checkpoint = {"state_dict": model.state_dict(), "config": model.config}
         torch.save(checkpoint, filepath)
         print(f"Model checkpoint saved to {filepath}")
 
-    def load_from_checkpoint(filepath):
-        checkpoint = torch.load(filepath)
-        config = checkpoint["config"]
-        model = SpatialDQN(**config)
-        model.load_state_dict(checkpoint["state_dict"])
+    def load_from_checkpoint(filepath, map_location="cpu", mmap=True):
+        checkpoint = torch.load(filepath, map_location=map_location, mmap=mmap)
+        model = build_from_checkpoint(SpatialDQN, checkpoint)
         print("Model loaded from checkpoint")
         return model
 
@@ -318,6 +450,226 @@ class SpatialDQN(Q_Estimator):
         new_model.load_state_dict(self.state_dict())
         return new_model
 
+    def with_prediction_head(self, n_actions: int) -> "SpatialDQN":
+        """
+        Model with a new prediction head of `n_actions` on the same CNN / RNN trunk: the
+        trunk modules are shared, not copied, see MultiRoleSpatialDQN.
+        """
+        model = copy.copy(self)
+        # own module registry, so that the new head does not replace this model's head
+        model._modules = dict(self._modules)
+        model.config = {**self.config, "n_actions": n_actions}
+        model.n_actions = n_actions
+        model.mlp_dims = self.mlp_dims[:-1] + [n_actions]
+        model.prediction_head = make_mlp(
+            layer_dims=model.mlp_dims, activation_fn=ActivationType.PRELU
+        )
+        return model
+
+
+class SparseSpatialDQN(SpatialDQN):
+    """
+    SpatialDQN on sparse spatial input: one cell index per entity (agents, then jobs), as
+    produced by the featurizers' `sparse` option. Each index is embedded instead of being
+    convolved as a one-hot (H, W) channel, so input memory and compute scale with the
+    number of entities rather than n_agents * H * W.
+    """
+
+    def __init__(
+        self,
+        # Feature size args
+        n_cells: int,
+        n_entities: int,
+        non_spatial_input_size: int,
+        # Embedding arguments
+        embedding_dim: int,
+        # RNN arguments
+        rnn_layers: int,
+        rnn_hidden_dim: int,
+        rnn_dropout: float,
+        # MLP arguments
+        mlp_hidden_layer_dims: List[int],
+        n_actions: int,
+    ):
+        # skips the CNN of SpatialDQN
+        super(SpatialDQN, self).__init__()
+
+        self.config = {
+            "n_cells": n_cells,
+            "n_entities": n_entities,
+            "non_spatial_input_size": non_spatial_input_size,
+            "embedding_dim": embedding_dim,
+            "rnn_layers": rnn_layers,
+            "rnn_hidden_dim": rnn_hidden_dim,
+            "rnn_dropout": rnn_dropout,
+            "mlp_hidden_layer_dims": mlp_hidden_layer_dims,
+            "n_actions": n_actions,
+        }
+
+        # cells of agents / incomplete jobs, cells of done jobs, padding (dead agents)
+        self.embedding = nn.Embedding(
+            num_embeddings=2 * n_cells + 1,
+            embedding_dim=embedding_dim,
+            padding_idx=2 * n_cells,
+        )
+
+        # entities keep their slot in the RNN input, like channels of the dense input
+        self.rnn_in_dim = n_entities * embedding_dim + non_spatial_input_size
+
+        # Making RNN
+        self.rnn = RNNModel(
+            input_dim=self.rnn_in_dim,
+            n_layers=rnn_layers,
+            hidden_dim=rnn_hidden_dim,
+            dropout=rnn_dropout,
+        )
+
+        # MLP Prediction head
+        self.n_actions = n_actions
+        self.mlp_dims = [rnn_hidden_dim] + mlp_hidden_layer_dims + [n_actions]
+        self.prediction_head = make_mlp(
+            layer_dims=self.mlp_dims, activation_fn=ActivationType.PRELU
+        )
+
+    @property
+    def model_type(self):
+        return ModelType.SPARSE_SPATIAL_DQN
+
+    def _encode(self, spatial_x, non_spatial_x):
+        # (B, T, n_entities) cell indices -> (B, T, n_entities * embedding_dim)
+        batch_size, timesteps, _ = spatial_x.size()
+        embedded = self.embedding(spatial_x.long()).view(batch_size, timesteps, -1)
+        # appending non-spatial features
+        return torch.cat((embedded, non_spatial_x), dim=2)
+
+    def load_from_checkpoint(filepath, map_location="cpu", mmap=True):
+        checkpoint = torch.load(filepath, map_location=map_location, mmap=mmap)
+        model = build_from_checkpoint(SparseSpatialDQN, checkpoint)
+        print("Model loaded from checkpoint")
+        return model
+
+    def create_copy(self):
+        new_model = SparseSpatialDQN(**self.config)
+        new_model.load_state_dict(self.state_dict())
+        return new_model
+
+
+class MultiRoleSpatialDQN(Q_Estimator):
+    """
+    SpatialDQN trunk (CNN + RNN) shared by the imposter and crew, with one prediction head
+    per role.
+
+    `role_models` returns the imposter and crew models: regular SpatialDQNs sharing the
+    trunk modules, so they can be used (and checkpointed) wherever a team model is expected.
+    Batches of both roles go through a single trunk forward with `forward_shared_trunk`.
+    Takes the SpatialDQN arguments, with the action count of each role instead of n_actions.
+    """
+
+    def __init__(self, n_imposter_actions: int, n_crew_actions: int, **spatial_dqn_args):
+        super(MultiRoleSpatialDQN, self).__init__()
+
+        self.config = {
+            **spatial_dqn_args,
+            "n_imposter_actions": n_imposter_actions,
+            "n_crew_actions": n_crew_actions,
+        }
+
+        self.imposter = SpatialDQN(**spatial_dqn_args, n_actions=n_imposter_actions)
+        self.crew = self.imposter.with_prediction_head(n_crew_actions)
+
+    @property
+    def model_type(self):
+        return ModelType.MULTI_ROLE_SPATIAL_DQN
+
+    def role_models(self) -> Tuple[SpatialDQN, SpatialDQN]:
+        """Imposter and crew models, sharing this model's trunk."""
+        return self.imposter, self.crew
+
+    def forward(self, *role_inputs):
+        """
+        Q-values of the imposter and crew on their (spatial, non-spatial) inputs, with one
+        trunk forward.
+        """
+        return forward_shared_trunk(self.role_models(), role_inputs)
+
+    def dump_to_checkpoint(model, filepath):
+        checkpoint = {"state_dict": model.state_dict(), "config": model.config}
+        torch.save(checkpoint, filepath)
+        print(f"Model checkpoint saved to {filepath}")
+
+    def load_from_checkpoint(filepath, map_location="cpu", mmap=True):
+        checkpoint = torch.load(filepath, map_location=map_location, mmap=mmap)
+        model = build_from_checkpoint(MultiRoleSpatialDQN, checkpoint)
+        print("Model loaded from checkpoint")
+        return model
+
+    def create_copy(self):
+        new_model = MultiRoleSpatialDQN(**self.config)
+        new_model.load_state_dict(self.state_dict())
+        return new_model
+
+
+def build_from_checkpoint(build_model, checkpoint: dict) -> nn.Module:
+    """
+    Model built by `build_model(**config)` with the weights of a checkpoint.
+
+    The model is built on the meta device and takes over the checkpoint tensors instead
+    of copying them: with a checkpoint loaded by `torch.load(..., mmap=True)` the weights
+    stay memory mapped, and are only read from disk when used.
+
+    Parameters:
+        build_model (Callable): Model class, or function building the model from its config.
+        checkpoint (dict): Model "config" and "state_dict", see `dump_to_checkpoint`.
+    """
+    with torch.device("meta"):
+        model = build_model(**checkpoint["config"])
+    model.load_state_dict(checkpoint["state_dict"], assign=True)
+    return model
+
+
+def shares_trunk(*models) -> bool:
+    """Whether all models are SpatialDQNs on the same trunk modules."""
+    return all(isinstance(m, SpatialDQN) for m in models) and all(
+        m.rnn is models[0].rnn for m in models
+    )
+
+
+def forward_shared_trunk(models, inputs) -> List[torch.Tensor]:
+    """
+    Q-values of every model on its (spatial, non-spatial) inputs. Models sharing a trunk
+    (see MultiRoleSpatialDQN) run it once over the concatenated inputs, only the prediction
+    heads run per model.
+    """
+    if not shares_trunk(*models):
+        return [model(*model_inputs) for model, model_inputs in zip(models, inputs)]
+
+    spatial = torch.cat([model_inputs[0] for model_inputs in inputs])
+    non_spatial = torch.cat([model_inputs[1] for model_inputs in inputs])
+    trunk = models[0]
+    rnn_out, _ = trunk.rnn(trunk._encode(spatial, non_spatial))
+
+    last_outputs = rnn_out[:, -1].split([len(model_inputs[0]) for model_inputs in inputs])
+    return [
+        model.prediction_head(last_output)
+        for model, last_output in zip(models, last_outputs)
+    ]
+
+
+def copy_models(models) -> List[Q_Estimator]:
+    """Copies of the models (e.g. target networks), models sharing a trunk still share it."""
+    copies = []
+    for model in models:
+        trunk_copy = next(
+            (c for m, c in zip(models, copies) if shares_trunk(m, model)), None
+        )
+        if trunk_copy is None:
+            copies.append(model.create_copy())
+        else:
+            model_copy = trunk_copy.with_prediction_head(model.n_actions)
+            model_copy.prediction_head.load_state_dict(model.prediction_head.state_dict())
+            copies.append(model_copy)
+    return copies
+
 
 def make_mlp(layer_dims, activation_fn: ActivationType = ActivationType.RELU):
     layers = []
@@ -0,0 +1,154 @@
+import json
+import pathlib
+from typing import List, Tuple
+import torch
+from torch import nn
+
+from src.features.model_ready import SequenceStateFeaturizer
+from src.features.sampling import random_states
+from src.models.dqn import Q_Estimator
+
+
+class ExportedModel(Q_Estimator):
+    """
+    Frozen TorchScript model written by `export_model`, for acting and evaluation only.
+
+    Runs without the Python dispatch of the eager modules. Inputs must have the exported
+    (T, ...) feature shapes, the batch size is free.
+
+    Parameters:
+        module (torch.jit.ScriptModule): The exported model.
+        metadata (dict): Model type, config and input shapes of the exported model.
+    """
+
+    def __init__(self, module: torch.jit.ScriptModule, metadata: dict):
+        super(ExportedModel, self).__init__()
+        self.module = module
+        self.metadata = metadata
+        self.config = metadata["config"]
+        self.spatial_shape = tuple(metadata["spatial_shape"])
+        self.non_spatial_shape = tuple(metadata["non_spatial_shape"])
+
+    @property
+    def model_type(self):
+        return self.metadata["model_type"]
+
+    def forward(self, spatial_x, non_spatial_x):
+        assert (
+            spatial_x.shape[1:] == self.spatial_shape
+            and non_spatial_x.shape[1:] == self.non_spatial_shape
+        ), f"Exported for inputs {self.spatial_shape}, {self.non_spatial_shape}"
+        return self.module(spatial_x, non_spatial_x)
+
+    def create_copy(self):
+        raise NotImplementedError("Exported models can't be trained, export a copy instead")
+
+
+def example_inputs(
+    featurizer: SequenceStateFeaturizer,
+    sequence_length: int,
+    n_sequences: int = 8,
+    seed: int = 0,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Model inputs of every agent's perspective on random valid state sequences, i.e.
+    (n_sequences * n_agents, T, ...) spatial and non-spatial features.
+    """
+    states = random_states(featurizer.env, n_sequences * sequence_length, seed=seed)
+    features = featurizer.featurize(states.view(n_sequences, sequence_length, -1))
+    spatial, non_spatial = featurizer.generate_stacked_featurized_states(features)
+    return (
+        spatial.flatten(0, 1).contiguous().float(),
+        non_spatial.flatten(0, 1).contiguous().float(),
+    )
+
+
+def check_parity(
+    model: nn.Module,
+    exported: nn.Module,
+    inputs: Tuple[torch.Tensor, torch.Tensor],
+    batch_sizes: List[int] = [1, 8],
+    atol: float = 1e-5,
+) -> dict:
+    """
+    Compares the outputs of the exported and eager model on `inputs`, split in batches.
+
+    Returns:
+        dict: Max absolute difference per batch size, and whether all are within `atol`.
+    """
+    spatial, non_spatial = inputs
+    max_diffs = {}
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            max_diffs[batch_size] = max(
+                (
+                    exported(spatial[i : i + batch_size], non_spatial[i : i + batch_size])
+                    - model(spatial[i : i + batch_size], non_spatial[i : i + batch_size])
+                )
+                .abs()
+                .max()
+                .item()
+                for i in range(0, len(spatial), batch_size)
+            )
+    return {
+        "max_abs_diff": max_diffs,
+        "matches": all(diff <= atol for diff in max_diffs.values()),
+    }
+
+
+def export_model(
+    model: Q_Estimator,
+    featurizer: SequenceStateFeaturizer,
+    sequence_length: int,
+    filepath: pathlib.Path,
+    atol: float = 1e-5,
+) -> dict:
+    """
+    Traces the model on inputs shaped like the featurizer output (`featurized_shape` over
+    `sequence_length` frames), freezes it and saves it as TorchScript with its metadata.
+    The export is only written if its outputs match the eager model.
+
+    Parameters:
+        model (Q_Estimator): SpatialDQN, SparseSpatialDQN or MLP.
+        featurizer (SequenceStateFeaturizer): Featurizer the model was trained with.
+        sequence_length (int): Number of frames of the model input.
+        filepath (pathlib.Path): Destination of the exported model.
+        atol (float): Max absolute difference with the eager outputs.
+
+    Returns:
+        dict: The parity report, see `check_parity`.
+    """
+    inputs = example_inputs(featurizer, sequence_length)
+
+    # traced in eval mode, the model goes back to the mode it was in (e.g. still training)
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            traced = torch.jit.trace(model, (inputs[0][:1], inputs[1][:1]))
+        exported = torch.jit.freeze(traced)
+        parity = check_parity(model, exported, inputs, atol=atol)
+    finally:
+        model.train(was_training)
+    assert parity["matches"], f"Exported model differs from the eager model: {parity}"
+
+    metadata = {
+        "model_type": model.model_type,
+        "config": model.config,
+        "spatial_shape": list(inputs[0].shape[1:]),
+        "non_spatial_shape": list(inputs[1].shape[1:]),
+        "parity": parity,
+    }
+    torch.jit.save(
+        exported, filepath, _extra_files={"metadata.json": json.dumps(metadata)}
+    )
+    print(f"Exported model saved to {filepath}")
+    return parity
+
+
+def load_exported_model(filepath: pathlib.Path) -> ExportedModel:
+    """Loads a model written by `export_model`."""
+    extra_files = {"metadata.json": ""}
+    module = torch.jit.load(filepath, _extra_files=extra_files)
+    print("Exported model loaded")
+    return ExportedModel(module, json.loads(extra_files["metadata.json"]))
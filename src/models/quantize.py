@@ -0,0 +1,190 @@
+import copy
+import logging
+from typing import Optional, Tuple
+import torch
+from torch import nn
+from torch.ao import quantization
+from torch.ao.nn.quantized import dynamic as nnqd
+
+from src.features.model_ready import SequenceStateFeaturizer
+from src.models.dqn import ModelType, SpatialDQN
+
+logger = logging.getLogger(__name__)
+
+
+class DynamicQuantizedRNN(nn.Module):
+    """
+    Inference replacement of a batch first nn.RNN, which dynamic quantization does not cover.
+
+    The input projections (the largest RNN weights, rnn_in_dim x hidden_dim for the first
+    layer) run as dynamic int8 Linear layers over the whole sequence at once, the
+    recurrence stays fp32. Same inputs and outputs as nn.RNN.
+    """
+
+    def __init__(self, rnn: nn.RNN):
+        super(DynamicQuantizedRNN, self).__init__()
+        assert rnn.batch_first and not rnn.bidirectional, "Only batch first, unidirectional RNNs"
+
+        self.num_layers = rnn.num_layers
+        self.activation = torch.tanh if rnn.nonlinearity == "tanh" else torch.relu
+
+        self.input_projections = nn.ModuleList()
+        self.hidden_weights = nn.ParameterList()
+        for layer in range(rnn.num_layers):
+            weight_ih = getattr(rnn, f"weight_ih_l{layer}")
+            projection = nn.Linear(weight_ih.size(1), weight_ih.size(0))
+            projection.weight = nn.Parameter(weight_ih.detach().clone())
+            projection.bias = nn.Parameter(
+                (getattr(rnn, f"bias_ih_l{layer}") + getattr(rnn, f"bias_hh_l{layer}"))
+                .detach()
+                .clone()
+            )
+            projection.qconfig = quantization.default_dynamic_qconfig
+            self.input_projections.append(nnqd.Linear.from_float(projection))
+            self.hidden_weights.append(
+                nn.Parameter(getattr(rnn, f"weight_hh_l{layer}").detach().clone())
+            )
+
+    def forward(self, x, hx: Optional[torch.Tensor] = None):
+        batch_size, timesteps, _ = x.size()
+        if hx is None:
+            hx = x.new_zeros(self.num_layers, batch_size, self.hidden_weights[0].size(0))
+
+        last_hidden = []
+        for layer in range(self.num_layers):
+            projected = self.input_projections[layer](x)
+            h = hx[layer]
+            outputs = []
+            for t in range(timesteps):
+                h = self.activation(projected[:, t] + h @ self.hidden_weights[layer].t())
+                outputs.append(h)
+            x = torch.stack(outputs, dim=1)
+            last_hidden.append(h)
+
+        return x, torch.stack(last_hidden)
+
+
+def quantize_model(
+    model: nn.Module,
+    quantize_convs: bool = False,
+    calibration_inputs: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    backend: str = "x86",
+) -> nn.Module:
+    """
+    Int8 CPU inference copy of a SpatialDQN, SparseSpatialDQN or MLP.
+
+    Linear layers and the RNN input projections are dynamically quantized (int8 weights,
+    activations quantized on the fly). With `quantize_convs`, the CNN of a SpatialDQN is
+    statically quantized as well, its activation ranges are calibrated on `calibration_inputs`.
+    Embeddings stay fp32. The copy keeps the model class, so acting code (`forward`,
+    `forward_sequence`, `step`) is unchanged, but it can't be trained.
+
+    Parameters:
+        model (nn.Module): The fp32 model, not modified.
+        quantize_convs (bool): Statically quantize the convolutions.
+        calibration_inputs (Tuple[torch.Tensor, torch.Tensor]): Spatial and non-spatial model inputs, see `src.models.export.example_inputs`.
+        backend (str): Quantized engine the convolutions are converted for. The process-wide
+            engine is only switched to it during the conversion, then restored.
+    """
+    quantized = copy.deepcopy(model).eval()
+
+    if quantize_convs and hasattr(quantized, "cnn"):
+        assert calibration_inputs is not None, "Static quantization needs calibration inputs"
+        assert (
+            backend in torch.backends.quantized.supported_engines
+        ), f"Unsupported quantized engine: {backend}"
+        previous_engine = torch.backends.quantized.engine
+        torch.backends.quantized.engine = backend
+        try:
+            # conv + relu pairs run as single quantized ops between (de)quantization stubs
+            layers = quantized.cnn.model
+            quantization.fuse_modules(
+                layers, [[str(i), str(i + 1)] for i in range(0, len(layers), 2)], inplace=True
+            )
+            cnn = nn.Sequential(
+                quantization.QuantStub(), *layers, quantization.DeQuantStub()
+            )
+            cnn.qconfig = quantization.get_default_qconfig(backend)
+            quantized.cnn.model = quantization.prepare(cnn)
+
+            with torch.no_grad():
+                quantized(*calibration_inputs)
+            quantization.convert(quantized.cnn.model, inplace=True)
+        finally:
+            torch.backends.quantized.engine = previous_engine
+
+    if isinstance(quantized, SpatialDQN):
+        quantized.rnn.model = DynamicQuantizedRNN(quantized.rnn.model)
+
+    return quantization.quantize_dynamic(quantized, {nn.Linear}, dtype=torch.qint8)
+
+
+def greedy_agreement(
+    model: nn.Module,
+    quantized: nn.Module,
+    inputs: Tuple[torch.Tensor, torch.Tensor],
+) -> dict:
+    """
+    Accuracy of the quantized model against the fp32 model on `inputs`.
+
+    Returns:
+        dict: Share of inputs with the same greedy action, and max / mean absolute Q-value difference.
+    """
+    with torch.no_grad():
+        q_values = model(*inputs)
+        quantized_q_values = quantized(*inputs)
+
+    diff = (quantized_q_values - q_values).abs()
+    return {
+        "greedy_agreement": (
+            (quantized_q_values.argmax(dim=1) == q_values.argmax(dim=1)).float().mean().item()
+        ),
+        "max_abs_q_diff": diff.max().item(),
+        "mean_abs_q_diff": diff.mean().item(),
+        "n_inputs": len(q_values),
+    }
+
+
+def build_quantized(
+    model_type: ModelType,
+    quantize_convs: bool = False,
+    featurizer: Optional[SequenceStateFeaturizer] = None,
+    sequence_length: Optional[int] = None,
+    min_greedy_agreement: Optional[float] = None,
+    **kwargs,
+) -> nn.Module:
+    """
+    Quantized model built by `ModelType.build(..., quantized=True)`, usually from a checkpoint.
+
+    With a `featurizer` (and `sequence_length`), inputs of random valid states calibrate the
+    convolutions, and the accuracy against the fp32 model (see `greedy_agreement`) is
+    measured on inputs of other random states. It is logged and kept as the
+    `quantization_report` attribute of the model (None without a featurizer).
+
+    Parameters:
+        min_greedy_agreement (float): Fail the build if the share of inputs with the same
+            greedy action is lower, needs a featurizer.
+    """
+    from src.models.export import example_inputs
+
+    model = ModelType.build(model_type, **kwargs)
+    calibration_inputs = None
+    if featurizer is not None:
+        assert sequence_length is not None, "Need the sequence length of the model inputs"
+        calibration_inputs = example_inputs(featurizer, sequence_length, n_sequences=64)
+
+    quantized = quantize_model(
+        model, quantize_convs=quantize_convs, calibration_inputs=calibration_inputs
+    )
+    quantized.quantization_report = None
+    if featurizer is not None:
+        inputs = example_inputs(featurizer, sequence_length, n_sequences=64, seed=1)
+        quantized.quantization_report = greedy_agreement(model, quantized, inputs)
+        logger.info(f"Quantized {model_type}: {quantized.quantization_report}")
+
+    if min_greedy_agreement is not None:
+        assert featurizer is not None, "Checking the greedy agreement needs a featurizer"
+        assert (
+            quantized.quantization_report["greedy_agreement"] >= min_greedy_agreement
+        ), f"Quantized model disagrees with the fp32 model: {quantized.quantization_report}"
+    return quantized
@@ -0,0 +1,137 @@
+from typing import List, Optional, Tuple
+import numpy as np
+import torch
+
+from src.environment import FourRoomEnv
+from src.features.model_ready import SequenceStateFeaturizer
+from src.models.dqn import Q_Estimator, SpatialDQN, StreamState
+
+
+def select_actions(
+    env: FourRoomEnv,
+    featurizer: SequenceStateFeaturizer,
+    features,
+    imposter_model: Q_Estimator,
+    crew_model: Q_Estimator,
+    alive_agents: np.ndarray,
+    eps: float = 0.0,
+    hidden: Optional[torch.Tensor] = None,
+    model_states: Optional[List[Optional[StreamState]]] = None,
+) -> Tuple[np.ndarray, Optional[torch.Tensor], Optional[List[Optional[StreamState]]]]:
+    """
+    Epsilon-greedy actions of all agents, with one forward pass per team model, or a single
+    one for team models that batch teams together (see `Q_Estimator.forward_teams`).
+
+    Only alive agents are featurized: their perspectives are stacked into one batch per
+    team, and exploration is drawn for the whole team at once. Dead agents get action 0.
+    Should be called under torch.no_grad().
+
+    Parameters:
+        env (FourRoomEnv): The environment.
+        featurizer (SequenceStateFeaturizer): Featurizer of `features`.
+        features: Features of the current state sequence (batch of one), see `featurize`.
+        imposter_model (Q_Estimator): Model of the imposters.
+        crew_model (Q_Estimator): Model of the crew.
+        alive_agents (np.ndarray): Alive flag per agent.
+        eps (float): Probability of a random action, per agent.
+        hidden (torch.Tensor): RNN hidden state per agent (n_agents, layers, hidden_dim), for recurrent models.
+        model_states (List[StreamState]): Streaming inference state of the imposter and crew
+            model (one row per agent, see SpatialDQN.init_state), None for a team whose model
+            runs on the whole window. Only the newest frame of `features` is used for them.
+
+    Returns:
+        Tuple: Action per agent, the next hidden states (None without `hidden`) and the
+            next model states (None without `model_states`).
+    """
+    agent_actions = np.zeros(env.n_agents, dtype=np.int32)
+    next_hidden = None if hidden is None else hidden.clone()
+    next_model_states = None if model_states is None else list(model_states)
+
+    alive = np.asarray(alive_agents, dtype=bool)
+    imposter_mask = np.asarray(env.imposter_mask, dtype=bool)
+
+    # teams acting on the whole window, run together by forward_teams
+    window_teams = []
+
+    for team_idx, (team_mask, team_model, n_actions) in enumerate(
+        [
+            (imposter_mask, imposter_model, env.n_imposter_actions),
+            (~imposter_mask, crew_model, env.n_crew_actions),
+        ]
+    ):
+        agents = np.flatnonzero(team_mask & alive)
+        if len(agents) == 0:
+            continue
+        agent_idxs = torch.from_numpy(agents)
+        team_state = None if model_states is None else model_states[team_idx]
+
+        # one batch element per agent, all of them seeing the same (1, T, ...) features,
+        # streamed models only need the newest frame
+        team_features = features.__class__(
+            *[
+                (f[:, -1:] if team_state is not None else f).expand(
+                    len(agents), -1, *f.shape[2:]
+                )
+                for f in features
+            ]
+        )
+        spatial, non_spatial = featurizer.generate_agent_featurized_states(
+            agent_idxs, team_features
+        )
+
+        if team_state is not None:
+            q_values, agents_state = team_model.step(
+                spatial[:, 0],
+                non_spatial[:, 0],
+                StreamState(*[None if x is None else x[agent_idxs] for x in team_state]),
+            )
+            # rows of the other team and of dead agents are left untouched
+            next_model_states[team_idx] = StreamState(
+                *[
+                    None if x is None else x.index_copy(0, agent_idxs, agent_x)
+                    for x, agent_x in zip(team_state, agents_state)
+                ]
+            )
+        elif hidden is not None and isinstance(team_model, SpatialDQN):
+            # the hidden state has to follow every observation, explored or not
+            q_values, team_hidden = team_model.forward_sequence(
+                spatial, non_spatial, hidden[agent_idxs]
+            )
+            q_values = q_values[:, -1]
+            next_hidden[agent_idxs] = team_hidden
+        else:
+            window_teams.append((agents, team_model, n_actions, (spatial, non_spatial)))
+            continue
+
+        agent_actions[agents] = _eps_greedy(q_values, n_actions, eps)
+
+    if window_teams:
+        agents, team_models, n_actions, inputs = zip(*window_teams)
+        for team_agents, q_values, team_n_actions in zip(
+            agents, team_models[0].forward_teams(team_models, inputs), n_actions
+        ):
+            agent_actions[team_agents] = _eps_greedy(q_values, team_n_actions, eps)
+
+    return agent_actions, next_hidden, next_model_states
+
+
+def _eps_greedy(q_values: torch.Tensor, n_actions: int, eps: float) -> np.ndarray:
+    greedy_actions = torch.argmax(q_values, dim=1).numpy()
+    explore = np.random.random(len(greedy_actions)) <= eps
+    random_actions = np.random.randint(0, n_actions, len(greedy_actions))
+    return np.where(explore, random_actions, greedy_actions)
+
+
+def init_model_states(
+    models: List[Q_Estimator], n_agents: int, sequence_length: int
+) -> List[Optional[StreamState]]:
+    """
+    Empty streaming inference states (one row per agent) for `select_actions`, None for
+    models that can't be streamed.
+    """
+    return [
+        model.init_state(n_agents, sequence_length)
+        if isinstance(model, SpatialDQN)
+        else None
+        for model in models
+    ]
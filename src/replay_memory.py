@@ -1,14 +1,250 @@
+import json
+import queue
+import threading
+import zipfile
+from collections import deque
+from typing import Tuple
 import numpy as np
 import torch
 from collections import namedtuple
 
 # Batch namedtuple, i.e. a class which contains the given attributes
 Batch = namedtuple(
-    "Batch", ("states", "actions", "rewards", "next_states", "imposters", "dones")
+    "Batch",
+    ("states", "actions", "rewards", "next_states", "imposters", "dones", "discounts"),
 )
 
+# Team batch of recurrent training sequences, see EpisodeReplayBuffer.sample_by_role
+SequenceBatch = namedtuple(
+    "SequenceBatch",
+    ("states", "actions", "rewards", "dones", "agents", "hidden", "valid"),
+)
+
+# Team batch, every transition is seen from one agent of the team (`agents`), whose
+# action and reward are selected. `rewards` are n-step returns and `discounts` the
+# factor to apply to the value of `next_states` (gamma ** number of summed rewards)
+RoleBatch = namedtuple(
+    "RoleBatch",
+    ("states", "actions", "rewards", "next_states", "agents", "dones", "discounts"),
+)
+
+
+class PersistentBuffer:
+    """
+    Base for replay buffers made of preallocated tensors indexed by row.
+
+    Subclasses list their row tensors in `_storage_fields`, keep their constructor
+    arguments in `self.config` and track the write position with `idx` / `size`.
+    """
+
+    # buffer tensors indexed by row, these are what `save` and `load` persist
+    _storage_fields = ()
+
+    def _reset_counters(self):
+        # initializing current index and buffer size
+        self.idx = 0
+        self.size = 0
+
+    def _counters(self) -> dict:
+        """Write position counters, as persisted by `save`."""
+        return {"idx": self.idx, "size": self.size}
+
+    def _restore_counters(self, counters: dict):
+        self.idx = counters["idx"]
+        self.size = counters["size"]
+
+    def _used_rows(self) -> int:
+        """Number of leading rows that may hold transitions (what `save` persists)."""
+        return self.size
+
+    def _save_extras(self, archive: zipfile.ZipFile):
+        """Write state that is not indexed by row (nothing by default)."""
+
+    def _load_extras(self, archive: zipfile.ZipFile):
+        """Read back what `_save_extras` wrote."""
+
+    def save(self, filepath, chunk_size: int = 10_000):
+        """
+        Save the buffer (config, write counters and all filled rows) to a compressed archive.
+
+        Every tensor is split into chunks of `chunk_size` rows and each chunk is streamed
+        into its own deflated zip entry, so saving only ever needs one chunk of extra memory.
+
+        Parameters
+            - filepath (str | pathlib.Path): Path of the archive to write
+            - chunk_size (int): Number of buffer rows per archive entry
+        """
+        assert chunk_size > 0, "Chunk size must be positive"
+
+        meta = {
+            "config": self.config,
+            "counters": self._counters(),
+            "rows": self._used_rows(),
+            "chunk_size": chunk_size,
+        }
+
+        with zipfile.ZipFile(
+            filepath, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True
+        ) as archive:
+            archive.writestr("meta.json", json.dumps(meta))
+            for field in self._storage_fields:
+                tensor = getattr(self, field)
+                for start in range(0, meta["rows"], chunk_size):
+                    with archive.open(f"{field}/{start}.npy", "w", force_zip64=True) as f:
+                        np.save(f, tensor[start : start + chunk_size].numpy())
+            self._save_extras(archive)
+
+        print(f"Replay buffer saved to {filepath}")
+
+    @classmethod
+    def load(cls, filepath) -> "PersistentBuffer":
+        """
+        Load a buffer written by `save`, restoring its contents and write position.
+
+        Chunks are decompressed one at a time straight into the preallocated tensors.
+
+        Parameters
+            - filepath (str | pathlib.Path): Path of the archive to read
+        """
+        with zipfile.ZipFile(filepath, "r") as archive:
+            meta = json.loads(archive.read("meta.json"))
+            buffer = cls(**meta["config"])
+
+            for field in buffer._storage_fields:
+                tensor = getattr(buffer, field)
+                for start in range(0, meta["rows"], meta["chunk_size"]):
+                    with archive.open(f"{field}/{start}.npy", "r") as f:
+                        chunk = torch.from_numpy(np.load(f))
+                    tensor[start : start + len(chunk)] = chunk
+            buffer._load_extras(archive)
+
+        buffer._restore_counters(meta["counters"])
+
+        print(f"Replay buffer with {buffer.size} transitions loaded from {filepath}")
+        return buffer
+
+
+def _crew_indices(n_agents, imposters) -> torch.Tensor:
+    """Indices of the agents that are not imposters."""
+    crew_mask = np.ones(n_agents, dtype=bool)
+    crew_mask[imposters] = False
+    return torch.from_numpy(np.flatnonzero(crew_mask))
+
+
+class FrameStore:
+    """
+    Interned storage of flat states, every distinct state is stored once and referenced by id.
+
+    Frames are hashed by their bytes. Ids are reference counted: once no transition
+    references a frame anymore it is forgotten and its slot reused, so memory tracks the
+    number of distinct live states instead of the number of transitions.
+
+    Interning and releasing move and reuse slots (and `frames` is replaced when it grows),
+    so readers in other threads must hold `lock` while resolving ids to frames, as writers
+    do while updating frames and ids.
+    """
+
+    def __init__(self, state_size: int, capacity: int = 1024):
+        """
+        Parameters
+            - state_size (int): Size of a flat state
+            - capacity (int): Initial number of frame slots, doubled whenever full
+        """
+        assert state_size > 0, "State size must be positive"
+        assert capacity > 0, "Frame store capacity must be positive"
+
+        self.state_size = state_size
+        self.frames = torch.empty((capacity, state_size))
+        self.refcounts = torch.zeros(capacity, dtype=torch.long)
+        # slots handed out so far, released slots below it are reused first
+        self.n_slots = 0
+        self._free = []
+        # frame bytes -> id, for the live frames
+        self._ids = {}
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Number of distinct frames currently stored."""
+        return len(self._ids)
+
+    def intern(self, frames) -> torch.Tensor:
+        """
+        Ids of `frames` (any shape ending in `state_size`), storing the unseen ones.
+        Every returned id holds one new reference.
+
+        Repeated frames are collapsed with one `torch.unique` first, only the distinct
+        frames are hashed (one dict lookup each, e.g. T + 1 for a transition's windows).
+        """
+        frames = torch.as_tensor(frames, dtype=torch.float).reshape(-1, self.state_size)
+        unique_frames, inverse = torch.unique(frames, dim=0, return_inverse=True)
+        unique_ids = torch.empty(len(unique_frames), dtype=torch.long)
+        for i, frame in enumerate(unique_frames):
+            key = frame.numpy().tobytes()
+            frame_id = self._ids.get(key)
+            if frame_id is None:
+                frame_id = self._allocate()
+                self.frames[frame_id] = frame
+                self._ids[key] = frame_id
+            unique_ids[i] = frame_id
+
+        ids = unique_ids[inverse]
+        self.refcounts.index_add_(0, ids, torch.ones_like(ids))
+        return ids
+
+    def release(self, ids: torch.Tensor):
+        """Drop one reference per id, frames without references are forgotten."""
+        ids = ids.reshape(-1)
+        self.refcounts.index_add_(0, ids, -torch.ones_like(ids))
+        for frame_id in ids.unique().tolist():
+            if self.refcounts[frame_id] == 0:
+                del self._ids[self.frames[frame_id].numpy().tobytes()]
+                self._free.append(frame_id)
+
+    def restore(self, frames: torch.Tensor, refcounts: torch.Tensor):
+        """Rebuild the store from its first `n_slots` frames and reference counts."""
+        self.n_slots = len(frames)
+        self.frames = torch.empty((max(self.n_slots, 1), self.state_size))
+        self.frames[: self.n_slots] = frames
+        self.refcounts = torch.zeros(len(self.frames), dtype=torch.long)
+        self.refcounts[: self.n_slots] = refcounts
+
+        self._ids = {}
+        self._free = []
+        for frame_id in range(self.n_slots):
+            if self.refcounts[frame_id] > 0:
+                self._ids[self.frames[frame_id].numpy().tobytes()] = frame_id
+            else:
+                self._free.append(frame_id)
+
+    def _allocate(self) -> int:
+        if self._free:
+            return self._free.pop()
+
+        if self.n_slots == len(self.frames):
+            # grow by doubling, the old frames are copied over once
+            frames = torch.empty((2 * len(self.frames), self.state_size))
+            frames[: self.n_slots] = self.frames
+            refcounts = torch.zeros(len(frames), dtype=torch.long)
+            refcounts[: self.n_slots] = self.refcounts
+            self.frames, self.refcounts = frames, refcounts
+
+        self.n_slots += 1
+        return self.n_slots - 1
+
+
+class ReplayBuffer(PersistentBuffer):
+    _storage_fields = (
+        "states",
+        "actions",
+        "rewards",
+        "next_states",
+        "dones",
+        "imposters",
+        "crew",
+        "bootstrap_idx",
+        "discounts",
+    )
 
-class ReplayBuffer:
     def __init__(
         self,
         max_size: int,
@@ -16,38 +252,88 @@ class ReplayBuffer:
         trajectory_size: int,
         n_agents: int,
         n_imposters: int,
+        n_step: int = 1,
+        gamma: float = 0.99,
+        dedup_states: bool = False,
     ):
+        """
+        Parameters
+            - n_step (int): Number of rewards summed into the return stored for every
+              transition, the transition bootstraps from the next state `n_step` steps later
+            - gamma (float): Discount used for the n-step returns
+            - dedup_states (bool): Keep states in a `FrameStore` and store frame ids per
+              transition, worth it when few distinct states fill a large buffer
+        """
 
         assert max_size > 0, "Replay buffer size must be positive"
         assert trajectory_size > 0, "Trajectory size must be positive"
         assert state_size > 0, "State size must be positive"
         assert n_agents > 0, "Number of agents must be positive"
+        assert 0 < n_step < max_size, "N-step must be positive and smaller than the buffer"
 
         self.max_size = max_size
         self.trajectory_size = trajectory_size
         self.state_size = state_size
         self.n_agents = n_agents
         self.n_imposters = n_imposters
+        self.n_step = n_step
+        self.gamma = gamma
+        self.dedup_states = dedup_states
+        self.config = {
+            "max_size": max_size,
+            "state_size": state_size,
+            "trajectory_size": trajectory_size,
+            "n_agents": n_agents,
+            "n_imposters": n_imposters,
+            "n_step": n_step,
+            "gamma": gamma,
+            "dedup_states": dedup_states,
+        }
 
         # initializing the timestep buffer
-        self.states = torch.empty(
-            (self.max_size, self.trajectory_size, self.state_size)
-        )
+        if dedup_states:
+            # rows hold frame ids, consecutive transitions share most of their frames
+            self.frame_store = FrameStore(state_size)
+            self.state_ids = torch.empty(
+                (self.max_size, self.trajectory_size), dtype=torch.long
+            )
+            self.next_state_ids = torch.empty(
+                (self.max_size, self.trajectory_size), dtype=torch.long
+            )
+            self._storage_fields = tuple(
+                {"states": "state_ids", "next_states": "next_state_ids"}.get(f, f)
+                for f in self._storage_fields
+            )
+        else:
+            self.states = torch.empty(
+                (self.max_size, self.trajectory_size, self.state_size)
+            )
+            self.next_states = torch.empty(
+                (self.max_size, self.trajectory_size, self.state_size)
+            )
         self.actions = torch.empty((self.max_size, self.n_agents), dtype=torch.long)
         self.rewards = torch.empty((self.max_size, self.n_agents))
-        self.next_states = torch.empty(
-            (self.max_size, self.trajectory_size, self.state_size)
-        )
         self.dones = torch.empty((self.max_size, 1), dtype=torch.bool)
         self.imposters = torch.empty(
             (self.max_size, self.n_imposters), dtype=torch.int16
         )
+        # role partition of the agents of each row, complements `imposters`
+        self.crew = torch.empty(
+            (self.max_size, self.n_agents - self.n_imposters), dtype=torch.int16
+        )
+        # row whose `next_states` ends the n-step window of each row, and its discount
+        self.bootstrap_idx = torch.empty(self.max_size, dtype=torch.long)
+        self.discounts = torch.empty(self.max_size)
 
-        # initializing current index and buffer size
-        self.idx = 0
-        self.size = 0
+        # rows of the current episode whose n-step return is still being accumulated,
+        # oldest first (never persisted, a reloaded buffer just keeps shorter returns)
+        self._pending = deque()
 
-    def add(self, state, action, reward, next_state, done, imposters):
+        self._reset_counters()
+
+    def add(
+        self, state, action, reward, next_state, done, imposters, truncated=False
+    ):
         """
         Add a transition to the buffer.
 
@@ -58,19 +344,60 @@ class ReplayBuffer:
             - next_state (np.ndarray): Next state
             - done (bool): Whether the episode ended
             - imposters (np.ndarray): List of imposter indices
+            - truncated (bool): Whether the episode was cut off, closes the n-step
+              windows of the episode without making them terminal
         """
-        self.states[self.idx] = torch.tensor(state)
-        self.actions[self.idx] = torch.tensor(action)
-        self.rewards[self.idx] = torch.tensor(reward)
-        self.next_states[self.idx] = torch.tensor(next_state)
-        self.dones[self.idx] = torch.tensor(done)
-        self.imposters[self.idx] = torch.tensor(imposters)
+        self._write(self.idx, state, action, reward, next_state, done, imposters)
+        self._accumulate_returns(self.idx, done, truncated)
 
         # Circulate the pointer to the next position
         self.idx = (self.idx + 1) % self.max_size
         # Update the current buffer size
         self.size = min(self.size + 1, self.max_size)
 
+    def _write(self, row, state, action, reward, next_state, done, imposters):
+        if self.dedup_states:
+            # a prefetching thread may be resolving ids to frames
+            with self.frame_store.lock:
+                if row < self.size:
+                    # the evicted transition gives up its frames
+                    self.frame_store.release(self.state_ids[row])
+                    self.frame_store.release(self.next_state_ids[row])
+                # the windows overlap, both are interned in one call
+                ids = self.frame_store.intern(
+                    torch.stack([torch.as_tensor(state), torch.as_tensor(next_state)])
+                )
+                self.state_ids[row], self.next_state_ids[row] = ids.view(2, -1)
+        else:
+            self.states[row] = torch.tensor(state)
+            self.next_states[row] = torch.tensor(next_state)
+        self.actions[row] = torch.tensor(action)
+        self.rewards[row] = torch.tensor(reward)
+        self.dones[row] = torch.tensor(done)
+        self.imposters[row] = torch.tensor(imposters)
+        self.crew[row] = _crew_indices(self.n_agents, imposters)
+        self.bootstrap_idx[row] = row
+        self.discounts[row] = self.gamma
+
+    def _accumulate_returns(self, row, done, truncated):
+        # the earlier rows of the episode still inside their n-step window receive the
+        # reward of `row` (for all agents at once) and now bootstrap from its next state
+        if self._pending:
+            pending = torch.tensor(self._pending)
+            # number of rewards already summed into each pending row
+            steps = torch.arange(len(pending), 0, -1)
+            self.rewards[pending] += (self.gamma**steps).unsqueeze(1) * self.rewards[row]
+            self.discounts[pending] = self.gamma ** (steps + 1).float()
+            self.bootstrap_idx[pending] = row
+            self.dones[pending] = bool(done)
+
+        self._pending.append(row)
+        if done or truncated:
+            # returns never cross episode ends
+            self._pending.clear()
+        elif len(self._pending) == self.n_step:
+            self._pending.popleft()
+
     def sample(self, batch_size) -> Batch:
         """Sample a batch of experiences.
 
@@ -82,15 +409,76 @@ class ReplayBuffer:
         """
         assert self.size > 0, "Replay buffer is empty, can't sample"
 
-        sample_idx = torch.randint(0, self.size, (batch_size,))
+        return self._gather(self._sample_indices(batch_size))
+
+    def sample_by_role(self, batch_size) -> Tuple[RoleBatch, RoleBatch]:
+        """Sample one batch per team, (imposter batch, crew batch).
+
+        Each row stores all agents split into `imposters` and `crew`, so drawing a row
+        and then one of its slots for the role is uniform over (transition, agent of
+        that role) pairs. Teams are sampled independently.
+
+        Parameters
+            - batch_size (int): Number of transitions to sample per team
+        """
+        assert self.size > 0, "Replay buffer is empty, can't sample"
+
+        return tuple(
+            self._gather_role(self._sample_indices(batch_size), role_agents)
+            for role_agents in (self.imposters, self.crew)
+        )
+
+    def _sample_indices(self, batch_size) -> torch.Tensor:
+        return torch.randint(0, self.size, (batch_size,))
+
+    def _gather_role(self, sample_idx, role_agents) -> RoleBatch:
+        slots = torch.randint(0, role_agents.size(1), (len(sample_idx),))
+        agents = role_agents[sample_idx, slots].long()
+
+        return RoleBatch(
+            states=self._states(sample_idx),
+            actions=self.actions[sample_idx, agents],
+            rewards=self.rewards[sample_idx, agents],
+            next_states=self._next_states(self.bootstrap_idx[sample_idx]),
+            agents=agents,
+            dones=self.dones[sample_idx],
+            discounts=self.discounts[sample_idx],
+        )
+
+    def _states(self, rows) -> torch.Tensor:
+        if self.dedup_states:
+            return self.frame_store.frames[self.state_ids[rows]]
+        return self.states[rows]
+
+    def _next_states(self, rows) -> torch.Tensor:
+        if self.dedup_states:
+            return self.frame_store.frames[self.next_state_ids[rows]]
+        return self.next_states[rows]
+
+    def _save_extras(self, archive: zipfile.ZipFile):
+        if self.dedup_states:
+            n_slots = self.frame_store.n_slots
+            for name in ("frames", "refcounts"):
+                with archive.open(f"frame_store/{name}.npy", "w", force_zip64=True) as f:
+                    np.save(f, getattr(self.frame_store, name)[:n_slots].numpy())
+
+    def _load_extras(self, archive: zipfile.ZipFile):
+        if self.dedup_states:
+            arrays = {}
+            for name in ("frames", "refcounts"):
+                with archive.open(f"frame_store/{name}.npy", "r") as f:
+                    arrays[name] = torch.from_numpy(np.load(f))
+            self.frame_store.restore(**arrays)
 
+    def _gather(self, sample_idx) -> Batch:
         return Batch(
-            states=self.states[sample_idx],
+            states=self._states(sample_idx),
             actions=self.actions[sample_idx],
             rewards=self.rewards[sample_idx],
             imposters=self.imposters[sample_idx],
-            next_states=self.next_states[sample_idx],
+            next_states=self._next_states(self.bootstrap_idx[sample_idx]),
             dones=self.dones[sample_idx],
+            discounts=self.discounts[sample_idx],
         )
 
     def populate(self, env, num_steps):
@@ -131,6 +519,7 @@ class ReplayBuffer:
                     next_state=next_sequence,
                     done=done,
                     imposters=imposters,
+                    truncated=truncation or step + 1 >= num_steps,
                 )
                 state = next_state
                 state_sequence = next_sequence
@@ -141,3 +530,539 @@ class ReplayBuffer:
 
                 if step >= num_steps:
                     break
+
+
+class SharedReplayBuffer(ReplayBuffer):
+    """
+    Replay buffer whose storage lives in shared memory, so that several actor processes
+    can append transitions while the learner samples from the very same tensors.
+
+    The rows are split into `n_shards` equal shards and every writer owns exactly one of
+    them (see `set_shard`). A writer only touches its own rows and its own counters, so
+    appends need no locks. Counters are bumped after the row is written; a learner that
+    samples while a writer wraps around may occasionally read a row that is being
+    overwritten, which is tolerated as in other asynchronous replay setups.
+
+    Hand the buffer to actor processes through `torch.multiprocessing`, the storage is
+    then shared with them instead of being copied. `run_experiment(n_actors=...)` trains
+    from one, filled by the actor processes of an ActorPool.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        state_size: int,
+        trajectory_size: int,
+        n_agents: int,
+        n_imposters: int,
+        n_step: int = 1,
+        gamma: float = 0.99,
+        n_shards: int = 1,
+        dedup_states: bool = False,
+    ):
+        assert n_shards > 0, "Number of shards must be positive"
+        # the frame store is a process local structure
+        assert not dedup_states, "State deduplication is not supported with shared storage"
+        assert (
+            max_size % n_shards == 0
+        ), "Replay buffer size must be divisible by the number of shards"
+
+        self.n_shards = n_shards
+        self.shard_capacity = max_size // n_shards
+        assert (
+            self.shard_capacity > n_step
+        ), "Shards must be larger than the n-step window"
+        # shard written by this process
+        self.shard = 0
+
+        super().__init__(
+            max_size=max_size,
+            state_size=state_size,
+            trajectory_size=trajectory_size,
+            n_agents=n_agents,
+            n_imposters=n_imposters,
+            n_step=n_step,
+            gamma=gamma,
+        )
+        self.config["n_shards"] = n_shards
+
+        for field in self._storage_fields:
+            getattr(self, field).share_memory_()
+
+    def _reset_counters(self):
+        # per shard write position and number of stored transitions
+        self.shard_idx = torch.zeros(self.n_shards, dtype=torch.long).share_memory_()
+        self.shard_sizes = torch.zeros(self.n_shards, dtype=torch.long).share_memory_()
+
+    def _counters(self) -> dict:
+        return {
+            "shard_idx": self.shard_idx.tolist(),
+            "shard_sizes": self.shard_sizes.tolist(),
+        }
+
+    def _restore_counters(self, counters: dict):
+        self.shard_idx[:] = torch.tensor(counters["shard_idx"])
+        self.shard_sizes[:] = torch.tensor(counters["shard_sizes"])
+
+    def _used_rows(self) -> int:
+        filled = torch.nonzero(self.shard_sizes).view(-1)
+        if len(filled) == 0:
+            return 0
+        last = int(filled[-1])
+        return last * self.shard_capacity + int(self.shard_sizes[last])
+
+    @property
+    def size(self) -> int:
+        """Number of transitions stored across all shards."""
+        return int(self.shard_sizes.sum())
+
+    def set_shard(self, shard: int):
+        """
+        Select the shard this process appends to. Every concurrent writer must use its own shard.
+
+        Parameters
+            - shard (int): Shard index in [0, n_shards)
+        """
+        assert 0 <= shard < self.n_shards, f"Invalid shard: {shard}"
+        self.shard = shard
+
+    def add(
+        self, state, action, reward, next_state, done, imposters, truncated=False
+    ):
+        position = int(self.shard_idx[self.shard])
+        row = self.shard * self.shard_capacity + position
+        self._write(row, state, action, reward, next_state, done, imposters)
+        # n-step windows stay inside the shard of their writer
+        self._accumulate_returns(row, done, truncated)
+
+        # publish the row only once it is fully written
+        self.shard_idx[self.shard] = (position + 1) % self.shard_capacity
+        self.shard_sizes[self.shard] = min(
+            int(self.shard_sizes[self.shard]) + 1, self.shard_capacity
+        )
+
+    def populate(self, env, num_steps):
+        """Populates every shard with its share of `num_steps` steps of the random policy."""
+        shard = self.shard
+        for shard_idx in range(self.n_shards):
+            self.set_shard(shard_idx)
+            super().populate(
+                env,
+                num_steps * (shard_idx + 1) // self.n_shards
+                - num_steps * shard_idx // self.n_shards,
+            )
+        self.set_shard(shard)
+
+    def _sample_indices(self, batch_size) -> torch.Tensor:
+        # uniform over all stored transitions: draw a global rank and map it to (shard, offset)
+        sizes = self.shard_sizes.clone()
+        ends = sizes.cumsum(0)
+        ranks = torch.randint(0, int(ends[-1]), (batch_size,))
+        shards = torch.searchsorted(ends, ranks, right=True)
+        offsets = ranks - (ends - sizes)[shards]
+        return shards * self.shard_capacity + offsets
+
+
+class EpisodeReplayBuffer(PersistentBuffer):
+    """
+    Replay buffer storing whole episodes frame by frame, for recurrent (R2D2 style) training.
+
+    Each step keeps the flat state the agents acted on, the joint action and rewards and
+    the recurrent hidden state every agent had when it acted. Training sequences are read
+    back with a burn-in prefix that refreshes the stored hidden state, so long temporal
+    context costs one frame per step instead of a window per transition.
+    """
+
+    _storage_fields = (
+        "states",
+        "actions",
+        "rewards",
+        "dones",
+        "imposters",
+        "crew",
+        "hidden",
+        "episodes",
+        "episode_starts",
+    )
+
+    def __init__(
+        self,
+        max_size: int,
+        state_size: int,
+        n_agents: int,
+        n_imposters: int,
+        hidden_shape: Tuple[int, int],
+    ):
+        assert max_size > 0, "Replay buffer size must be positive"
+        assert state_size > 0, "State size must be positive"
+        assert n_agents > 0, "Number of agents must be positive"
+
+        self.max_size = max_size
+        self.state_size = state_size
+        self.n_agents = n_agents
+        self.n_imposters = n_imposters
+        self.hidden_shape = tuple(hidden_shape)
+        self.config = {
+            "max_size": max_size,
+            "state_size": state_size,
+            "n_agents": n_agents,
+            "n_imposters": n_imposters,
+            "hidden_shape": list(self.hidden_shape),
+        }
+        # acting only needs the newest frame, the recurrent state carries the past
+        self.trajectory_size = 1
+
+        self.states = torch.empty((self.max_size, self.state_size))
+        self.actions = torch.empty((self.max_size, self.n_agents), dtype=torch.long)
+        self.rewards = torch.empty((self.max_size, self.n_agents))
+        self.dones = torch.empty(self.max_size, dtype=torch.bool)
+        self.imposters = torch.empty(
+            (self.max_size, self.n_imposters), dtype=torch.int16
+        )
+        self.crew = torch.empty(
+            (self.max_size, self.n_agents - self.n_imposters), dtype=torch.int16
+        )
+        # hidden state of each agent's model before acting on the frame, (layers, hidden_dim)
+        self.hidden = torch.empty((self.max_size, self.n_agents, *self.hidden_shape))
+        # episode id and absolute step of the episode's first frame
+        self.episodes = torch.empty(self.max_size, dtype=torch.long)
+        self.episode_starts = torch.empty(self.max_size, dtype=torch.long)
+
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.idx = 0
+        self.size = 0
+        # frames ever added, id and first absolute step of the episode being written
+        self.n_added = 0
+        self.episode = 0
+        self.episode_start = 0
+
+    def _counters(self) -> dict:
+        return {
+            "idx": self.idx,
+            "size": self.size,
+            "n_added": self.n_added,
+            "episode": self.episode,
+            "episode_start": self.episode_start,
+        }
+
+    def _restore_counters(self, counters: dict):
+        for name, value in counters.items():
+            setattr(self, name, value)
+        # whatever was being written when the buffer was saved won't be continued
+        self.end_episode()
+
+    def add(self, state, action, reward, done, truncated, imposters, hidden):
+        """
+        Add a step to the buffer.
+
+        Parameters
+            - state (np.ndarray): Flat state the agents acted on
+            - action (np.ndarray): Action taken by every agent
+            - reward (np.ndarray): Reward received by every agent
+            - done (bool): Whether the episode ended
+            - truncated (bool): Whether the episode was cut by the time limit
+            - imposters (np.ndarray): List of imposter indices
+            - hidden (torch.Tensor): Hidden state of every agent before acting, (n_agents, layers, hidden_dim)
+        """
+        row = self.idx
+        self.states[row] = torch.tensor(state)
+        self.actions[row] = torch.tensor(action)
+        self.rewards[row] = torch.tensor(reward)
+        self.dones[row] = bool(done)
+        self.imposters[row] = torch.tensor(imposters)
+        self.crew[row] = _crew_indices(self.n_agents, imposters)
+        self.hidden[row] = hidden
+        self.episodes[row] = self.episode
+        self.episode_starts[row] = self.episode_start
+
+        self.n_added += 1
+        self.idx = (self.idx + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+
+        if done or truncated:
+            self.end_episode()
+
+    def end_episode(self):
+        """Close the episode being written, the next step starts a new one."""
+        if self.episode_start < self.n_added:
+            self.episode += 1
+            self.episode_start = self.n_added
+
+    def sample_by_role(
+        self, batch_size: int, sequence_length: int, burn_in: int
+    ) -> Tuple[SequenceBatch, SequenceBatch]:
+        """Sample one batch of training sequences per team, (imposter batch, crew batch).
+
+        A sequence covers `burn_in + sequence_length + 1` frames: the burn-in prefix, the
+        trained steps and the frame bootstrapping the last trained step. The first trained
+        step is drawn uniformly over stored frames; the burn-in is shortened at the start
+        of an episode (those frames are left padded and flagged invalid) and frames past
+        the end of the episode are flagged invalid as well. `hidden` is the stored hidden
+        state of the first valid frame.
+
+        Parameters
+            - batch_size (int): Number of sequences to sample per team
+            - sequence_length (int): Number of trained steps per sequence
+            - burn_in (int): Maximum number of steps used to refresh the hidden state
+        """
+        assert self.size > 0, "Replay buffer is empty, can't sample"
+
+        oldest = self.n_added - self.size
+        return tuple(
+            self._gather_sequences(
+                torch.randint(oldest, self.n_added, (batch_size,)),
+                role_agents,
+                sequence_length,
+                burn_in,
+            )
+            for role_agents in (self.imposters, self.crew)
+        )
+
+    def _gather_sequences(
+        self, starts, role_agents, sequence_length, burn_in
+    ) -> SequenceBatch:
+        oldest = self.n_added - self.size
+        start_rows = starts % self.max_size
+
+        # absolute step of every frame in the sequence, the first trained step sits at `burn_in`
+        steps = (starts - burn_in).unsqueeze(1) + torch.arange(
+            burn_in + sequence_length + 1
+        )
+        rows = steps.clamp(oldest, self.n_added - 1) % self.max_size
+
+        first_steps = torch.clamp(
+            torch.maximum(starts - burn_in, self.episode_starts[start_rows]), min=oldest
+        )
+        valid = (
+            (steps >= first_steps.unsqueeze(1))
+            & (steps < self.n_added)
+            & (self.episodes[rows] == self.episodes[start_rows].unsqueeze(1))
+        )
+
+        slots = torch.randint(0, role_agents.size(1), (len(starts),))
+        agents = role_agents[start_rows, slots].long()
+
+        # roles change between episodes, so invalid frames may hold actions of the other
+        # team's action space, they are never trained but still have to index the Q values
+        actions = self.actions[rows[:, :-1], agents.unsqueeze(1)]
+        actions = torch.where(valid[:, :-1], actions, torch.zeros_like(actions))
+
+        return SequenceBatch(
+            states=self.states[rows],
+            actions=actions,
+            rewards=self.rewards[rows[:, :-1], agents.unsqueeze(1)],
+            dones=self.dones[rows[:, :-1]],
+            agents=agents,
+            hidden=self.hidden[first_steps % self.max_size, agents],
+            valid=valid,
+        )
+
+    def populate(self, env, num_steps):
+        """Populate this replay memory with `num_steps` from the random policy.
+
+        The random policy has no recurrent state, zeros are stored as hidden states.
+
+        :param env: Gymnasium environment
+        :param num_steps: Number of steps to populate the replay memory
+        """
+        hidden = torch.zeros((self.n_agents, *self.hidden_shape))
+
+        step = 0
+        while step < num_steps:
+            s, _ = env.reset()
+            state = env.flatten_state(s)
+
+            done = False
+            truncation = False
+            while not done and not truncation and step < num_steps:
+                imposters = env.imposter_idxs
+                action = env.sample_actions()
+                n_s, reward, done, truncation, _ = env.step(action)
+                self.add(
+                    state=state,
+                    action=action,
+                    reward=reward,
+                    done=done,
+                    truncated=truncation,
+                    imposters=imposters,
+                    hidden=hidden,
+                )
+                state = env.flatten_state(n_s)
+                step += 1
+
+        self.end_episode()
+
+
+class PrefetchingSampler:
+    """
+    Samples team batches from a `ReplayBuffer` in a background thread, so that sampling
+    (and optionally featurization) overlaps with the learner's forward / backward pass.
+
+    Batches are written with `index_select(out=...)` into a small ring of preallocated
+    (pinned when `pin_memory` and CUDA is available) `RoleBatch` tensors instead of being
+    freshly allocated for every sample. A batch returned by `get` stays valid until the
+    next call to `get`, after which its slot is handed back to the sampling thread.
+
+    The buffer may keep receiving transitions while the thread samples, a row that is
+    being overwritten can then be read, as with `SharedReplayBuffer`. Interned states
+    (`dedup_states`) are resolved under the frame store lock, so ids and frames always match.
+    """
+
+    def __init__(
+        self,
+        replay_buffer: ReplayBuffer,
+        batch_size: int,
+        n_buffers: int = 2,
+        featurizer=None,
+        pin_memory: bool = False,
+    ):
+        """
+        Parameters
+            - replay_buffer (ReplayBuffer): Buffer to sample from, must not be empty
+            - batch_size (int): Number of transitions per team batch
+            - n_buffers (int): Number of batches prepared ahead
+            - featurizer (SequenceStateFeaturizer): Optional featurizer used by the sampling
+              thread, only its stateless `featurize` is used so it can be shared
+            - pin_memory (bool): Allocate page-locked batches (only with CUDA)
+        """
+        assert batch_size > 0, "Batch size must be positive"
+        assert n_buffers > 0, "Number of prefetched batches must be positive"
+        assert replay_buffer.size > 0, "Replay buffer is empty, can't sample"
+
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self.featurizer = featurizer
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+        self.slots = [
+            tuple(
+                self._allocate_role_batch(role_agents.size(1))
+                for role_agents in (replay_buffer.imposters, replay_buffer.crew)
+            )
+            for _ in range(n_buffers)
+        ]
+        # prepared slots (or the sampling thread's exception) and slots free for refill
+        self._filled = queue.Queue()
+        self._free = queue.Queue()
+        for slot_idx in range(n_buffers):
+            self._free.put(slot_idx)
+        self._current = None
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _allocate_role_batch(self, n_role_agents) -> RoleBatch:
+        buffer = self.replay_buffer
+        B = self.batch_size
+        return RoleBatch(
+            states=self._empty(B, buffer.trajectory_size, buffer.state_size),
+            actions=self._empty(B, dtype=torch.long),
+            rewards=self._empty(B),
+            next_states=self._empty(B, buffer.trajectory_size, buffer.state_size),
+            agents=self._empty(B, dtype=torch.long),
+            dones=self._empty(B, 1, dtype=torch.bool),
+            discounts=self._empty(B),
+        )
+
+    def _empty(self, *shape, dtype=torch.float):
+        return torch.empty(shape, dtype=dtype, pin_memory=self.pin_memory)
+
+    def _fill_role(self, out: RoleBatch, role_agents):
+        buffer = self.replay_buffer
+        rows = buffer._sample_indices(self.batch_size)
+        slots = torch.randint(0, role_agents.size(1), (self.batch_size,))
+        out.agents.copy_(role_agents.view(-1)[rows * role_agents.size(1) + slots])
+
+        # (row, agent) pairs are read through the flattened per-agent tensors
+        agent_rows = rows * buffer.n_agents + out.agents
+        bootstrap_rows = torch.index_select(buffer.bootstrap_idx, 0, rows)
+        if buffer.dedup_states:
+            # resolve the frame ids of all (row, step) pairs in one select, ids and frames
+            # are read together under the store lock, see FrameStore
+            with buffer.frame_store.lock:
+                frames = buffer.frame_store.frames
+                for ids, ids_rows, states in (
+                    (buffer.state_ids, rows, out.states),
+                    (buffer.next_state_ids, bootstrap_rows, out.next_states),
+                ):
+                    torch.index_select(
+                        frames,
+                        0,
+                        ids[ids_rows].view(-1),
+                        out=states.view(-1, buffer.state_size),
+                    )
+        else:
+            torch.index_select(buffer.states, 0, rows, out=out.states)
+            torch.index_select(
+                buffer.next_states, 0, bootstrap_rows, out=out.next_states
+            )
+        torch.index_select(buffer.actions.view(-1), 0, agent_rows, out=out.actions)
+        torch.index_select(buffer.rewards.view(-1), 0, agent_rows, out=out.rewards)
+        torch.index_select(buffer.dones, 0, rows, out=out.dones)
+        torch.index_select(buffer.discounts, 0, rows, out=out.discounts)
+
+    def _featurize(self, batch):
+        # (state features, next state features) per team, from the sampled agents' view
+        features = []
+        for team_batch in batch:
+            state_features, next_state_features = self.featurizer.featurize_transitions(
+                team_batch.states, team_batch.next_states
+            )
+            state_feat = self.featurizer.generate_agent_featurized_states(
+                team_batch.agents, state_features
+            )
+            next_state_feat = self.featurizer.generate_agent_featurized_states(
+                team_batch.agents, next_state_features
+            )
+            features.append((state_feat, next_state_feat))
+        return tuple(features)
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    slot_idx = self._free.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                batch = self.slots[slot_idx]
+                for out, role_agents in zip(
+                    batch, (self.replay_buffer.imposters, self.replay_buffer.crew)
+                ):
+                    self._fill_role(out, role_agents)
+                features = None if self.featurizer is None else self._featurize(batch)
+                self._filled.put((slot_idx, features))
+        except Exception as e:
+            self._filled.put(e)
+
+    def get(self):
+        """
+        Next prefetched sample, (batch, features).
+
+        `batch` is an (imposter, crew) pair of `RoleBatch` as returned by
+        `ReplayBuffer.sample_by_role`. `features` holds the featurized (states,
+        next states) per team when the sampler has a featurizer, otherwise None.
+        """
+        assert not self._stop.is_set(), "Sampler is closed"
+        if self._current is not None:
+            self._free.put(self._current)
+            self._current = None
+
+        item = self._filled.get()
+        if isinstance(item, Exception):
+            raise item
+        self._current, features = item
+        return self.slots[self._current], features
+
+    def close(self):
+        """Stop the sampling thread."""
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -10,12 +10,35 @@ import pathlib
 from datetime import datetime
 import json
 
+from src.checkpoint import (
+    load_checkpoint,
+    restore_training_checkpoint,
+    save_training_checkpoint,
+)
 from src.scheduler import ExponentialSchedule
 from src.environment import FourRoomEnv, StateFields
-from src.features.model_ready import SequenceStateFeaturizer, FeaturizerType
+from src.features.model_ready import (
+    SequenceStateFeaturizer,
+    FeaturizerType,
+    StreamingFeaturizer,
+)
+from src.actors import ActorPool
+from src.inference_server import InferenceServer
 from src.metrics import EpisodicMetricHandler, SusMetrics
-from src.replay_memory import ReplayBuffer
-from src.models.dqn import ModelType, Q_Estimator
+from src.policy import init_model_states, select_actions
+from src.replay_memory import (
+    ReplayBuffer,
+    EpisodeReplayBuffer,
+    PrefetchingSampler,
+    SharedReplayBuffer,
+)
+from src.models.dqn import (
+    ModelType,
+    Q_Estimator,
+    SpatialDQN,
+    copy_models,
+    forward_shared_trunk,
+)
 from src.visualize import AmongUsVisualizer
 from src.utils import GeneralEncoder
 
@@ -55,99 +78,230 @@ class DQNTeamTrainer:
         imposter_target_model,
         crew_model,
         crew_target_model,
+        features=None,
     ):
+        """
+        One DQN update per trained team. Teams with the same optimizer (a shared trunk
+        model, see MultiRoleSpatialDQN) are updated together, with one trunk forward for
+        both teams' samples.
+
+        Parameters:
+            batch (Tuple[RoleBatch, RoleBatch]): Imposter and crew batches, as returned by ReplayBuffer.sample_by_role.
+            features (Tuple): Optional already featurized (states, next states) per team, as returned by PrefetchingSampler.get.
+        """
 
         accumulated_losses = [0, 0]
 
         if not self.train:
             return accumulated_losses
 
-        # reset gradents for both optimizers
-        for opt in [self.imposter_optimizer, self.crew_optimizer]:
-            if opt is not None:
-                opt.zero_grad()
+        update_groups = self._update_groups(
+            batch, imposter_model, imposter_target_model, crew_model, crew_target_model
+        )
+
+        for group in update_groups:
+            loss_idxs, opts, team_batches, team_models, team_target_models = zip(*group)
+
+            opts[0].zero_grad()
 
-        featurizer.fit(batch.states)
-        featurized_state = featurizer.generate_featurized_states()
+            # every sample is featurized from the perspective of the team agent it was drawn for
+            state_feats, next_state_feats = zip(
+                *[
+                    features[loss_idx]
+                    if features is not None
+                    else self._featurize_team(featurizer, team_batch)
+                    for loss_idx, team_batch in zip(loss_idxs, team_batches)
+                ]
+            )
 
-        featurizer.fit(batch.next_states)
-        featurized_next_state = featurizer.generate_featurized_states()
+            for team_model in team_models:
+                team_model.train()
+            # compute the value of the actions taken by the agents (gradients are calculated here!)
+            action_values = forward_shared_trunk(team_models, state_feats)
 
-        for agent_idx, (state_feat, next_state_feat) in enumerate(
-            zip(featurized_state, featurized_next_state)
-        ):
+            with torch.no_grad():
+                next_action_values = forward_shared_trunk(
+                    team_target_models, next_state_feats
+                )
 
-            # samples in which agnets is an imposter/crew member
-            imposter_samples = (batch.imposters == agent_idx).view(-1)
-            crew_samples = ~imposter_samples
+            loss = 0
+            for loss_idx, team_batch, team_action_values, team_next_action_values in zip(
+                loss_idxs, team_batches, action_values, next_action_values
+            ):
+                values = torch.gather(
+                    team_action_values, 1, team_batch.actions.view(-1, 1)
+                ).view(-1)
+
+                with torch.no_grad():
+                    done_mask = team_batch.dones.view(-1)
+                    rewards = team_batch.rewards.view(-1)
+
+                    # calculate target values, no gradients here. rewards are n-step returns
+                    # from the buffer, discounted by gamma ** n up to the bootstrapped state
+                    target_values = (
+                        rewards
+                        + team_batch.discounts
+                        * torch.max(team_next_action_values, dim=1)[0]
+                    )
+                    target_values[done_mask] = rewards[done_mask]
 
-            # spatial.requires_grad = non_spatial.requires_grad = True
+                team_loss = F.mse_loss(values, target_values)
+                accumulated_losses[loss_idx] += team_loss.item()
+                loss = loss + team_loss
 
-            # training via gradient accumulation
-            for loss_idx, (
-                opt,
-                team_samples,
-                team_model,
-                team_model_target,
-            ) in enumerate(
+            loss.backward()
+            opts[0].step()
+
+        return accumulated_losses
+
+    def _update_groups(
+        self, batch, imposter_model, imposter_target_model, crew_model, crew_target_model
+    ):
+        """
+        Trained teams as (loss index, optimizer, batch, model, target model), grouped by
+        optimizer: teams sharing one (a shared trunk model) are updated with one step.
+        """
+        imposter_batch, crew_batch = batch
+
+        teams = [
+            (loss_idx, opt, team_batch, team_model, team_model_target)
+            for loss_idx, (opt, team_batch, team_model, team_model_target) in enumerate(
                 [
                     (
                         self.imposter_optimizer,
-                        imposter_samples,
+                        imposter_batch,
                         imposter_model,
                         imposter_target_model,
                     ),
-                    (self.crew_optimizer, crew_samples, crew_model, crew_target_model),
+                    (self.crew_optimizer, crew_batch, crew_model, crew_target_model),
                 ]
-            ):
-                if opt is not None and team_samples.sum() > 0:
-                    team_model.train()
-                    # compute the value of the actions taken by the agent (gradients are calculated here!)
+            )
+            if opt is not None
+        ]
+        if len(teams) == 2 and self.imposter_optimizer is self.crew_optimizer:
+            return [teams]
+        return [[team] for team in teams]
 
-                    action_values = team_model(
-                        state_feat[0][team_samples],
-                        state_feat[1][team_samples],
-                    )
+    @staticmethod
+    def _featurize_team(featurizer, team_batch):
+        state_features, next_state_features = featurizer.featurize_transitions(
+            team_batch.states, team_batch.next_states
+        )
+        return (
+            featurizer.generate_agent_featurized_states(team_batch.agents, state_features),
+            featurizer.generate_agent_featurized_states(
+                team_batch.agents, next_state_features
+            ),
+        )
 
-                    actions = torch.tensor(batch.actions[team_samples, agent_idx])
+    def train_sequence_step(
+        self,
+        batch,
+        featurizer,
+        imposter_model,
+        imposter_target_model,
+        crew_model,
+        crew_target_model,
+        burn_in,
+    ):
+        """
+        One recurrent DQN update per trained team, on sequences replayed with a burn-in prefix.
+        Teams with the same optimizer (a shared trunk model) sum their losses into one step.
 
-                    values = torch.gather(action_values, 1, actions.view(-1, 1)).view(
-                        -1
-                    )
+        The online and target RNNs start from the hidden state stored at acting time and are
+        run over the burn-in steps without gradients (padded steps keep the hidden state),
+        the loss then covers every valid step after the burn-in. A team whose sequences have
+        no such step (all padding) is not updated.
+
+        Parameters:
+            batch (Tuple[SequenceBatch, SequenceBatch]): Imposter and crew batches, as returned by EpisodeReplayBuffer.sample_by_role.
+            burn_in (int): Number of burn-in steps the batch was sampled with.
+        """
+
+        accumulated_losses = [0, 0]
+
+        if not self.train:
+            return accumulated_losses
+
+        update_groups = self._update_groups(
+            batch, imposter_model, imposter_target_model, crew_model, crew_target_model
+        )
+
+        for group in update_groups:
+            # teams of a group share the optimizer
+            opt = group[0][1]
+            opt.zero_grad()
+
+            loss = None
+            for loss_idx, _, team_batch, team_model, team_model_target in group:
+                team_loss = self._sequence_loss(
+                    featurizer, team_batch, team_model, team_model_target, burn_in
+                )
+                if team_loss is None:
+                    continue
+                accumulated_losses[loss_idx] += team_loss.item()
+                loss = team_loss if loss is None else loss + team_loss
+
+            # no step at all, even a zero loss would move the weights with momentum
+            if loss is None:
+                continue
+            loss.backward()
+            opt.step()
 
-                    with torch.no_grad():
-                        done_mask = batch.dones[team_samples].view(-1)
-
-                        rewards = torch.tensor(
-                            batch.rewards[team_samples, agent_idx]
-                        ).view(-1)
-
-                        # calculate target values, no gradients here (notice the detach() calls
-                        target_values = (
-                            rewards
-                            + self.gamma
-                            * torch.max(
-                                team_model_target(
-                                    next_state_feat[0][team_samples].detach(),
-                                    next_state_feat[1][team_samples].detach(),
-                                ),
-                                dim=1,
-                            )[0]
-                        )
-                        target_values[done_mask] = rewards[done_mask]
-
-                    loss = F.mse_loss(values, target_values)
-                    loss.backward()
-                    accumulated_losses[loss_idx] += loss.item()
-
-                    opt.step()
-
-        # use gradients to update models
-        # for opt in [self.imposter_optimizer, self.crew_optimizer]:
-        #     if opt is not None:
-        #         opt.step()
         return accumulated_losses
 
+    def _sequence_loss(
+        self, featurizer, team_batch, team_model, team_model_target, burn_in
+    ):
+        """Loss of the team's valid steps after the burn-in, None if there are none."""
+        valid = team_batch.valid
+        dones = team_batch.dones[:, burn_in:]
+
+        # steps outside the episode, or whose next frame is unknown, are not trained
+        loss_mask = valid[:, burn_in:-1] & (dones | valid[:, burn_in + 1 :])
+        if not loss_mask.any():
+            return None
+
+        spatial, non_spatial = featurizer.generate_agent_featurized_states(
+            team_batch.agents, featurizer.featurize(team_batch.states)
+        )
+
+        team_model.train()
+
+        with torch.no_grad():
+            hidden = target_hidden = team_batch.hidden
+            for t in range(burn_in):
+                # padded steps (before the start of the episode) leave the hidden state untouched
+                keep = ~valid[:, t].view(-1, 1, 1)
+                _, next_hidden = team_model.forward_sequence(
+                    spatial[:, t : t + 1], non_spatial[:, t : t + 1], hidden
+                )
+                _, next_target_hidden = team_model_target.forward_sequence(
+                    spatial[:, t : t + 1], non_spatial[:, t : t + 1], target_hidden
+                )
+                hidden = torch.where(keep, hidden, next_hidden)
+                target_hidden = torch.where(keep, target_hidden, next_target_hidden)
+
+            # the target also covers the frame after the last trained step
+            target_q, _ = team_model_target.forward_sequence(
+                spatial[:, burn_in:], non_spatial[:, burn_in:], target_hidden
+            )
+
+        action_values, _ = team_model.forward_sequence(
+            spatial[:, burn_in:-1], non_spatial[:, burn_in:-1], hidden
+        )
+        values = torch.gather(
+            action_values, 2, team_batch.actions[:, burn_in:].unsqueeze(2)
+        ).squeeze(2)
+
+        with torch.no_grad():
+            rewards = team_batch.rewards[:, burn_in:]
+
+            target_values = rewards + self.gamma * target_q[:, 1:].max(dim=2)[0]
+            target_values[dones] = rewards[dones]
+
+        return F.mse_loss(values[loss_mask], target_values[loss_mask])
+
 
 def run_experiment(
     env: FourRoomEnv,
@@ -162,6 +316,8 @@ def run_experiment(
     replay_prepopulate_steps: int = 1000,
     batch_size: int = 32,
     gamma: float = 0.99,
+    # number of rewards summed by the replay buffer before bootstrapping (transition replay)
+    n_step: int = 1,
     scheduler_start_eps: float = 1.0,
     scheduler_end_eps: float = 0.05,
     scheduler_time_steps: int = 1_000_000,
@@ -173,6 +329,24 @@ def run_experiment(
     train_step_interval: int = 5,
     num_checkpoint_saves: int = 5,
     target_update_interval: int = 10_000,
+    replay_buffer_path: Optional[pathlib.Path] = None,
+    save_replay_buffer: bool = False,
+    # replay whole episodes R2D2 style, `sequence_length` is then the number of trained
+    # steps per replayed sequence, preceded by up to `burn_in` steps
+    recurrent_replay: bool = False,
+    burn_in: int = 2,
+    # number of batches sampled and featurized ahead in a background thread (0 = off)
+    prefetch_batches: int = 0,
+    # store every distinct state once in the replay buffer (transition replay)
+    dedup_states: bool = False,
+    # act with SpatialDQN.step, reusing the CNN encodings of earlier frames (transition replay)
+    streaming_inference: bool = False,
+    # training checkpoint (see src.checkpoint) to resume the models, optimizers, RNG states
+    # and step counter from, typically with the replay buffer saved by the same run
+    resume_checkpoint_path: Optional[pathlib.Path] = None,
+    # number of actor processes playing into a shared replay buffer, with one shard each,
+    # while this process trains (transition replay, 0 = act and train in this process)
+    n_actors: int = 0,
 ):
     # create a experiment dir
     if experiment_base_dir is None:        experiment_base_dir = BASE_REGISTRY_DIR / "experiments"
@@ -194,6 +368,7 @@ def run_experiment(
         'replay_prepopulate_steps': replay_prepopulate_steps,
         'batch_size': batch_size,
         'gamma': gamma,
+        'n_step': n_step,
         'scheduler_start_eps': scheduler_start_eps,
         'scheduler_end_eps': scheduler_end_eps,
         'scheduler_time_steps': scheduler_time_steps,
@@ -204,6 +379,15 @@ def run_experiment(
         'learning_rate': learning_rate,
         'train_step_interval': train_step_interval,
         "target_update_interval": target_update_interval,
+        "replay_buffer_path": replay_buffer_path,
+        "save_replay_buffer": save_replay_buffer,
+        "recurrent_replay": recurrent_replay,
+        "burn_in": burn_in,
+        "prefetch_batches": prefetch_batches,
+        "dedup_states": dedup_states,
+        "streaming_inference": streaming_inference,
+        "resume_checkpoint_path": resume_checkpoint_path,
+        "n_actors": n_actors,
     }
     
     # save the configs
@@ -211,20 +395,35 @@ def run_experiment(
         json.dump(experiment_config, f, cls=GeneralEncoder, indent=4)
 
     # initializing models
-    imposter_model = ModelType.build(imposter_model_type, **imposter_model_args)
-    crew_model = ModelType.build(crew_model_type, **crew_model_args)
+    shared_model = None
+    if imposter_model_type == ModelType.MULTI_ROLE_SPATIAL_DQN:
+        # one trunk for both teams, built from the imposter model args
+        assert (
+            crew_model_type == ModelType.MULTI_ROLE_SPATIAL_DQN
+        ), "Both teams must use the multi role model"
+        shared_model = ModelType.build(imposter_model_type, **imposter_model_args)
+        imposter_model, crew_model = shared_model.role_models()
+    else:
+        imposter_model = ModelType.build(imposter_model_type, **imposter_model_args)
+        crew_model = ModelType.build(crew_model_type, **crew_model_args)
 
     # initializing optimizers
     crew_optimizer = imposter_optimizer = None
     if optimizer_type is not None:
-        if train_imposter:
-            imposter_optimizer = OptimizerType.build(
-                optimizer_type, imposter_model, learning_rate
-            )
-        if train_crew:
-            crew_optimizer = OptimizerType.build(
-                optimizer_type, crew_model, learning_rate
+        if shared_model is not None and train_imposter and train_crew:
+            # a single optimizer, so that the shared trunk is stepped once per update
+            imposter_optimizer = crew_optimizer = OptimizerType.build(
+                optimizer_type, shared_model, learning_rate
             )
+        else:
+            if train_imposter:
+                imposter_optimizer = OptimizerType.build(
+                    optimizer_type, imposter_model, learning_rate
+                )
+            if train_crew:
+                crew_optimizer = OptimizerType.build(
+                    optimizer_type, crew_model, learning_rate
+                )
 
     # initializing trainer
     trainer = DQNTeamTrainer(
@@ -241,35 +440,116 @@ def run_experiment(
     # initialize metric handlers
     metrics = EpisodicMetricHandler()
 
-    # initialize replay buffer and prepopulate it
-    replay_buffer = ReplayBuffer(
-        max_size=replay_buffer_size,
-        trajectory_size=sequence_length,
-        state_size=env.flattened_state_size,
-        n_imposters=env.n_imposters,
-        n_agents=env.n_agents,
-    )
+    # initialize replay buffer, either warm-started from a previous run or prepopulated
+    assert not (
+        recurrent_replay and n_step > 1
+    ), "N-step returns are only computed by the transition replay buffer"
+    assert n_actors == 0 or not (
+        recurrent_replay or dedup_states or streaming_inference
+    ), "Actor processes only support transition replay without deduplication or streaming"
+    if recurrent_replay:
+        recurrent_models = [
+            m for m in (imposter_model, crew_model) if isinstance(m, SpatialDQN)
+        ]
+        assert len(recurrent_models) > 0, "Recurrent replay needs a SpatialDQN model"
+        assert all(
+            isinstance(m, SpatialDQN)
+            for m, opt in (
+                (imposter_model, imposter_optimizer),
+                (crew_model, crew_optimizer),
+            )
+            if opt is not None
+        ), "Recurrent replay can only train SpatialDQN models"
+        hidden_shape = recurrent_models[0].hidden_shape
+        assert all(
+            m.hidden_shape == hidden_shape for m in recurrent_models
+        ), "Recurrent models must share the RNN layers and hidden size"
+
+    if replay_buffer_path is not None:
+        if recurrent_replay:
+            buffer_type = EpisodeReplayBuffer
+        elif n_actors > 0:
+            buffer_type = SharedReplayBuffer
+        else:
+            buffer_type = ReplayBuffer
+        replay_buffer = buffer_type.load(replay_buffer_path)
+        assert (
+            replay_buffer.state_size == env.flattened_state_size
+            and replay_buffer.n_agents == env.n_agents
+            and replay_buffer.n_imposters == env.n_imposters
+            and (recurrent_replay or replay_buffer.trajectory_size == sequence_length)
+        ), "Saved replay buffer does not match the environment / sequence length"
+        assert (
+            replay_buffer.max_size == replay_buffer_size
+        ), f"Saved replay buffer holds {replay_buffer.max_size} steps, not replay_buffer_size"
+        assert recurrent_replay or (
+            replay_buffer.n_step == n_step and replay_buffer.gamma == gamma
+        ), "Saved replay buffer returns were computed with a different n-step / gamma"
+        assert (
+            n_actors == 0 or replay_buffer.n_shards == n_actors
+        ), f"Saved replay buffer has {replay_buffer.n_shards} shards, not one per actor"
+    else:
+        if recurrent_replay:
+            replay_buffer = EpisodeReplayBuffer(
+                max_size=replay_buffer_size,
+                state_size=env.flattened_state_size,
+                n_imposters=env.n_imposters,
+                n_agents=env.n_agents,
+                hidden_shape=hidden_shape,
+            )
+        elif n_actors > 0:
+            replay_buffer = SharedReplayBuffer(
+                max_size=replay_buffer_size,
+                trajectory_size=sequence_length,
+                state_size=env.flattened_state_size,
+                n_imposters=env.n_imposters,
+                n_agents=env.n_agents,
+                n_step=n_step,
+                gamma=gamma,
+                n_shards=n_actors,
+            )
+        else:
+            replay_buffer = ReplayBuffer(
+                max_size=replay_buffer_size,
+                trajectory_size=sequence_length,
+                state_size=env.flattened_state_size,
+                n_imposters=env.n_imposters,
+                n_agents=env.n_agents,
+                n_step=n_step,
+                gamma=gamma,
+                dedup_states=dedup_states,
+            )
 
-    replay_buffer.populate(env=env, num_steps=replay_prepopulate_steps)
+        replay_buffer.populate(env=env, num_steps=replay_prepopulate_steps)
 
     # run actual experiment
-    train(
-        env=env,
-        metrics=metrics,
-        num_steps=num_steps,
-        replay_buffer=replay_buffer,
-        featurizer=featurizer,
-        imposter_model=imposter_model,
-        crew_model=crew_model,
-        save_directory_path=experiment_dir,
-        train_step_interval=train_step_interval,
-        batch_size=batch_size,
-        gamma=gamma,
-        scheduler=scheduler,
-        trainer=trainer,
-        num_saves=num_checkpoint_saves,
-        target_update_interval=target_update_interval,
-    )
+    try:
+        train(
+            env=env,
+            metrics=metrics,
+            num_steps=num_steps,
+            replay_buffer=replay_buffer,
+            featurizer=featurizer,
+            imposter_model=imposter_model,
+            crew_model=crew_model,
+            save_directory_path=experiment_dir,
+            train_step_interval=train_step_interval,
+            batch_size=batch_size,
+            gamma=gamma,
+            scheduler=scheduler,
+            trainer=trainer,
+            num_saves=num_checkpoint_saves,
+            target_update_interval=target_update_interval,
+            sequence_length=sequence_length,
+            burn_in=burn_in,
+            prefetch_batches=prefetch_batches,
+            streaming_inference=streaming_inference,
+            resume_checkpoint_path=resume_checkpoint_path,
+        )
+    finally:
+        # keep the buffer even if training is interrupted, so the run can be resumed warm
+        if save_replay_buffer:
+            replay_buffer.save(experiment_dir / "replay_buffer.zip")
 
     avg_metrics = metrics.compute()
 
@@ -297,14 +577,23 @@ def train(
     gamma: float = 0.99,
     num_saves: int = 5,
     target_update_interval: int = 10_000,
+    sequence_length: int = 2,
+    burn_in: int = 2,
+    prefetch_batches: int = 0,
+    streaming_inference: bool = False,
+    resume_checkpoint_path: Optional[pathlib.Path] = None,
 ):
     returns = []
     game_lengths = []
     losses = []
     rewards = []
 
-    imposter_target_model = imposter_model.create_copy()
-    crew_target_model = crew_model.create_copy()
+    imposter_target_model, crew_target_model = copy_models([imposter_model, crew_model])
+
+    # everything a training checkpoint holds, per team
+    models = {"imposter": imposter_model, "crew": crew_model}
+    target_models = {"imposter": imposter_target_model, "crew": crew_target_model}
+    optimizers = {"imposter": trainer.imposter_optimizer, "crew": trainer.crew_optimizer}
 
     # Initialize structures to store the models at different stages of training
     t_saves = np.linspace(0, num_steps, num_saves - 1, endpoint=False, dtype=int)
@@ -312,6 +601,45 @@ def train(
 
     i_episode = 0  # Use this to indicate the index of the current episode
     t_episode = 0  # Use this to indicate the time-step inside current episode
+    t_start = 0
+
+    # resumed runs start a new episode at the saved step
+    if resume_checkpoint_path is not None:
+        counters = restore_training_checkpoint(
+            load_checkpoint(resume_checkpoint_path),
+            models,
+            target_models,
+            optimizers,
+            scheduler,
+        )
+        t_start, i_episode = counters["t_total"], counters["i_episode"]
+        print(f"Resuming training at step {t_start} (episode {i_episode})")
+
+    if isinstance(replay_buffer, SharedReplayBuffer):
+        # actor processes play and fill the buffer shards, this process only trains
+        assert not streaming_inference, "Actors act through an InferenceServer, not streamed"
+        _train_with_actors(
+            metrics=metrics,
+            num_steps=num_steps,
+            t_start=t_start,
+            i_episode=i_episode,
+            replay_buffer=replay_buffer,
+            featurizer=featurizer,
+            models=models,
+            target_models=target_models,
+            optimizers=optimizers,
+            scheduler=scheduler,
+            env=env,
+            save_directory_path=save_directory_path,
+            trainer=trainer,
+            t_saves=t_saves,
+            train_step_interval=train_step_interval,
+            batch_size=batch_size,
+            gamma=gamma,
+            target_update_interval=target_update_interval,
+            prefetch_batches=prefetch_batches,
+        )
+        return
 
     state, info = env.reset()  # Initialize state of first episode
 
@@ -321,20 +649,50 @@ def train(
             state
         )  # Initialize sequence with current state
 
+    # featurized window of the acting sequence, only new frames get featurized
+    stream = StreamingFeaturizer(featurizer, replay_buffer.trajectory_size)
+    stream.reset(state_sequence[-1])
+
     G = np.zeros(env.n_agents)
 
+    # recurrent replay: models see one frame per step and carry their hidden state instead
+    recurrent = isinstance(replay_buffer, EpisodeReplayBuffer)
+    if recurrent:
+        hidden = torch.zeros((env.n_agents, *replay_buffer.hidden_shape))
+
+    # streamed models encode every frame once, the cached encodings of the window are
+    # therefore computed with the weights at the time their frame was seen
+    model_states = None
+    if streaming_inference and not recurrent:
+        model_states = init_model_states(
+            [imposter_model, crew_model], env.n_agents, replay_buffer.trajectory_size
+        )
+
+    # sample and featurize the next batches while the models train on the current one,
+    # featurize is stateless so the sampling thread shares the featurizer
+    sampler = None
+    if prefetch_batches > 0 and not recurrent:
+        sampler = PrefetchingSampler(
+            replay_buffer,
+            batch_size=batch_size,
+            n_buffers=prefetch_batches,
+            featurizer=featurizer,
+        )
+
     # Iterate for a total of `num_steps` steps
-    pbar = tqdm.trange(num_steps)
+    pbar = tqdm.trange(t_start, num_steps)
     for t_total in pbar:
 
         # Save model
         if t_total in t_saves and trainer.train:
-            percent_progress = f"{int(t_total * 100 / num_steps)}"
-            imposter_model.dump_to_checkpoint(
-                save_directory_path / f"imposter_{imposter_model.model_type}_{percent_progress}.pt"
-            )
-            crew_model.dump_to_checkpoint(
-                save_directory_path / f"crew_{crew_model.model_type}_{percent_progress}.pt"
+            _save_checkpoints(
+                save_directory_path,
+                f"{int(t_total * 100 / num_steps)}",
+                models,
+                target_models,
+                optimizers,
+                scheduler,
+                counters={"t_total": t_total, "i_episode": i_episode},
             )
 
         # Update Target DQNs
@@ -342,43 +700,25 @@ def train(
             imposter_target_model.load_state_dict(imposter_model.state_dict())
             crew_target_model.load_state_dict(crew_model.state_dict())
 
-        # featurizing current trajectory
-        featurizer.fit(
-            torch.tensor(state_sequence).unsqueeze(0)
-        )  # add batch dimension to state_sequence (features expect a batch dimension)
+        # featurizing current trajectory (batch of one)
+        features = stream.current()
 
-        # getting next action
+        # getting next action, one forward pass per team for all its alive agents
         eps = scheduler.value(t_total)
-        agent_actions = np.zeros(env.n_agents, dtype=np.int32)
         alive_agents = state[env.state_fields[StateFields.ALIVE_AGENTS]]
 
         with torch.no_grad():
-            for agent_idx, (spatial, non_spatial) in enumerate(
-                featurizer.generate_featurized_states()
-            ):
-
-                # choose action for alive imposter
-                if env.imposter_mask[agent_idx] and alive_agents[agent_idx]:
-
-                    if np.random.random() <= eps:
-                        agent_actions[agent_idx] = np.random.randint(
-                            0, env.n_imposter_actions
-                        )
-                    else:
-                        agent_actions[agent_idx] = int(
-                            torch.argmax(imposter_model(spatial, non_spatial))
-                        )
-
-                # choose action for alive crew member
-                elif alive_agents[agent_idx]:
-                    if np.random.random() <= eps:
-                        agent_actions[agent_idx] = np.random.randint(
-                            0, env.n_crew_actions
-                        )
-                    else:
-                        agent_actions[agent_idx] = int(
-                            torch.argmax(crew_model(spatial, non_spatial))
-                        )
+            agent_actions, next_hidden, model_states = select_actions(
+                env,
+                featurizer,
+                features,
+                imposter_model,
+                crew_model,
+                alive_agents,
+                eps=eps,
+                hidden=hidden if recurrent else None,
+                model_states=model_states,
+            )
 
         next_state, reward, done, trunc, info = env.step(agent_actions=agent_actions)
 
@@ -389,29 +729,57 @@ def train(
         next_state_sequence[-1] = env.flatten_state(next_state)
 
         # adding the timestep to replay buffer
-        replay_buffer.add(
-            state=state_sequence,
-            action=agent_actions,
-            reward=reward,
-            done=done,
-            next_state=next_state_sequence,
-            imposters=env.imposter_idxs,
-        )
+        if recurrent:
+            replay_buffer.add(
+                state=state_sequence[-1],
+                action=agent_actions,
+                reward=reward,
+                done=done,
+                truncated=trunc,
+                imposters=env.imposter_idxs,
+                hidden=hidden,
+            )
+            hidden = next_hidden
+        else:
+            replay_buffer.add(
+                state=state_sequence,
+                action=agent_actions,
+                reward=reward,
+                done=done,
+                next_state=next_state_sequence,
+                imposters=env.imposter_idxs,
+                truncated=trunc,
+            )
 
         # Training update for imposters and/or crew
         if t_total % train_step_interval == 0:
 
-            # get sample of trajectories to train on
-            batch = replay_buffer.sample(batch_size)
-
-            step_losses = trainer.train_step(
-                batch=batch,
-                featurizer=featurizer,
-                imposter_model=imposter_model,
-                imposter_target_model=imposter_target_model,
-                crew_model=crew_model,
-                crew_target_model=crew_target_model,
-            )
+            # get sample of trajectories to train on, one batch per team
+            if recurrent:
+                batch = replay_buffer.sample_by_role(batch_size, sequence_length, burn_in)
+                step_losses = trainer.train_sequence_step(
+                    batch=batch,
+                    featurizer=featurizer,
+                    imposter_model=imposter_model,
+                    imposter_target_model=imposter_target_model,
+                    crew_model=crew_model,
+                    crew_target_model=crew_target_model,
+                    burn_in=burn_in,
+                )
+            else:
+                if sampler is not None:
+                    batch, features = sampler.get()
+                else:
+                    batch, features = replay_buffer.sample_by_role(batch_size), None
+                step_losses = trainer.train_step(
+                    batch=batch,
+                    featurizer=featurizer,
+                    imposter_model=imposter_model,
+                    imposter_target_model=imposter_target_model,
+                    crew_model=crew_model,
+                    crew_target_model=crew_target_model,
+                    features=features,
+                )
 
             losses.append(step_losses)
 
@@ -443,20 +811,198 @@ def train(
             )
             for i in range(replay_buffer.trajectory_size):
                 state_sequence[i] = env.flatten_state(state)
+            stream.reset(state_sequence[-1])
+
+            if recurrent:
+                hidden = torch.zeros((env.n_agents, *replay_buffer.hidden_shape))
+            if model_states is not None:
+                model_states = init_model_states(
+                    [imposter_model, crew_model],
+                    env.n_agents,
+                    replay_buffer.trajectory_size,
+                )
 
         else:
             state = next_state
             state_sequence = next_state_sequence
+            stream.push(state_sequence[-1])
             t_episode += 1
 
+    if sampler is not None:
+        sampler.close()
+
+    if featurizer.cache is not None:
+        print(f"Feature cache: {featurizer.cache.stats()}")
+
     # saving final model states
-    imposter_model.dump_to_checkpoint(
-        save_directory_path / f"imposter_{imposter_model.model_type}_100%.pt"
+    _save_checkpoints(
+        save_directory_path,
+        "100%",
+        models,
+        target_models,
+        optimizers,
+        scheduler,
+        counters={"t_total": num_steps, "i_episode": i_episode},
+    )
+    _set_training_metrics(metrics, returns, losses)
+
+
+def _train_with_actors(
+    metrics: EpisodicMetricHandler,
+    num_steps: int,
+    t_start: int,
+    i_episode: int,
+    replay_buffer: SharedReplayBuffer,
+    featurizer: SequenceStateFeaturizer,
+    models: dict,
+    target_models: dict,
+    optimizers: dict,
+    scheduler: ExponentialSchedule,
+    env: FourRoomEnv,
+    save_directory_path: pathlib.Path,
+    trainer: DQNTeamTrainer,
+    t_saves: np.ndarray,
+    train_step_interval: int,
+    batch_size: int,
+    gamma: float,
+    target_update_interval: int,
+    prefetch_batches: int,
+):
+    """
+    Learner loop of `train` with a SharedReplayBuffer: one actor process per buffer shard
+    plays (see ActorPool) with the models of an InferenceServer, this process trains on the
+    shared buffer and publishes the new weights to the server after every update.
+
+    The learner follows the global step of the actors, so updates, target updates and
+    saves happen at the same steps as in the single process loop. Actors act with weights
+    at most one update (and the server's queue latency) old.
+    """
+    imposter_model, crew_model = models["imposter"], models["crew"]
+    imposter_target_model, crew_target_model = (
+        target_models["imposter"],
+        target_models["crew"],
     )
-    crew_model.dump_to_checkpoint(
-        save_directory_path / f"crew_{crew_model.model_type}_100%.pt"
+    returns = []
+    losses = []
+
+    server = InferenceServer(imposter_model, crew_model, n_clients=replay_buffer.n_shards)
+    pool = ActorPool(
+        env,
+        featurizer,
+        replay_buffer,
+        server,
+        scheduler,
+        gamma,
+        num_steps,
+        start_step=t_start,
     )
+    sampler = None
+    if prefetch_batches > 0:
+        sampler = PrefetchingSampler(
+            replay_buffer,
+            batch_size=batch_size,
+            n_buffers=prefetch_batches,
+            featurizer=featurizer,
+        )
+
+    def record(episodes):
+        nonlocal i_episode
+        for episode in episodes:
+            returns.append([episode["imposter_return"], episode["crew_return"]])
+            metrics.step(episode["info"])
+            i_episode += 1
+        if episodes and losses:
+            pbar.set_description(
+                f"Episode: {i_episode} | Steps: {episode['length'] + 1} | Epsilon: {episode['eps']:4.2f} | Imposter Loss: {losses[-1][0]:4.2f} | Crew Loss: {losses[-1][1]:4.2f} | Imposter Return: {episode['imposter_return']:4.2f} | Crew Return: {episode['crew_return']:4.2f}"
+            )
+
+    try:
+        pbar = tqdm.trange(t_start, num_steps)
+        for t_total in pbar:
+            # wait for the actors to take this step
+            while pool.n_steps <= t_total:
+                pool.wait(t_total + 1)
+                record(pool.finished_episodes())
+
+            if t_total in t_saves and trainer.train:
+                _save_checkpoints(
+                    save_directory_path,
+                    f"{int(t_total * 100 / num_steps)}",
+                    models,
+                    target_models,
+                    optimizers,
+                    scheduler,
+                    counters={"t_total": t_total, "i_episode": i_episode},
+                )
+
+            if t_total % target_update_interval == 0:
+                imposter_target_model.load_state_dict(imposter_model.state_dict())
+                crew_target_model.load_state_dict(crew_model.state_dict())
+
+            if t_total % train_step_interval == 0:
+                if sampler is not None:
+                    batch, features = sampler.get()
+                else:
+                    batch, features = replay_buffer.sample_by_role(batch_size), None
+                losses.append(
+                    trainer.train_step(
+                        batch=batch,
+                        featurizer=featurizer,
+                        imposter_model=imposter_model,
+                        imposter_target_model=imposter_target_model,
+                        crew_model=crew_model,
+                        crew_target_model=crew_target_model,
+                        features=features,
+                    )
+                )
+                if trainer.train:
+                    server.publish_weights(imposter_model, crew_model)
+
+            record(pool.finished_episodes())
+    finally:
+        pool.close()
+        server.close()
+        if sampler is not None:
+            sampler.close()
+    record(pool.finished_episodes())
+
+    _save_checkpoints(
+        save_directory_path,
+        "100%",
+        models,
+        target_models,
+        optimizers,
+        scheduler,
+        counters={"t_total": num_steps, "i_episode": i_episode},
+    )
+    _set_training_metrics(metrics, returns, losses)
+
+
+def _save_checkpoints(
+    save_directory_path: pathlib.Path,
+    progress: str,
+    models: dict,
+    target_models: dict,
+    optimizers: dict,
+    scheduler: ExponentialSchedule,
+    counters: dict,
+):
+    """Model checkpoints of both teams and the training checkpoint at `progress`."""
+    for name, model in models.items():
+        model.dump_to_checkpoint(
+            save_directory_path / f"{name}_{model.model_type}_{progress}.pt"
+        )
+    save_training_checkpoint(
+        save_directory_path / f"training_{progress}.pt",
+        models,
+        target_models,
+        optimizers,
+        scheduler,
+        counters=counters,
+    )
+
 
+def _set_training_metrics(metrics: EpisodicMetricHandler, returns, losses):
     returns = np.array(returns)
     metrics.set({
         SusMetrics.AVG_IMPOSTER_RETURNS: returns[:, 0].tolist(),
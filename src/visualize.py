@@ -12,8 +12,9 @@ from IPython.display import display
 from src.replay_memory import ReplayBuffer
 from src.models.dqn import ModelType, Q_Estimator
 from src.metrics import SusMetrics
-from src.features.model_ready import SequenceStateFeaturizer
-from src.environment import FourRoomEnv
+from src.features.model_ready import SequenceStateFeaturizer, StreamingFeaturizer
+from src.environment import FourRoomEnv, StateFields
+from src.policy import init_model_states, select_actions
 
 ASSETS_PATH = pathlib.Path(__file__).parent.parent / "assets"
 
@@ -319,16 +320,18 @@ class StateSequenceVisualizer:
         self.featurizer = featurizer
         self.cmap = cmap
 
-    def visualize_global_state(self, imposters: torch.Tensor):
-        for b, spatial in enumerate(torch.unbind(self.featurizer.spatial, dim=0)):
+    def visualize_global_state(self, state_sequence: torch.Tensor, imposters: torch.Tensor):
+        features = self.featurizer.featurize(state_sequence)
+        for b, spatial in enumerate(torch.unbind(features.spatial, dim=0)):
             imposters_locations = set(imposters[b].tolist())
             self._visualize_sequence(
                 spatial, imposters_locations, title=f"Global State, Batch {b}"
             )
 
-    def visualize_perspectives(self, imposters: torch.Tensor):
+    def visualize_perspectives(self, state_sequence: torch.Tensor, imposters: torch.Tensor):
+        features = self.featurizer.featurize(state_sequence)
         for agent_id, (batched_spatial, batch_non_spatial) in enumerate(
-            self.featurizer.generator()
+            self.featurizer.generate_featurized_states(features)
         ):
             B, *_ = batched_spatial.size()
             for b in range(B):
@@ -507,6 +510,9 @@ def run_game(
     sequence_length: int = 2,
     debug: bool = True,
 ):
+    # featurized window of the played sequence, only new frames get featurized
+    stream = StreamingFeaturizer(featurizer, sequence_length)
+
     def reset_game(visualizer):
         state, _ = visualizer.reset()
         replay_memory = ReplayBuffer(
@@ -521,10 +527,15 @@ def run_game(
         )
         for i in range(replay_memory.trajectory_size):
             state_sequence[i] = visualizer.env.flatten_state(state)
-        return state, replay_memory, state_sequence
+        stream.reset(state_sequence[-1])
+        # models are fixed, streamed inference gives the same Q-values as the whole window
+        model_states = init_model_states(
+            [imposter_model, crew_model], visualizer.env.n_agents, sequence_length
+        )
+        return state, replay_memory, state_sequence, model_states
     
     with AmongUsVisualizer(env) as visualizer:
-        state, replay_memory, state_sequence = reset_game(visualizer)
+        state, replay_memory, state_sequence, model_states = reset_game(visualizer)
 
         stop_game = False
         done = False
@@ -540,26 +551,32 @@ def run_game(
                     break
                 # if you click r, reset the game
                 if event.type == pygame.KEYDOWN and event.key == pygame.K_r:
-                    state, replay_memory, state_sequence = reset_game(visualizer)
+                    state, replay_memory, state_sequence, model_states = reset_game(
+                        visualizer
+                    )
                     paused = False
                     done = False
 
             if not done and not paused:
-                featurizer.fit(state_sequence=torch.tensor(state_sequence).unsqueeze(0))
-                actions = []
-                action_strs = []
-
-                for agent_idx, (agent_spatial, agent_non_spatial) in enumerate(
-                    featurizer.generate_featurized_states()
-                ):
-                    if agent_idx in env.imposter_idxs:
-                        action_probs = imposter_model(agent_spatial, agent_non_spatial)
-                        action = action_probs.argmax().item()
-                    else:
-                        action = crew_model(agent_spatial, agent_non_spatial).argmax().item()
-                    action_strs.append(env.compute_action(agent_idx, action))
-                    
-                    actions.append(action)
+                features = stream.current()
+                alive_agents = state[env.state_fields[StateFields.ALIVE_AGENTS]]
+
+                # greedy actions, one forward pass per team
+                with torch.no_grad():
+                    agent_actions, _, model_states = select_actions(
+                        env,
+                        featurizer,
+                        features,
+                        imposter_model,
+                        crew_model,
+                        alive_agents,
+                        model_states=model_states,
+                    )
+                actions = agent_actions.tolist()
+                action_strs = [
+                    env.compute_action(agent_idx, action)
+                    for agent_idx, action in enumerate(actions)
+                ]
 
                 next_state, reward, done, truncated, _ = visualizer.step(actions)
 
@@ -580,6 +597,7 @@ def run_game(
 
                 state = next_state
                 state_sequence = next_state_sequence
+                stream.push(state_sequence[-1])
 
             pygame.time.wait(250)
         visualizer.close()
@@ -0,0 +1,59 @@
+import torch
+
+from src.actors import ActorPool
+from src.environment import FourRoomEnv
+from src.features.component import CompositeFeaturizer, CoordinateAgentPositionsFeaturizer
+from src.features.model_ready import FeaturizerType
+from src.inference_server import InferenceServer
+from src.models.dqn import ModelType
+from src.replay_memory import SharedReplayBuffer
+from src.scheduler import ExponentialSchedule
+
+N_ACTORS, SEQUENCE_LENGTH, NUM_STEPS = 2, 2, 120
+
+
+def test_actors_fill_their_shards():
+    env = FourRoomEnv(n_imposters=1, n_crew=3, n_jobs=2, max_time_steps=20)
+    featurizer = FeaturizerType.build(
+        FeaturizerType.FLAT,
+        env,
+        featurizers=CompositeFeaturizer([CoordinateAgentPositionsFeaturizer(env)]),
+    )
+    n_features = int(featurizer.featurized_shape[1][0]) * SEQUENCE_LENGTH
+    imposter_model, crew_model = [
+        ModelType.build(ModelType.MLP, layer_dims=[n_features, 16, n_actions])
+        for n_actions in (env.n_imposter_actions, env.n_crew_actions)
+    ]
+    replay_buffer = SharedReplayBuffer(
+        max_size=1000,
+        state_size=env.flattened_state_size,
+        trajectory_size=SEQUENCE_LENGTH,
+        n_agents=env.n_agents,
+        n_imposters=env.n_imposters,
+        n_shards=N_ACTORS,
+    )
+
+    server = InferenceServer(imposter_model, crew_model, n_clients=N_ACTORS)
+    try:
+        with ActorPool(
+            env,
+            featurizer,
+            replay_buffer,
+            server,
+            ExponentialSchedule(1.0, 0.5, NUM_STEPS),
+            gamma=0.99,
+            num_steps=NUM_STEPS,
+        ) as pool:
+            pool.wait(NUM_STEPS, timeout=120)
+            server.publish_weights(imposter_model, crew_model)
+        episodes = pool.finished_episodes()
+    finally:
+        server.close()
+
+    assert pool.n_steps == NUM_STEPS
+    assert replay_buffer.size == NUM_STEPS
+    assert all(replay_buffer.shard_sizes > 0)
+    assert len(episodes) >= NUM_STEPS // env.max_time_steps - N_ACTORS
+    assert all(episode["length"] < env.max_time_steps for episode in episodes)
+    batch = replay_buffer.sample_by_role(8)
+    assert all(torch.isfinite(role_batch.rewards).all() for role_batch in batch)
@@ -0,0 +1,21 @@
+import pytest
+import torch
+
+from src.features.benchmark import (
+    build_env,
+    component_featurizers,
+    reference_component_features,
+)
+from src.features.sampling import random_states
+
+
+@pytest.mark.parametrize("env_name", ["FourRoomEnv", "ImposterTrainingGround"])
+@pytest.mark.parametrize("n_crew", [2, 3, 5, 7, 9])
+def test_batch_features_match_per_state_features(env_name, n_crew):
+    env = build_env(env_name, n_crew)
+    states = random_states(env, 200, seed=n_crew)
+    for featurizer in component_featurizers(env):
+        output = featurizer.extract_features_batch(states)
+        reference = reference_component_features(featurizer, states)
+        assert output.shape == reference.shape, featurizer.__class__.__name__
+        assert torch.equal(output.float(), reference.float()), featurizer.__class__.__name__
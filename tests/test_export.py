@@ -0,0 +1,30 @@
+import torch
+
+from src.environment import FourRoomEnv
+from src.features.component import CompositeFeaturizer, CoordinateAgentPositionsFeaturizer
+from src.features.model_ready import FeaturizerType
+from src.models.dqn import ModelType
+from src.models.export import example_inputs, export_model
+
+SEQUENCE_LENGTH = 2
+
+
+def test_export_keeps_model_mode_and_outputs(tmp_path):
+    env = FourRoomEnv(n_imposters=1, n_crew=3, n_jobs=2)
+    featurizer = FeaturizerType.build(
+        FeaturizerType.FLAT,
+        env,
+        featurizers=CompositeFeaturizer([CoordinateAgentPositionsFeaturizer(env)]),
+    )
+    n_features = int(featurizer.featurized_shape[1][0]) * SEQUENCE_LENGTH
+    model = ModelType.build(ModelType.MLP, layer_dims=[n_features, 16, env.n_crew_actions])
+    model.train()
+
+    path = tmp_path / "model.pt"
+    assert export_model(model, featurizer, SEQUENCE_LENGTH, path)["matches"]
+    assert model.training
+
+    exported = ModelType.build(ModelType.MLP, exported_model_path=path)
+    inputs = example_inputs(featurizer, SEQUENCE_LENGTH, seed=1)
+    with torch.no_grad():
+        assert torch.allclose(exported(*inputs), model.eval()(*inputs), atol=1e-5)
@@ -0,0 +1,15 @@
+from src.features.benchmark import failed_checks, run_featurizer_benchmark
+
+
+def test_every_environment_matches_reference():
+    report = run_featurizer_benchmark(
+        n_crews=[3], batch_sizes=[4], sequence_lengths=[2], n_repeats=1
+    )
+    assert not failed_checks(report)
+
+
+def test_failed_run_is_a_failed_check():
+    report = run_featurizer_benchmark(
+        env_names=["UnknownEnv"], n_crews=[3], batch_sizes=[4], sequence_lengths=[2]
+    )
+    assert failed_checks(report) == report["runs"]
@@ -0,0 +1,81 @@
+import time
+
+import pytest
+import torch
+
+from src.inference_server import InferenceServer
+from src.models.dqn import MLP, Q_Estimator
+
+N_ACTIONS = 4
+
+
+class EchoModel(Q_Estimator):
+    """
+    Q-values are the first spatial inputs. Inputs with a positive first value are slow,
+    spatial and non-spatial inputs of different sizes fail.
+    """
+
+    @property
+    def model_type(self):
+        return "echo"
+
+    def forward(self, spatial_x, non_spatial_x):
+        if len(spatial_x) != len(non_spatial_x):
+            raise ValueError("Batch sizes differ")
+        if spatial_x.flatten()[0] > 0:
+            time.sleep(3)
+        return spatial_x.flatten(1)[:, :N_ACTIONS]
+
+
+def _inputs(value: float):
+    return (torch.full((2, 1, 8), value), torch.zeros(2, 1, 3))
+
+
+def test_late_answer_is_not_returned_to_next_request():
+    server = InferenceServer(EchoModel(), EchoModel(), n_clients=1, response_timeout=0.5)
+    client = server.client(0)
+    try:
+        with pytest.raises(TimeoutError):
+            client.q_values([_inputs(1.0), None])
+        # the late answer arrives while waiting for this one
+        client.timeout = 30
+        q_values = client.q_values([_inputs(-1.0), None])
+        assert torch.equal(q_values[0], torch.full((2, N_ACTIONS), -1.0))
+    finally:
+        server.close()
+
+
+def test_failed_request_does_not_stop_server():
+    server = InferenceServer(EchoModel(), EchoModel(), n_clients=2)
+    client = server.client(0)
+    try:
+        with pytest.raises(ValueError):
+            client.q_values([(torch.zeros(2, 1, 8), torch.zeros(3, 1, 3)), None])
+        q_values = server.client(1).q_values([None, _inputs(-2.0)])
+        assert q_values[0] is None
+        assert torch.equal(q_values[1], torch.full((2, N_ACTIONS), -2.0))
+    finally:
+        server.close()
+
+
+def test_learner_updates_are_served_once_published():
+    imposter_model, crew_model = MLP([4, N_ACTIONS]), MLP([4, N_ACTIONS])
+    server = InferenceServer(imposter_model, crew_model, n_clients=1)
+    client = server.client(0)
+    inputs = (torch.zeros(1, 1), torch.ones(1, 4))
+    try:
+        served = client.q_values([inputs, None])[0]
+        with torch.no_grad():
+            for x in imposter_model.parameters():
+                x.add_(1.0)
+        assert torch.equal(client.q_values([inputs, None])[0], served)
+
+        server.publish_weights(imposter_model, crew_model)
+        deadline = time.perf_counter() + 30
+        while torch.equal(client.q_values([inputs, None])[0], served):
+            assert time.perf_counter() < deadline, "Published weights were never served"
+            time.sleep(0.05)
+        with torch.no_grad():
+            assert torch.allclose(client.q_values([inputs, None])[0], imposter_model(*inputs))
+    finally:
+        server.close()
@@ -0,0 +1,68 @@
+import pytest
+import torch
+
+from src.environment import FourRoomEnv
+from src.features.model_ready import FeaturizerType
+from src.models.dqn import ModelType
+
+SEQUENCE_LENGTH = 2
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    env = FourRoomEnv(n_imposters=1, n_crew=3, n_jobs=2)
+    featurizer = FeaturizerType.build(FeaturizerType.PERPSECTIVE, env)
+    spatial_shape, non_spatial_shape = featurizer.featurized_shape
+    model = ModelType.build(
+        ModelType.SPATIAL_DQN,
+        n_actions=env.n_crew_actions,
+        input_image_size=env.n_cols,
+        non_spatial_input_size=int(non_spatial_shape[0]),
+        n_channels=[int(spatial_shape[0]), 8, 8],
+        strides=[1, 1],
+        paddings=[1, 1],
+        kernel_size=[3, 3],
+        dilations=[1, 1],
+        rnn_layers=1,
+        rnn_hidden_dim=16,
+        rnn_dropout=0.0,
+        mlp_hidden_layer_dims=[16],
+    )
+    path = tmp_path / "model.pt"
+    model.dump_to_checkpoint(path)
+    return path, featurizer
+
+
+def test_report_is_kept_and_engine_restored(checkpoint):
+    path, featurizer = checkpoint
+    if "qnnpack" not in torch.backends.quantized.supported_engines:
+        pytest.skip("Needs a second quantized engine")
+    previous_engine = torch.backends.quantized.engine
+    # the convolutions are converted for the x86 engine
+    torch.backends.quantized.engine = "qnnpack"
+    try:
+        quantized = ModelType.build(
+            ModelType.SPATIAL_DQN,
+            pretrained_model_path=path,
+            quantized=True,
+            quantize_convs=True,
+            featurizer=featurizer,
+            sequence_length=SEQUENCE_LENGTH,
+        )
+        assert torch.backends.quantized.engine == "qnnpack"
+    finally:
+        torch.backends.quantized.engine = previous_engine
+    assert 0 <= quantized.quantization_report["greedy_agreement"] <= 1
+
+
+def test_low_greedy_agreement_fails_build(checkpoint):
+    path, featurizer = checkpoint
+    with pytest.raises(AssertionError):
+        ModelType.build(
+            ModelType.SPATIAL_DQN,
+            pretrained_model_path=path,
+            quantized=True,
+            featurizer=featurizer,
+            sequence_length=SEQUENCE_LENGTH,
+            min_greedy_agreement=1.1,
+        )
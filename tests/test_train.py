@@ -0,0 +1,63 @@
+import torch
+
+from src.environment import FourRoomEnv
+from src.features.model_ready import FeaturizerType
+from src.features.sampling import random_states
+from src.models.dqn import ModelType
+from src.replay_memory import SequenceBatch
+from src.train import DQNTeamTrainer
+
+BATCH_SIZE, SEQUENCE_LENGTH, BURN_IN = 4, 3, 2
+
+
+def _sequence_batch(env, valid):
+    n_frames = BURN_IN + SEQUENCE_LENGTH + 1
+    states = random_states(env, BATCH_SIZE * n_frames).view(BATCH_SIZE, n_frames, -1)
+    return SequenceBatch(
+        states=states,
+        actions=torch.zeros(BATCH_SIZE, n_frames - 1, dtype=torch.long),
+        rewards=torch.ones(BATCH_SIZE, n_frames - 1),
+        dones=torch.zeros(BATCH_SIZE, n_frames - 1, dtype=torch.bool),
+        agents=torch.ones(BATCH_SIZE, dtype=torch.long),
+        hidden=torch.zeros(BATCH_SIZE, 1, 16),
+        valid=valid,
+    )
+
+
+def test_all_padding_sequences_are_not_trained():
+    env = FourRoomEnv(n_imposters=1, n_crew=3, n_jobs=2)
+    featurizer = FeaturizerType.build(FeaturizerType.PERPSECTIVE, env)
+    spatial_shape, non_spatial_shape = featurizer.featurized_shape
+    model = ModelType.build(
+        ModelType.SPATIAL_DQN,
+        n_actions=env.n_crew_actions,
+        input_image_size=env.n_cols,
+        non_spatial_input_size=int(non_spatial_shape[0]),
+        n_channels=[int(spatial_shape[0]), 4, 4],
+        strides=[1, 1],
+        paddings=[1, 1],
+        kernel_size=[3, 3],
+        dilations=[1, 1],
+        rnn_layers=1,
+        rnn_hidden_dim=16,
+        rnn_dropout=0.0,
+        mlp_hidden_layer_dims=[16],
+    )
+    target_model = model.create_copy()
+    trainer = DQNTeamTrainer(None, torch.optim.Adam(model.parameters()), gamma=0.9)
+    weights = {name: x.clone() for name, x in model.state_dict().items()}
+
+    n_frames = BURN_IN + SEQUENCE_LENGTH + 1
+    padding = _sequence_batch(env, torch.zeros(BATCH_SIZE, n_frames, dtype=torch.bool))
+    losses = trainer.train_sequence_step(
+        (padding, padding), featurizer, None, None, model, target_model, BURN_IN
+    )
+    assert losses == [0, 0]
+    assert all(torch.equal(x, weights[name]) for name, x in model.state_dict().items())
+
+    episode = _sequence_batch(env, torch.ones(BATCH_SIZE, n_frames, dtype=torch.bool))
+    losses = trainer.train_sequence_step(
+        (episode, episode), featurizer, None, None, model, target_model, BURN_IN
+    )
+    assert torch.isfinite(torch.tensor(losses[1])) and losses[1] > 0
+    assert not all(torch.equal(x, weights[name]) for name, x in model.state_dict().items())